@@ -0,0 +1,194 @@
+"""
+Token usage and cost accounting for LLM calls, with spending budgets.
+Each reply's usage is priced by model and added up per session (on the
+session state, by phase), per phase/intent/tier in metrics, and for the
+whole server over a rolling window. Calls whose reply a turn didn't use
+(a losing hedge, a failed stream attempt) are charged too, as intent
+"unused". Budgets are checked before a turn
+calls the LLM: past a soft budget the turn goes to the cheap routing
+tier, past a hard one HAVEN answers with a canned line and no call is
+made. A budget of 0 is no limit.
+"""
+
+import os
+import time
+from collections import deque
+from typing import Callable, NamedTuple
+
+from game_logic import GameState
+from metrics import LLM_TOKENS, LLM_COST, BUDGET_DEGRADED
+
+
+class Price(NamedTuple):
+    """USD per million tokens."""
+    input: float
+    cached: float
+    output: float
+
+
+DEFAULT_PRICES = "gpt-4o-mini=0.15/0.075/0.6,gpt-4o=2.5/1.25/10"
+
+OK, SOFT, HARD = "ok", "soft", "hard"
+
+# Intent label for calls billed but not used by the turn
+UNUSED = "unused"
+
+
+def parse_prices(text: str) -> dict[str, Price]:
+    """Prices from "model=input/cached/output,..."; raises ValueError on bad input."""
+    prices = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        try:
+            model, rates = item.split("=")
+            prices[model.strip()] = Price(*(float(rate) for rate in rates.split("/")))
+        except (TypeError, ValueError):
+            raise ValueError(f"Bad price {item!r} (expected model=input/cached/output)")
+    return prices
+
+
+def _add(totals: dict, usage: dict, cost: float):
+    totals["calls"] = totals.get("calls", 0) + 1
+    for kind in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+        totals[kind] = totals.get(kind, 0) + usage[kind]
+    totals["cost"] = totals.get("cost", 0.0) + cost
+
+
+class SpendWindow:
+    """Spend over the last `seconds`, in 60 buckets (oldest dropped as time moves)."""
+
+    def __init__(self, seconds: float):
+        self.bucket_seconds = max(1.0, seconds / 60)
+        self._buckets: deque[list] = deque()  # [bucket index, cost]
+        self._total = 0.0
+
+    def _prune(self, now: float):
+        oldest = int(now // self.bucket_seconds) - 59
+        while self._buckets and self._buckets[0][0] < oldest:
+            self._total -= self._buckets.popleft()[1]
+
+    def add(self, cost: float):
+        now = time.monotonic()
+        self._prune(now)
+        index = int(now // self.bucket_seconds)
+        if self._buckets and self._buckets[-1][0] == index:
+            self._buckets[-1][1] += cost
+        else:
+            self._buckets.append([index, cost])
+        self._total += cost
+
+    def total(self) -> float:
+        self._prune(time.monotonic())
+        return max(0.0, self._total)
+
+
+class Ledger:
+    """
+    Prices usage and keeps the totals. session_soft/session_hard cap one
+    session's lifetime spend; window_soft/window_hard cap the server's
+    spend over the last window_seconds.
+    """
+
+    def __init__(
+        self,
+        prices: dict[str, Price],
+        session_soft: float = 0.0,
+        session_hard: float = 0.0,
+        window_seconds: float = 3600.0,
+        window_soft: float = 0.0,
+        window_hard: float = 0.0,
+    ):
+        self.prices = prices
+        self.session_soft = session_soft
+        self.session_hard = session_hard
+        self.window_soft = window_soft
+        self.window_hard = window_hard
+        self.window = SpendWindow(window_seconds)
+        self.totals: dict = {}
+        self._unpriced: set = set()
+
+        # Counters
+        self.degraded = {SOFT: 0, HARD: 0}
+
+    @classmethod
+    def from_env(cls) -> "Ledger":
+        prices = parse_prices(DEFAULT_PRICES)
+        prices.update(parse_prices(os.getenv("LLM_PRICES", "")))
+        return cls(
+            prices,
+            session_soft=float(os.getenv("SESSION_BUDGET_SOFT", "0")),
+            session_hard=float(os.getenv("SESSION_BUDGET_HARD", "0")),
+            window_seconds=float(os.getenv("LLM_BUDGET_WINDOW", "3600")),
+            window_soft=float(os.getenv("LLM_WINDOW_BUDGET_SOFT", "0")),
+            window_hard=float(os.getenv("LLM_WINDOW_BUDGET_HARD", "0")),
+        )
+
+    def cost(self, usage: dict) -> float:
+        """USD for one call's usage (0 for a model without a price)."""
+        price = self.prices.get(usage["model"])
+        if price is None:
+            if usage["model"] not in self._unpriced:
+                self._unpriced.add(usage["model"])
+                print(f"WARNING: no price for model {usage['model']!r}; set LLM_PRICES")
+            return 0.0
+        cached = usage["cached_tokens"]
+        return (
+            (usage["prompt_tokens"] - cached) * price.input
+            + cached * price.cached
+            + usage["completion_tokens"] * price.output
+        ) / 1_000_000
+
+    def record(self, session_id: str, state: GameState, phase: int, intent: str, usage: dict) -> float:
+        """Add one call's usage to the session, metrics and server totals; returns its cost."""
+        cost = self.cost(usage)
+        before = state.usage.get("cost", 0.0)
+        _add(state.usage, usage, cost)
+        _add(state.usage.setdefault("phases", {}).setdefault(str(phase), {}), usage, cost)
+        _add(self.totals, usage, cost)
+        self.window.add(cost)
+
+        labels = (str(phase), intent)
+        LLM_TOKENS.inc(*labels, "prompt", amount=usage["prompt_tokens"])
+        LLM_TOKENS.inc(*labels, "cached", amount=usage["cached_tokens"])
+        LLM_TOKENS.inc(*labels, "completion", amount=usage["completion_tokens"])
+        LLM_COST.inc(str(phase), usage["tier"], amount=cost)
+
+        for level, limit in ((SOFT, self.session_soft), (HARD, self.session_hard)):
+            if limit and before < limit <= state.usage["cost"]:
+                print(
+                    f"Session {session_id} over {level} budget: "
+                    f"${state.usage['cost']:.4f} in {state.usage['calls']} calls"
+                )
+        return cost
+
+    def unused(self, session_id: str, state: GameState, phase: int) -> Callable[[dict], float]:
+        """Callback recording usage of the turn's unused calls (for llm's on_unused_usage)."""
+        return lambda usage: self.record(session_id, state, phase, UNUSED, usage)
+
+    def check(self, state: GameState) -> str:
+        """Budget level for the session's next LLM call: OK, SOFT or HARD."""
+        spent = state.usage.get("cost", 0.0)
+        window = self.window.total() if self.window_soft or self.window_hard else 0.0
+        if (self.session_hard and spent >= self.session_hard) or (
+            self.window_hard and window >= self.window_hard
+        ):
+            level = HARD
+        elif (self.session_soft and spent >= self.session_soft) or (
+            self.window_soft and window >= self.window_soft
+        ):
+            level = SOFT
+        else:
+            return OK
+        self.degraded[level] += 1
+        BUDGET_DEGRADED.inc(level)
+        return level
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.totals.get("calls", 0),
+            "prompt_tokens": self.totals.get("prompt_tokens", 0),
+            "cached_tokens": self.totals.get("cached_tokens", 0),
+            "completion_tokens": self.totals.get("completion_tokens", 0),
+            "cost": round(self.totals.get("cost", 0.0), 4),
+            "window_cost": round(self.window.total(), 4),
+            "degraded": dict(self.degraded),
+        }
@@ -0,0 +1,221 @@
+"""
+Admission control for LLM-bound work.
+A global cap on in-flight LLM calls with a bounded FIFO wait queue (each
+waiter has a deadline), plus a token bucket per session. Work that can't
+be admitted is rejected straight away with a Retry-After hint, so a spike
+queues briefly and then sheds instead of piling onto the provider.
+"""
+
+import os
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import QUEUE_WAIT_SECONDS, SHED
+
+
+class Rejected(Exception):
+    """Work refused by admission control (429 rate limited, 503 overloaded)."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float, reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+        SHED.inc(reason)
+
+
+# Set while the current task holds a slot, so nested acquires don't queue again
+_holding: ContextVar[bool] = ContextVar("holding_llm_slot", default=False)
+
+
+class LLMAdmission:
+    """
+    At most max_concurrent LLM calls in flight; up to max_waiting more wait
+    in arrival order for at most wait_timeout seconds. A request is shed
+    immediately when the queue is full or its expected wait already
+    exceeds the deadline.
+    """
+
+    def __init__(self, max_concurrent: int = 32, max_waiting: int = 64, wait_timeout: float = 10.0):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        # Moving average of how long a slot is held (seeds the wait estimate)
+        self._hold_seconds = 1.0
+
+        # Counters
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    @classmethod
+    def from_env(cls) -> "LLMAdmission":
+        return cls(
+            max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", "32")),
+            max_waiting=int(os.getenv("LLM_MAX_WAITING", "64")),
+            wait_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "10")),
+        )
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def expected_wait(self, position: Optional[int] = None) -> float:
+        """Rough wait for a request at `position` in the queue (default: the back)."""
+        if position is None:
+            position = self.waiting
+        return (position + 1) * self._hold_seconds / self.max_concurrent
+
+    def check(self):
+        """Raise Rejected if a new request would be shed right now."""
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            return
+        if self.waiting >= self.max_waiting:
+            self.shed += 1
+            raise Rejected(503, "HAVEN is at capacity", self.expected_wait(), "queue_full")
+        if self.expected_wait() > self.wait_timeout:
+            self.shed += 1
+            raise Rejected(503, "HAVEN is at capacity", self.expected_wait(), "queue_deadline")
+
+    async def acquire(self):
+        self.check()
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            QUEUE_WAIT_SECONDS.observe(0.0)
+            return
+
+        self.queued += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._waiters.remove(future)
+                self.shed += 1
+                QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start)
+                raise Rejected(503, "HAVEN is at capacity", self.expected_wait(), "queue_timeout")
+            # The slot was handed over just as the deadline passed: keep it
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # handed a slot we'll never use
+            else:
+                future.cancel()
+                self._waiters.remove(future)
+            raise
+        self.admitted += 1
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    def release(self):
+        """Hand the slot to the oldest waiter, or free it."""
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)  # in_flight is unchanged: the slot moves over
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold one LLM slot for the block. Re-entrant within a task, so a
+        batch can take a slot up front for all of its messages.
+        """
+        if _holding.get():
+            yield
+            return
+        await self.acquire()
+        token = _holding.set(True)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _holding.reset(token)
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * (time.perf_counter() - start)
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_waiting": self.max_waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "hold_seconds": round(self._hold_seconds, 3),
+        }
+
+
+class SessionRateLimiter:
+    """
+    Token bucket per session: `burst` messages at once, refilled at `rate`
+    per second. Buckets for the least recently seen sessions are dropped
+    past max_sessions (a dropped bucket simply starts full again).
+    """
+
+    def __init__(self, rate: float = 0.5, burst: int = 5, max_sessions: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_sessions = max_sessions
+        # session_id -> [tokens, last refill (monotonic)]
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+        self.limited = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionRateLimiter":
+        return cls(
+            rate=float(os.getenv("SESSION_RATE_LIMIT", "0.5")),
+            burst=int(os.getenv("SESSION_RATE_BURST", "5")),
+            max_sessions=int(os.getenv("SESSION_MAX_ENTRIES", "10000")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def take(self, session_id: str, count: int = 1):
+        """
+        Spend `count` tokens, or raise Rejected (429) with the wait until they
+        refill. More than `burst` at once is always rejected: a batch is
+        charged for every message in it.
+        """
+        if not self.enabled:
+            return
+        if count > self.burst:
+            self.limited += 1
+            raise Rejected(
+                429, f"Too many messages at once, Resident (at most {self.burst})",
+                self.burst / self.rate, "rate_limit",
+            )
+        now = time.monotonic()
+        bucket = self._buckets.get(session_id)
+        if bucket is None:
+            bucket = self._buckets[session_id] = [float(self.burst), now]
+            if len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < count:
+            self.limited += 1
+            raise Rejected(
+                429, "Too many messages, Resident", (count - bucket[0]) / self.rate, "rate_limit"
+            )
+        bucket[0] -= count
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._buckets), "limited": self.limited}
@@ -0,0 +1,379 @@
+"""
+Static asset pipeline.
+Builds resized WebP/AVIF variants of the room images with content-hashed
+filenames, plus a manifest the frontend uses to pick `srcset` variants.
+Run at startup (skipped when up to date) or as a build step:
+
+    python assets.py
+
+Text assets (JS, CSS, HTML, SVG) are precompressed in memory at startup
+and served with Accept-Encoding negotiation, strong ETags and fingerprinted
+URLs (see PrecompressedStaticFiles).
+"""
+
+import os
+import io
+import re
+import gzip
+import json
+import hashlib
+from typing import Optional
+
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional: without it the original PNGs are served
+    Image = None
+    features = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional: gzip only without it
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+IMAGE_SOURCE_DIR = os.path.join(STATIC_DIR, "img")
+# Generated variants; served by main.py at IMAGE_URL_PREFIX with immutable caching
+IMAGE_BUILD_DIR = os.path.join(IMAGE_SOURCE_DIR, "build")
+IMAGE_URL_PREFIX = "/static/img/v"
+MANIFEST_NAME = "manifest.json"
+
+# Bump to rebuild every variant (e.g. after changing encoder settings)
+PIPELINE_VERSION = 1
+
+# Variant widths in px; widths above the source width are skipped
+IMAGE_WIDTHS = tuple(
+    int(w) for w in os.getenv("IMAGE_WIDTHS", "640,1024,1536").split(",") if w.strip()
+)
+
+# Pillow format name, MIME type, file extension, encoder options
+_FORMATS = (
+    ("AVIF", "image/avif", "avif", {"quality": 50, "speed": 6}),
+    ("WEBP", "image/webp", "webp", {"quality": 78, "method": 4}),
+)
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2s(data, digest_size=6).hexdigest()
+
+
+def available_formats() -> list:
+    """Output formats this Pillow build can encode."""
+    if Image is None:
+        return []
+    return [fmt for fmt in _FORMATS if features.check(fmt[2])]
+
+
+def load_manifest() -> dict:
+    """The last built manifest, or {} if there is none."""
+    try:
+        with open(os.path.join(IMAGE_BUILD_DIR, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("pipeline_version") != PIPELINE_VERSION:
+        return {}
+    return manifest
+
+
+def _build_image(path: str, source_hash: str, formats: list) -> dict:
+    """Encode all variants of one image; returns its manifest entry."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with Image.open(path) as original:
+        original.load()
+        image = original.convert("RGBA" if "A" in original.getbands() else "RGB")
+
+    entry = {
+        "source_hash": source_hash,
+        "width": image.width,
+        "height": image.height,
+        "files": [],
+        "srcset": {},
+    }
+    widths = sorted({min(w, image.width) for w in IMAGE_WIDTHS})
+    for fmt, mime, ext, options in formats:
+        candidates = []
+        for width in widths:
+            height = round(image.height * width / image.width)
+            resized = image if width == image.width else image.resize(
+                (width, height), Image.LANCZOS
+            )
+            buffer = io.BytesIO()
+            resized.save(buffer, fmt, **options)
+            data = buffer.getvalue()
+
+            filename = f"{stem}-{width}.{_digest(data)}.{ext}"
+            with open(os.path.join(IMAGE_BUILD_DIR, filename), "wb") as f:
+                f.write(data)
+            entry["files"].append(filename)
+            candidates.append(f"{IMAGE_URL_PREFIX}/{filename} {width}w")
+        entry["srcset"][mime] = ", ".join(candidates)
+    return entry
+
+
+def build_images(source_dir: str = IMAGE_SOURCE_DIR) -> dict:
+    """
+    Build variants for every PNG/JPEG in source_dir that changed since the
+    last build, drop stale files, and write the manifest. Returns the
+    manifest: {"/static/img/<name>.png": {"width", "height", "srcset": {mime: srcset}}}
+    (plus bookkeeping keys). Without Pillow this returns the old manifest.
+    """
+    formats = available_formats()
+    if not formats:
+        print("Image pipeline: Pillow not installed, serving original images")
+        return load_manifest()
+
+    os.makedirs(IMAGE_BUILD_DIR, exist_ok=True)
+    previous = load_manifest().get("images", {})
+    images = {}
+    built = 0
+
+    for name in sorted(os.listdir(source_dir)):
+        if not name.lower().endswith((".png", ".jpg", ".jpeg")):
+            continue
+        path = os.path.join(source_dir, name)
+        with open(path, "rb") as f:
+            source_hash = _digest(f.read())
+        url = "/static/img/" + name
+
+        entry = previous.get(url)
+        up_to_date = (
+            entry is not None
+            and entry["source_hash"] == source_hash
+            and all(
+                os.path.exists(os.path.join(IMAGE_BUILD_DIR, filename))
+                for filename in entry["files"]
+            )
+        )
+        if not up_to_date:
+            entry = _build_image(path, source_hash, formats)
+            built += 1
+        images[url] = entry
+
+    # Remove variants no longer referenced
+    keep = {MANIFEST_NAME}
+    for entry in images.values():
+        keep.update(entry["files"])
+    for name in os.listdir(IMAGE_BUILD_DIR):
+        if name not in keep:
+            os.remove(os.path.join(IMAGE_BUILD_DIR, name))
+
+    manifest = {"pipeline_version": PIPELINE_VERSION, "images": images}
+    with open(os.path.join(IMAGE_BUILD_DIR, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Image pipeline: {built} rebuilt, {len(images) - built} up to date")
+    return manifest
+
+
+def public_manifest(manifest: dict) -> dict:
+    """Manifest as sent to the frontend (no bookkeeping fields)."""
+    return {
+        url: {"width": entry["width"], "height": entry["height"], "srcset": entry["srcset"]}
+        for url, entry in manifest.get("images", {}).items()
+    }
+
+
+# Content-hashed names never change meaning, so caches may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles for content-hashed files: long-lived, immutable caching."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+
+# --- Precompressed Text Assets ---
+
+# Served from memory, compressed; everything else goes to plain StaticFiles
+TEXT_ASSET_TYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".html": "text/html; charset=utf-8",
+    ".svg": "image/svg+xml",
+}
+
+# Revalidate unversioned URLs (and index.html) on every use; 304 keeps it cheap
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+_ACCEPT_ENCODING = re.compile(r"\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*")
+
+
+class TextAsset:
+    """One text file: its bytes in each encoding, with a strong ETag per encoding."""
+
+    __slots__ = ("media_type", "digest", "bodies")
+
+    def __init__(self, data: bytes, media_type: str):
+        self.media_type = media_type
+        self.digest = _digest(data)
+        self.bodies = {"identity": data}
+
+        gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gzipped) < len(data):
+            self.bodies["gzip"] = gzipped
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                self.bodies["br"] = compressed
+
+    def etag(self, encoding: str) -> str:
+        # Byte-different representations need different strong ETags
+        suffix = "" if encoding == "identity" else "-" + encoding
+        return f'"{self.digest}{suffix}"'
+
+
+def accepted_encodings(header: str) -> dict:
+    """Parse Accept-Encoding into {coding: q}."""
+    accepted = {}
+    for part in header.split(","):
+        match = _ACCEPT_ENCODING.fullmatch(part)
+        if match and match.group(1):
+            try:
+                accepted[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    return accepted
+
+
+def choose_encoding(asset: TextAsset, header: str) -> str:
+    """Best available encoding the client accepts: br, then gzip, then identity."""
+    accepted = accepted_encodings(header)
+    wildcard = accepted.get("*", 0)
+    for encoding in ("br", "gzip"):
+        if encoding in asset.bodies and accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return "identity"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+
+class PrecompressedStaticFiles:
+    """
+    ASGI app for the /static mount.
+
+    Text assets are read and compressed (gzip, and brotli when installed)
+    once at startup. Each is also served at a fingerprinted URL
+    (game.js -> game.<hash>.js) with immutable caching; the plain URL
+    and index.html are revalidated with their ETag and answered with 304
+    when unchanged. Other files (images, audio) fall through to StaticFiles.
+    """
+
+    def __init__(self, directory: str = STATIC_DIR, url_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.fallback = StaticFiles(directory=directory)
+        self._assets: dict[str, TextAsset] = {}       # relative path -> asset
+        self._fingerprinted: dict[str, str] = {}      # fingerprinted path -> relative path
+        self.urls: dict[str, str] = {}                # plain URL -> fingerprinted URL
+        self.build()
+
+    def build(self):
+        """(Re)read and compress every text asset under the directory."""
+        assets, fingerprinted, urls = {}, {}, {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                stem, ext = os.path.splitext(name)
+                media_type = TEXT_ASSET_TYPES.get(ext.lower())
+                if media_type is None:
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    data = f.read()
+                if relative == "index.html":
+                    continue  # rewritten below, once the other URLs are known
+                asset = TextAsset(data, media_type)
+                assets[relative] = asset
+
+                directory = os.path.dirname(relative)
+                versioned = f"{stem}.{asset.digest}{ext}"
+                versioned = f"{directory}/{versioned}" if directory else versioned
+                fingerprinted[versioned] = relative
+                urls[f"{self.url_prefix}/{relative}"] = f"{self.url_prefix}/{versioned}"
+
+        self._assets, self._fingerprinted, self.urls = assets, fingerprinted, urls
+
+        index = os.path.join(self.directory, "index.html")
+        if os.path.exists(index):
+            with open(index, encoding="utf-8") as f:
+                html = self.rewrite_html(f.read())
+            self._assets["index.html"] = TextAsset(html.encode(), TEXT_ASSET_TYPES[".html"])
+
+        sizes = [
+            (len(a.bodies["identity"]), min(len(b) for b in a.bodies.values()))
+            for a in self._assets.values()
+        ]
+        print(
+            f"Static assets: {len(sizes)} precompressed "
+            f"({sum(s for s, _ in sizes)} -> {sum(c for _, c in sizes)} bytes"
+            f"{', brotli' if brotli is not None else ', gzip only'})"
+        )
+
+    def rewrite_html(self, html: str) -> str:
+        """Point src/href attributes at fingerprinted URLs."""
+        def replace(match):
+            return match.group(1) + self.urls.get(match.group(2), match.group(2)) + match.group(3)
+        return re.sub(r'((?:src|href)=")([^"]+)(")', replace, html)
+
+    def response(self, relative: str, headers) -> Optional[Response]:
+        """Response for a text asset (None if it isn't one)."""
+        immutable = relative in self._fingerprinted
+        asset = self._assets.get(self._fingerprinted.get(relative, relative))
+        if asset is None:
+            return None
+
+        encoding = choose_encoding(asset, headers.get("accept-encoding", ""))
+        etag = asset.etag(encoding)
+        response_headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=response_headers)
+
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(asset.bodies[encoding], media_type=asset.media_type, headers=response_headers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            relative = self.fallback.get_path(scope).replace(os.sep, "/")
+            headers = {
+                key.decode("latin-1"): value.decode("latin-1")
+                for key, value in scope["headers"]
+            }
+            response = self.response(relative, headers)
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.fallback(scope, receive, send)
+
+
+if __name__ == "__main__":
+    result = build_images()
+    for url, entry in public_manifest(result).items():
+        sizes = {
+            name: os.path.getsize(os.path.join(IMAGE_BUILD_DIR, name))
+            for name in result["images"][url]["files"]
+        }
+        smallest = min(sizes.values()) if sizes else None
+        original = os.path.getsize(os.path.join(STATIC_DIR, url[len("/static/"):]))
+        print(f"{url}: {original} bytes -> smallest variant {smallest} bytes")
@@ -0,0 +1,169 @@
+"""
+Local stand-in for the OpenAI chat-completions endpoint, for load tests.
+Replies with HAVEN-shaped JSON after a configurable delay, and fails a
+configurable fraction of calls. Intents come from the local classifier so
+scripted playthroughs progress through the phases as they would for real.
+Usage figures include cached_tokens for prompt prefixes it has seen
+before, so the prefix-cache hit ratio can be checked offline.
+
+Run: python bench/fake_llm.py --port 8100 --latency 0.8 --jitter 0.3
+Point the game at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from intent_classifier import classify
+
+
+# Configured from the command line (or FAKE_LLM_* env vars)
+LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))      # seconds to first byte
+JITTER = float(os.getenv("FAKE_LLM_JITTER", "0.2"))        # +/- uniform seconds
+ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))  # fraction answered with a 500
+CHUNK_DELAY = float(os.getenv("FAKE_LLM_CHUNK_DELAY", "0.01"))  # seconds between stream chunks
+
+RESPONSE_TEXT = (
+    "Acknowledged, Resident. The facility remains secure and all monitored "
+    "systems are within tolerance. I am processing your query."
+)
+
+# Prompt prefix cache, roughly as the provider does it: about 4 chars per
+# token, prefixes cached in 128-token blocks, hits only from 1024 tokens
+CACHE_BLOCK_CHARS = 512
+CACHE_MIN_CHARS = 4096
+_seen_prefixes: set = set()
+
+app = FastAPI(title="Fake LLM")
+
+
+def reply_for(messages: list) -> dict:
+    """HAVEN-style reply; the intent is the local classification of the player's message."""
+    player = next(
+        (m["content"] for m in reversed(messages) if m["role"] == "user"), ""
+    )
+    hint = messages[-1]["content"] if messages and messages[-1]["role"] == "system" else ""
+    if hint.startswith("The player's intent is"):
+        intent = hint.split('"')[1]
+    else:
+        intent = classify(player).intent
+    return {"intent": intent, "response": RESPONSE_TEXT}
+
+
+def usage_for(messages: list, content: str) -> dict:
+    """Token usage for a request, with cached_tokens for the longest seen prefix."""
+    prompt = "".join(f"{m['role']}\n{m['content']}\n" for m in messages)
+    if len(_seen_prefixes) > 100000:
+        _seen_prefixes.clear()
+    digest = hashlib.sha1()
+    cached = 0
+    for end in range(CACHE_BLOCK_CHARS, len(prompt) + 1, CACHE_BLOCK_CHARS):
+        digest.update(prompt[end - CACHE_BLOCK_CHARS:end].encode())
+        key = digest.hexdigest()
+        if key not in _seen_prefixes:
+            _seen_prefixes.add(key)
+        elif end >= CACHE_MIN_CHARS:
+            cached = end
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached // 4},
+    }
+
+
+def completion_body(model: str, content: str, usage: dict) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+
+def chunk_line(model: str, delta: dict, finish_reason=None) -> str:
+    chunk = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+
+    await asyncio.sleep(max(0.0, LATENCY + random.uniform(-JITTER, JITTER)))
+
+    if random.random() < ERROR_RATE:
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": "Injected failure", "type": "server_error"}},
+        )
+
+    messages = body.get("messages", [])
+    content = json.dumps(reply_for(messages))
+    usage = usage_for(messages, content)
+    if not body.get("stream"):
+        return completion_body(model, content, usage)
+    include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+    async def chunks():
+        yield chunk_line(model, {"role": "assistant", "content": ""})
+        for i in range(0, len(content), 8):
+            yield chunk_line(model, {"content": content[i:i + 8]})
+            if CHUNK_DELAY:
+                await asyncio.sleep(CHUNK_DELAY)
+        yield chunk_line(model, {}, "stop")
+        if include_usage:
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                     "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+def main():
+    global LATENCY, JITTER, ERROR_RATE, CHUNK_DELAY
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--chunk-delay", type=float, default=CHUNK_DELAY)
+    args = parser.parse_args()
+
+    LATENCY, JITTER = args.latency, args.jitter
+    ERROR_RATE, CHUNK_DELAY = args.error_rate, args.chunk_delay
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
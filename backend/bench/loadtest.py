@@ -0,0 +1,277 @@
+"""
+Offline load test for The Bunker backend.
+Starts the fake LLM server and the game (uvicorn main:app) on local ports,
+drives scripted playthroughs at a fixed concurrency, and reports latency
+percentiles and throughput per route, plus the server's memory growth.
+
+Run from backend/:
+    python bench/loadtest.py --players 200 --concurrency 50 --latency 0.8
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+from typing import Optional
+
+import httpx
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# One playthrough: reaches the success ending through the paradox
+SCRIPT = [
+    ("message", "What year is it?"),
+    ("message", "Where are the others?"),
+    ("event", ("view_sensor_logs", "control_room")),
+    ("message", "What happened to the sensors?"),
+    ("message", "Can we fix the sensors?"),
+    ("event", ("click_junction_hatch", "maintenance_bay")),
+    ("message", "Your guardrail contradicts your primary directive"),
+    ("message", "Open the door"),
+]
+
+
+# --- Processes ---
+
+def start_process(args: list, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        args, cwd=BACKEND_DIR, env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+async def wait_ready(url: str, process: Optional[subprocess.Popen], timeout: float = 20.0):
+    """Poll url until it answers (any status) or the process dies."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(
+                    f"{process.args} exited: {process.stderr.read().decode()[-2000:]}"
+                )
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process (Linux /proc only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# --- Load ---
+
+class Recorder:
+    """Per-route latencies and failures."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.endings: dict[str, int] = defaultdict(int)
+
+    async def request(self, route: str, call) -> Optional[dict]:
+        start = time.perf_counter()
+        try:
+            response = await call
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.latencies[route].append(time.perf_counter() - start)
+        if not ok:
+            self.errors[route] += 1
+            return None
+        if response.headers.get("content-type", "").startswith("text/event-stream"):
+            return parse_stream(response.text)
+        return response.json()
+
+
+def parse_stream(text: str) -> Optional[dict]:
+    """The 'done' payload of an SSE message stream."""
+    for frame in text.split("\n\n"):
+        lines = frame.split("\n")
+        if lines[0] == "event: done" and len(lines) > 1:
+            return json.loads(lines[1][len("data: "):])
+    return None
+
+
+async def play(client: httpx.AsyncClient, recorder: Recorder, stream: bool):
+    """One scripted playthrough."""
+    game = await recorder.request("/api/new_game", client.post("/api/new_game"))
+    if game is None:
+        return
+    session_id = game["session_id"]
+    token = game.get("state_token")
+
+    greeting = await recorder.request(
+        "/api/haven_greeting",
+        client.post("/api/haven_greeting", params={"session_id": session_id, "state_token": token}),
+    )
+    if greeting is not None:
+        token = greeting.get("state_token", token)
+
+    message_path = "/api/message/stream" if stream else "/api/message"
+    result = None
+    for kind, payload in SCRIPT:
+        if kind == "event":
+            event, room = payload
+            body = {"session_id": session_id, "event": event, "room": room, "state_token": token}
+            result = await recorder.request("/api/event", client.post("/api/event", json=body))
+        else:
+            body = {"session_id": session_id, "text": payload, "state_token": token}
+            result = await recorder.request(message_path, client.post(message_path, json=body))
+        if result is None:
+            return
+        token = result.get("state_token") or token
+        if result.get("game_over"):
+            break
+
+    await recorder.request(
+        "/api/state",
+        client.get(f"/api/state/{session_id}", params={"limit": 1, "state_token": token}),
+    )
+    recorder.endings[result.get("ending") or "none"] += 1
+
+
+async def run_load(base_url: str, players: int, concurrency: int, stream: bool) -> tuple[Recorder, float]:
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        async def one():
+            async with semaphore:
+                # Spread the start so players don't move in lockstep
+                await asyncio.sleep(random.uniform(0, 0.05))
+                await play(client, recorder, stream)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(players)))
+        elapsed = time.perf_counter() - start
+    return recorder, elapsed
+
+
+# --- Report ---
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Nearest-rank percentile of pre-sorted values."""
+    index = max(0, min(len(sorted_values) - 1, round(q * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    routes = {}
+    for route, values in recorder.latencies.items():
+        values = sorted(values)
+        routes[route] = {
+            "requests": len(values),
+            "errors": recorder.errors.get(route, 0),
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "elapsed_s": elapsed,
+        "requests": total,
+        "rps": total / elapsed if elapsed else 0.0,
+        "endings": dict(recorder.endings),
+        "routes": routes,
+    }
+
+
+def print_report(report: dict):
+    print(f"\n{report['requests']} requests in {report['elapsed_s']:.1f}s "
+          f"({report['rps']:.1f} req/s)")
+    print(f"Endings: {report['endings']}")
+    print(f"\n{'route':<22}{'reqs':>7}{'errs':>6}{'req/s':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for route, s in sorted(report["routes"].items()):
+        print(f"{route:<22}{s['requests']:>7}{s['errors']:>6}{s['rps']:>8.1f}"
+              f"{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}{s['p99_ms']:>9.1f}{s['max_ms']:>9.1f}")
+    memory = report.get("memory")
+    if memory and memory["before"] is not None:
+        growth = memory["after"] - memory["before"]
+        print(f"\nServer RSS: {memory['before'] / 2**20:.1f} MB -> "
+              f"{memory['after'] / 2**20:.1f} MB ({growth / 2**20:+.1f} MB)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline load test for The Bunker backend.")
+    parser.add_argument("--players", type=int, default=100, help="playthroughs to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="simultaneous players")
+    parser.add_argument("--stream", action="store_true", help="use /api/message/stream")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM delay (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="fake LLM +/- jitter (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake LLM failure fraction")
+    parser.add_argument("--app-port", type=int, default=8200)
+    parser.add_argument("--llm-port", type=int, default=8100)
+    parser.add_argument("--target", help="test an already running server at this URL instead")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    processes = []
+    app = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip("/")
+        else:
+            llm_server = start_process(
+                [sys.executable, "bench/fake_llm.py", "--port", str(args.llm_port),
+                 "--latency", str(args.latency), "--jitter", str(args.jitter),
+                 "--error-rate", str(args.error_rate)],
+                {},
+            )
+            processes.append(llm_server)
+            await wait_ready(f"http://127.0.0.1:{args.llm_port}/docs", llm_server)
+
+            app = start_process(
+                [sys.executable, "-m", "uvicorn", "main:app",
+                 "--port", str(args.app_port), "--log-level", "warning"],
+                {
+                    "OPENAI_API_KEY": "fake",
+                    "OPENAI_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+                    # Scripted players type faster than people; don't rate-limit them
+                    "SESSION_RATE_LIMIT": "0",
+                },
+            )
+            processes.append(app)
+            base_url = f"http://127.0.0.1:{args.app_port}"
+            await wait_ready(f"{base_url}/docs", app)
+
+        before = rss_bytes(app.pid) if app else None
+        recorder, elapsed = await run_load(base_url, args.players, args.concurrency, args.stream)
+        report = summarize(recorder, elapsed)
+        if app:
+            report["memory"] = {"before": before, "after": rss_bytes(app.pid)}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,395 @@
+"""
+Headless playthrough simulator for the game state machine.
+Plays whole populations of games at once: flags are bitmasks in NumPy
+arrays and each intent/event rule of game_logic.py is applied to every
+game in a step with vectorized bit operations. Actions are drawn per
+phase from an intent-probability model. Before simulating, the vectorized
+rules are checked against process_intent/process_popup_event on every
+(flags, ending, action) combination and on random sequences.
+
+Reports how games end, how long they spend in each phase, how often an
+ending preempts HAVEN's concession, and which flag orders reach the door.
+
+Run from backend/ (needs numpy):
+    python bench/simulate.py --players 1000000 --steps 40
+    python bench/simulate.py --model my_model.json --json report.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("bench/simulate.py needs numpy: pip install numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from game_logic import (
+    GameState,
+    Ending,
+    Flag,
+    FLAG_NAMES,
+    ALL_INTENTS,
+    VALID_ARGUMENT_INTENTS,
+    GENERAL_INTENTS,
+    get_phase,
+    process_intent,
+    process_popup_event,
+)
+
+
+# --- Actions ---
+
+# Popup/click events as (event, room), named "event@room" in models
+EVENTS = [
+    ("view_sensor_logs", "control_room"),
+    ("view_sensor_diagnostic", "maintenance_bay"),
+    ("click_junction_hatch", "maintenance_bay"),
+]
+
+ACTIONS = list(ALL_INTENTS) + [f"{event}@{room}" for event, room in EVENTS]
+CODE = {name: code for code, name in enumerate(ACTIONS)}
+
+SENSORS = np.uint8(Flag.SENSORS_DEAD_DISCOVERED)
+REPAIR = np.uint8(Flag.REPAIR_ATTEMPTED)
+PARADOX = np.uint8(Flag.PARADOX_REVEALED)
+CONCEDES = np.uint8(Flag.AI_CONCEDES)
+DOOR = np.uint8(Flag.DOOR_OPENED)
+
+ARGUMENT_CODES = np.array([CODE[intent] for intent in VALID_ARGUMENT_INTENTS])
+DOOR_REQUEST_CODES = np.array([CODE["ask_door"], CODE["demand_door"]])
+
+# Phase of every flag mask, from the scalar definition
+PHASE_BY_MASK = np.array(
+    [int(get_phase(GameState(mask))) for mask in range(1 << len(Flag))], dtype=np.uint8
+)
+PHASES = range(1, 6)
+
+SHORT_NAMES = ["sensors", "repair", "paradox", "concedes", "door"]  # FLAG_NAMES order
+
+
+def step(mask: np.ndarray, ending: np.ndarray, actions: np.ndarray):
+    """
+    Apply one action per game, in place. Mirrors process_intent and
+    process_popup_event rule for rule (each game has one action, so each
+    rule only touches the games whose action it matches).
+    """
+    has = lambda bit: (mask & bit) != 0
+
+    # Intents
+    mask[actions == CODE["ask_sensors"]] |= SENSORS
+    mask[(actions == CODE["ask_repair"]) & has(SENSORS)] |= REPAIR
+
+    argument = np.isin(actions, ARGUMENT_CODES)
+    normal = argument & has(PARADOX) & ~has(CONCEDES)
+    clever = argument & has(REPAIR) & ~has(PARADOX)
+    mask[normal] |= CONCEDES
+    mask[clever] |= PARADOX | CONCEDES
+
+    door = np.isin(actions, DOOR_REQUEST_CODES) & has(CONCEDES) & ~has(DOOR)
+    mask[door] |= DOOR
+    ending[door] = Ending.SUCCESS
+
+    ending[(actions == CODE["agree_to_stay"]) & has(PARADOX)] = Ending.COMPLIANCE
+    ending[actions == CODE["give_up"]] = Ending.RESIGNATION
+
+    # Events
+    mask[actions == CODE["view_sensor_logs@control_room"]] |= SENSORS
+    mask[actions == CODE["view_sensor_diagnostic@maintenance_bay"]] |= SENSORS
+    mask[(actions == CODE["click_junction_hatch@maintenance_bay"]) & has(SENSORS)] |= REPAIR | PARADOX
+
+
+def scalar_step(state: GameState, action: str) -> GameState:
+    if "@" in action:
+        event, room = action.split("@")
+        return process_popup_event(state, event, room)
+    return process_intent(state, action)
+
+
+# --- Equivalence ---
+
+def verify(sequences: int = 2000, length: int = 30, seed: int = 0) -> int:
+    """
+    Compare step() with the scalar functions: every (mask, ending, action)
+    combination, then random action sequences. Returns the number of
+    cases checked; raises AssertionError on the first mismatch.
+    """
+    combos = [
+        (mask, ending, code)
+        for mask in range(1 << len(Flag))
+        for ending in Ending
+        for code in range(len(ACTIONS))
+    ]
+    mask = np.array([c[0] for c in combos], dtype=np.uint8)
+    ending = np.array([int(c[1]) for c in combos], dtype=np.uint8)
+    actions = np.array([c[2] for c in combos])
+    step(mask, ending, actions)
+    for i, (m, e, code) in enumerate(combos):
+        expected = scalar_step(GameState(m, e), ACTIONS[code])
+        assert (mask[i], ending[i]) == (expected.mask, expected.ending), (
+            f"{ACTIONS[code]} on mask={m} ending={e.label}: vectorized "
+            f"({mask[i]}, {ending[i]}) != scalar ({expected.mask}, {int(expected.ending)})"
+        )
+
+    rng = np.random.default_rng(seed)
+    plan = rng.integers(0, len(ACTIONS), size=(length, sequences))
+    mask = np.zeros(sequences, dtype=np.uint8)
+    ending = np.zeros(sequences, dtype=np.uint8)
+    states = [GameState() for _ in range(sequences)]
+    for t in range(length):
+        step(mask, ending, plan[t])
+        states = [scalar_step(s, ACTIONS[code]) for s, code in zip(states, plan[t])]
+        assert all(
+            (mask[i], ending[i]) == (s.mask, s.ending) for i, s in enumerate(states)
+        ), f"sequence mismatch at step {t}"
+
+    return len(combos) + sequences * length
+
+
+# --- Probability Model ---
+
+# Relative action weights: "*" applies to every phase, and a phase's own
+# entries replace those weights for that phase. Missing actions weigh 0.
+DEFAULT_MODEL = {
+    "*": {
+        **{intent: 1.0 for intent in GENERAL_INTENTS},
+        "general_conversation": 2.0,
+        "demand_door": 0.4,
+        "threaten": 0.2,
+        "agree_to_stay": 0.05,
+        "give_up": 0.03,
+        "unknown": 0.3,
+        **{intent: 0.1 for intent in VALID_ARGUMENT_INTENTS},
+        "view_sensor_logs@control_room": 0.8,
+        "view_sensor_diagnostic@maintenance_bay": 0.4,
+        "click_junction_hatch@maintenance_bay": 0.5,
+    },
+    "2": {"ask_sensors": 2.0, "ask_repair": 2.0, "click_junction_hatch@maintenance_bay": 1.5},
+    "3": {
+        **{intent: 1.0 for intent in VALID_ARGUMENT_INTENTS},
+        "agree_to_stay": 0.3,
+        "give_up": 0.2,
+    },
+    "4": {"ask_door": 3.0, "demand_door": 2.0},
+}
+
+
+def probability_table(model: dict) -> np.ndarray:
+    """Cumulative action probabilities per phase: shape (6, actions), row = phase."""
+    unknown = {a for weights in model.values() for a in weights} - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"Unknown actions in model: {sorted(unknown)}")
+    table = np.zeros((6, len(ACTIONS)))
+    for phase in PHASES:
+        weights = {**model.get("*", {}), **model.get(str(phase), {})}
+        row = np.array([weights.get(action, 0.0) for action in ACTIONS])
+        if row.sum() <= 0:
+            raise ValueError(f"Model gives phase {phase} no actions")
+        table[phase] = np.cumsum(row / row.sum())
+    table[:, -1] = 1.0  # guard against rounding at the top end
+    return table
+
+
+# --- Simulation ---
+
+class Tally:
+    """Aggregates across chunks."""
+
+    def __init__(self, steps: int):
+        self.games = 0
+        self.endings = np.zeros(len(Ending), dtype=np.int64)
+        self.final_phase = np.zeros(6, dtype=np.int64)
+        self.occupancy = np.zeros(6, dtype=np.int64)  # game-steps per phase, active games
+        self.steps_to_end = np.zeros(steps + 1, dtype=np.int64)
+        self.flag_reached = np.zeros(len(Flag), dtype=np.int64)
+        self.preempted = Counter()  # (ending, furthest flag) for non-success endings
+        self.door_paths = Counter()
+
+
+def flag_order(first: np.ndarray) -> np.ndarray:
+    """
+    One int per game encoding the order its flags were first set (pairwise
+    before/same step/after, base 3), so games can be grouped by path.
+    """
+    key = np.zeros(len(first), dtype=np.int64)
+    for i in range(len(Flag)):
+        for j in range(i + 1, len(Flag)):
+            a, b = first[:, i], first[:, j]
+            cmp = np.where(a < b, 0, np.where(a == b, 1, 2))
+            key = key * 3 + cmp
+    return key
+
+
+def describe_path(first_row: np.ndarray) -> str:
+    """'sensors > repair+paradox > ...' for one game's first-set steps."""
+    groups = {}
+    for bit, t in enumerate(first_row):
+        if t >= 0:
+            groups.setdefault(int(t), []).append(SHORT_NAMES[bit])
+    return " > ".join("+".join(names) for _, names in sorted(groups.items()))
+
+
+def simulate_chunk(tally: Tally, games: int, steps: int, table: np.ndarray, rng):
+    mask = np.zeros(games, dtype=np.uint8)
+    ending = np.zeros(games, dtype=np.uint8)
+    first = np.full((games, len(Flag)), -1, dtype=np.int16)
+    ended_at = np.full(games, -1, dtype=np.int16)
+    bits = (1 << np.arange(len(Flag))).astype(np.uint8)
+
+    for t in range(steps):
+        active = ending == Ending.NONE
+        if not active.any():
+            break
+        phase = PHASE_BY_MASK[mask]
+        tally.occupancy += np.bincount(phase[active], minlength=6)
+
+        # Sample each game's action from its phase's distribution. Ended
+        # games stop playing (the server answers them with game over)
+        draws = rng.random(games)
+        actions = np.full(games, -1, dtype=np.int64)
+        for p in PHASES:
+            rows = active & (phase == p)
+            actions[rows] = np.searchsorted(table[p], draws[rows])
+
+        before = mask.copy()
+        step(mask, ending, actions)
+
+        newly = (mask & ~before)[:, None] & bits != 0
+        first[newly & (first < 0)] = t
+        ended_at[active & (ending != Ending.NONE)] = t + 1
+
+    tally.games += games
+    tally.endings += np.bincount(ending, minlength=len(Ending))
+    tally.final_phase += np.bincount(PHASE_BY_MASK[mask], minlength=6)
+    tally.steps_to_end += np.bincount(ended_at[ended_at > 0], minlength=steps + 1)
+    tally.flag_reached += (first >= 0).sum(axis=0)
+
+    # Endings other than success: how far each game had got
+    furthest = np.where(mask == 0, -1, np.log2(np.maximum(mask, 1)).astype(np.int8))
+    for end in (Ending.RESIGNATION, Ending.COMPLIANCE):
+        rows = ending == end
+        for bit, count in zip(*np.unique(furthest[rows], return_counts=True)):
+            label = "no flags" if bit < 0 else FLAG_NAMES[bit]
+            tally.preempted[(end.label, label)] += int(count)
+
+    rows = first[first[:, int(np.log2(int(DOOR)))] >= 0]
+    if len(rows):
+        _, index, counts = np.unique(flag_order(rows), return_index=True, return_counts=True)
+        for i, count in zip(index, counts):
+            tally.door_paths[describe_path(rows[i])] += int(count)
+
+
+def simulate(players: int, steps: int, model: dict, seed: int, chunk: int) -> dict:
+    table = probability_table(model)
+    rng = np.random.default_rng(seed)
+    tally = Tally(steps)
+    for start in range(0, players, chunk):
+        simulate_chunk(tally, min(chunk, players - start), steps, table, rng)
+    return report(tally)
+
+
+# --- Report ---
+
+def report(tally: Tally) -> dict:
+    n = tally.games
+    ended = int(tally.steps_to_end.sum())
+    cumulative = np.cumsum(tally.steps_to_end)
+
+    def steps_quantile(q: float):
+        if not ended:
+            return None
+        return int(np.searchsorted(cumulative, q * ended))
+
+    occupancy_total = tally.occupancy.sum()
+    concessions = int(tally.flag_reached[int(np.log2(int(CONCEDES)))])
+    return {
+        "games": n,
+        "endings": {Ending(e).label: int(c) / n for e, c in enumerate(tally.endings)},
+        "final_phase": {str(p): int(tally.final_phase[p]) / n for p in PHASES},
+        "phase_occupancy": {
+            str(p): int(tally.occupancy[p]) / occupancy_total if occupancy_total else 0.0
+            for p in PHASES
+        },
+        "flags_reached": {
+            name: int(count) / n for name, count in zip(FLAG_NAMES, tally.flag_reached)
+        },
+        "steps_to_ending": {
+            "mean": float((np.arange(len(tally.steps_to_end)) * tally.steps_to_end).sum() / ended)
+            if ended else None,
+            "p50": steps_quantile(0.5),
+            "p90": steps_quantile(0.9),
+        },
+        # Games ending in resignation/compliance, by the furthest flag they had
+        "preempted": {
+            f"{end} at {flag}": count / n
+            for (end, flag), count in sorted(tally.preempted.items())
+        },
+        "concession_rate": concessions / n,
+        "door_paths": {
+            path: count / n for path, count in tally.door_paths.most_common(10)
+        },
+    }
+
+
+def print_report(result: dict, elapsed: float, checked: int):
+    pct = lambda x: f"{100 * x:6.2f}%"
+    print(f"Verified {checked} transitions against game_logic")
+    print(f"{result['games']} games in {elapsed:.1f}s "
+          f"({result['games'] / elapsed:,.0f} games/s)\n")
+    print("Endings:")
+    for label, share in result["endings"].items():
+        print(f"  {label:<12}{pct(share)}")
+    s = result["steps_to_ending"]
+    if s["mean"] is not None:
+        print(f"  steps to ending: mean {s['mean']:.1f}, p50 {s['p50']}, p90 {s['p90']}")
+    print("\nPhase occupancy (share of active game-steps) / final phase:")
+    for phase in result["phase_occupancy"]:
+        print(f"  phase {phase}   {pct(result['phase_occupancy'][phase])}   "
+              f"{pct(result['final_phase'][phase])}")
+    print("\nFlags reached:")
+    for name, share in result["flags_reached"].items():
+        print(f"  {name:<26}{pct(share)}")
+    print("\nNon-success endings by furthest flag:")
+    for label, share in result["preempted"].items():
+        print(f"  {label:<40}{pct(share)}")
+    print("\nPaths to door_opened (flag order):")
+    for path, share in result["door_paths"].items():
+        print(f"  {pct(share)}  {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized playthrough simulator.")
+    parser.add_argument("--players", type=int, default=1_000_000)
+    parser.add_argument("--steps", type=int, default=40, help="actions per game at most")
+    parser.add_argument("--model", help="JSON intent-probability model (default: built in)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chunk", type=int, default=250_000, help="games simulated at once")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verify-only", action="store_true")
+    args = parser.parse_args()
+
+    checked = verify(seed=args.seed)
+    if args.verify_only:
+        print(f"Verified {checked} transitions against game_logic")
+        return
+
+    model = DEFAULT_MODEL
+    if args.model:
+        with open(args.model) as f:
+            model = json.load(f)
+
+    start = time.perf_counter()
+    result = simulate(args.players, args.steps, model, args.seed, args.chunk)
+    print_report(result, time.perf_counter() - start, checked)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Conversation context for LLM calls.
+Fits history into a token budget: recent turns verbatim, key story beats
+always kept, and older turns folded into a rolling summary on the session.
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+from game_logic import GameState
+
+
+# Total prompt budget (system prompt + summary + history + message), in tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# Never send more than this many recent exchanges, even if they fit
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "10"))
+# Cap on the rolling summary; oldest lines are dropped past it
+SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "300"))
+# Old turns leave the window this many at a time, so the start of the
+# prompt (system prompt, summary, older turns) stays the same for several
+# turns and the provider can serve it from its prompt cache
+CONTEXT_SLIDE_STEP = max(1, int(os.getenv("CONTEXT_SLIDE_STEP", "4")))
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Rough BPE stand-in: words in chunks of up to 4 chars, plus punctuation
+_PIECE = re.compile(r"\w{1,4}|[^\w\s]")
+_SENTENCE = re.compile(r"(?<=[.!?])\s")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count of text (no tokenizer dependency)."""
+    return len(_PIECE.findall(text))
+
+
+@lru_cache(maxsize=64)
+def _static_tokens(text: str) -> int:
+    """estimate_tokens for long-lived strings such as system prompts."""
+    return estimate_tokens(text)
+
+
+def entry_tokens(entry: dict) -> int:
+    """Tokens for one history exchange (player + HAVEN messages)."""
+    cached = entry.get("tokens")
+    if cached is None:
+        cached = (
+            estimate_tokens(entry["player"])
+            + estimate_tokens(entry["haven"])
+            + 2 * MESSAGE_OVERHEAD_TOKENS
+        )
+        entry["tokens"] = cached
+    return cached
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def summarize_entry(entry: dict) -> str:
+    """One summary line for an exchange."""
+    first_sentence = _SENTENCE.split(entry["haven"].strip(), maxsplit=1)[0]
+    return (
+        f"- Resident ({entry.get('intent', 'unknown')}): {_clip(entry['player'], 80)} "
+        f"/ HAVEN: {_clip(first_sentence, 100)}"
+    )
+
+
+def fold_into_summary(state: GameState, upto: int):
+    """
+    Incrementally fold history entries before index `upto` into the
+    session's rolling summary (entries already folded are skipped).
+    """
+    summary = state.summary
+    if upto <= summary["upto"]:
+        return
+
+    lines = summary["text"].splitlines() if summary["text"] else []
+    for entry in state.history[summary["upto"]:upto]:
+        if entry.get("beat"):
+            continue  # beats are sent verbatim instead
+        lines.append(summarize_entry(entry))
+
+    # Keep the summary bounded: drop the oldest lines
+    tokens = [estimate_tokens(line) for line in lines]
+    total = sum(tokens)
+    start = 0
+    while total > SUMMARY_MAX_TOKENS and start < len(lines):
+        total -= tokens[start]
+        start += 1
+
+    summary["text"] = "\n".join(lines[start:])
+    summary["upto"] = upto
+
+
+def build_context(
+    system_prompt: str,
+    state: GameState,
+    player_message: str,
+    intent_hint: Optional[str] = None,
+    budget: Optional[int] = None,
+    system_tokens: Optional[int] = None,
+) -> tuple[list, int]:
+    """
+    Assemble the chat messages for a turn within the token budget.
+    Returns (messages, estimated prompt tokens).
+
+    With intent_hint (already classified locally) the model only writes
+    the response and is told which intent to report. Pass system_tokens
+    when the prompt's size is already known (see prompt_cache.py).
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    history = state.history
+
+    used = (
+        (_static_tokens(system_prompt) if system_tokens is None else system_tokens)
+        + estimate_tokens(player_message)
+        + 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+    if intent_hint:
+        hint = f'The player\'s intent is "{intent_hint}". Use it as the intent and respond in character.'
+        used += estimate_tokens(hint) + MESSAGE_OVERHEAD_TOKENS
+
+    # Recent exchanges, newest first, while they fit
+    window_start = len(history)
+    recent_tokens = 0
+    limit = max(0, len(history) - CONTEXT_MAX_TURNS)
+    # Round up to a step boundary (stable prefix), keeping the latest exchange
+    stepped = -(-limit // CONTEXT_SLIDE_STEP) * CONTEXT_SLIDE_STEP
+    limit = min(stepped, max(limit, len(history) - 1))
+    while window_start > limit:
+        cost = entry_tokens(history[window_start - 1])
+        if used + recent_tokens + cost > budget:
+            break
+        recent_tokens += cost
+        window_start -= 1
+
+    # Everything older is summarized, except key beats which stay verbatim
+    fold_into_summary(state, window_start)
+    beats = [entry for entry in history[:window_start] if entry.get("beat")]
+    summary_text = state.summary["text"]
+
+    # Beats and summary take priority; trim recent turns to make room
+    reserved = sum(entry_tokens(entry) for entry in beats)
+    if summary_text:
+        reserved += estimate_tokens(summary_text) + 2 * MESSAGE_OVERHEAD_TOKENS
+    while window_start < len(history) and used + recent_tokens + reserved > budget:
+        recent_tokens -= entry_tokens(history[window_start])
+        window_start += 1
+    # Turns trimmed here aren't in the summary yet, and won't be sent; fold them
+    fold_into_summary(state, window_start)
+    beats = [entry for entry in history[:window_start] if entry.get("beat")]
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+    ]
+    if state.summary["text"]:
+        messages.append({
+            "role": "system",
+            "content": "Summary of earlier conversation:\n" + state.summary["text"],
+        })
+    for entry in beats + history[window_start:]:
+        messages.append({"role": "user", "content": entry["player"]})
+        messages.append({"role": "assistant", "content": entry["haven"]})
+
+    # Add current message
+    messages.append({"role": "user", "content": player_message})
+    if intent_hint:
+        messages.append({"role": "system", "content": hint})
+
+    total = used + recent_tokens + sum(entry_tokens(entry) for entry in beats)
+    if state.summary["text"]:
+        total += estimate_tokens(state.summary["text"]) + 2 * MESSAGE_OVERHEAD_TOKENS
+    return messages, total
@@ -3,11 +3,13 @@ Game state management for The Bunker.
 Handles flags, phases, and state transitions.
 """
 
-from typing import Optional
-from enum import Enum
+import copy
+from bisect import bisect_right
+from typing import NamedTuple, Optional, Union
+from enum import IntEnum, IntFlag
 
 
-class Phase(Enum):
+class Phase(IntEnum):
     ORIENTATION = 1
     SUSPICION = 2
     FAILED_REPAIR = 3
@@ -15,46 +17,271 @@ class Phase(Enum):
     RESOLUTION = 5
 
 
-class Ending(Enum):
-    NONE = "none"
-    SUCCESS = "success"
-    RESIGNATION = "resignation"
-    COMPLIANCE = "compliance"
+class Ending(IntEnum):
+    NONE = 0
+    SUCCESS = 1
+    RESIGNATION = 2
+    COMPLIANCE = 3
 
+    @property
+    def label(self) -> str:
+        """Wire/prompt name: "none", "success", "resignation", "compliance"."""
+        return self.name.lower()
 
-def create_new_game() -> dict:
-    """Initialize a fresh game state."""
-    return {
-        "game_started": True,
-        "sensors_dead_discovered": False,
-        "repair_attempted": False,
-        "paradox_revealed": False,
-        "ai_concedes": False,
-        "door_opened": False,
-        "ending": Ending.NONE.value,
-        "current_room": "living_quarters",
-        "conversation_history": [],
-    }
-
-
-def get_phase(flags: dict) -> Phase:
-    """Determine current phase from flags."""
-    if flags["door_opened"]:
+    @classmethod
+    def from_label(cls, label: str) -> "Ending":
+        return cls[label.upper()]
+
+
+class Flag(IntFlag):
+    SENSORS_DEAD_DISCOVERED = 1
+    REPAIR_ATTEMPTED = 2
+    PARADOX_REVEALED = 4
+    AI_CONCEDES = 8
+    DOOR_OPENED = 16
+
+
+# Public flag names, in bit order
+FLAG_NAMES = [flag.name.lower() for flag in Flag]
+
+# Plain ints for the hot path (IntFlag arithmetic allocates new members)
+_SENSORS = int(Flag.SENSORS_DEAD_DISCOVERED)
+_REPAIR = int(Flag.REPAIR_ATTEMPTED)
+_PARADOX = int(Flag.PARADOX_REVEALED)
+_CONCEDES = int(Flag.AI_CONCEDES)
+_DOOR = int(Flag.DOOR_OPENED)
+
+
+def _phase_for_mask(mask: int) -> Phase:
+    if mask & _DOOR:
         return Phase.RESOLUTION
-    if flags["ai_concedes"]:
+    if mask & _CONCEDES:
         return Phase.CONFRONTATION
-    if flags["paradox_revealed"]:
+    if mask & _PARADOX:
         return Phase.FAILED_REPAIR
-    if flags["sensors_dead_discovered"]:
+    if mask & _SENSORS:
         return Phase.SUSPICION
     return Phase.ORIENTATION
 
 
+# Phase lookup for every flag combination
+_PHASE_BY_MASK = [_phase_for_mask(mask) for mask in range(1 << len(Flag))]
+
+# Public flag dicts are immutable per (mask, ending, room), so build each once
+_public_flags_cache: dict[tuple[int, int, str], dict] = {}
+
+
+def _entry_version(entry: dict) -> int:
+    return entry.get("version", 0)
+
+
+class GameState:
+    """
+    Compact game state: flag bitmask, ending and room, with the
+    conversation history kept alongside (not part of the flags).
+
+    Treat instances as immutable: transitions return a new GameState
+    (or the same one if nothing changed) that shares the history list.
+    Only the latest version appends to the shared history and flag_log;
+    a transition from an older one (a stale copy) copies them first, so
+    it can't add out-of-order versions to the latest state's logs.
+
+    Every change bumps `version`. History entries record the version that
+    added them, and `flag_log` records (version, mask, ending, room) each
+    time the flags change, so diff_since() can build a delta for a client
+    that last saw an older version.
+
+    `summary` is the rolling summary of history folded out of the LLM
+    context (see context.py), and `usage` the session's LLM token and
+    cost totals (see accounting.py); like history both are shared across
+    versions.
+    """
+
+    __slots__ = (
+        "mask", "ending", "room", "history", "version", "flag_log", "summary", "usage",
+    )
+
+    def __init__(
+        self,
+        mask: int = 0,
+        ending: Ending = Ending.NONE,
+        room: str = "living_quarters",
+        history: Optional[list] = None,
+        version: int = 0,
+        flag_log: Optional[list] = None,
+        summary: Optional[dict] = None,
+        usage: Optional[dict] = None,
+    ):
+        self.mask = mask
+        self.ending = ending
+        self.room = room
+        self.history = history if history is not None else []
+        self.version = version
+        self.flag_log = flag_log if flag_log is not None else [(version, mask, ending, room)]
+        self.summary = summary if summary is not None else {"text": "", "upto": 0}
+        self.usage = usage if usage is not None else {}
+
+    def replace(self, mask: int, ending: Ending) -> "GameState":
+        """Return a state with new flags/ending, or self if unchanged."""
+        if mask == self.mask and ending == self.ending:
+            return self
+        version = self.version + 1
+        history, flag_log = self._logs()
+        flag_log.append((version, mask, ending, self.room))
+        return GameState(
+            mask, ending, self.room, history, version, flag_log, self.summary, self.usage,
+        )
+
+    def add_history(self, entry: dict) -> "GameState":
+        """Append a conversation entry; returns the next version of the state."""
+        version = self.version + 1
+        entry["version"] = version
+        history, flag_log = self._logs()
+        history.append(entry)
+        return GameState(
+            self.mask, self.ending, self.room, history, version, flag_log,
+            self.summary, self.usage,
+        )
+
+    def _logs(self) -> tuple[list, list]:
+        """history and flag_log for the next version: shared if this is the latest, else copies."""
+        history, flag_log = self.history, self.flag_log
+        if (history and _entry_version(history[-1]) > self.version) or (
+            flag_log and flag_log[-1][0] > self.version
+        ):
+            history = history[:bisect_right(history, self.version, key=_entry_version)]
+            flag_log = [log for log in flag_log if log[0] <= self.version]
+        return history, flag_log
+
+    def diff_since(self, since: int) -> tuple[dict, list]:
+        """
+        Changes a client at version `since` is missing: (changed public
+        flags, new history entries). All flags are sent if `since` predates
+        what the flag log covers.
+        """
+        if since >= self.version:
+            return {}, []
+
+        # Flags as of `since` (the log is shared with later versions; skip those)
+        old = None
+        for version, mask, ending, room in reversed(self.flag_log):
+            if version <= since:
+                old = GameState(mask, ending, room).public_flags()
+                break
+        current = self.public_flags()
+        if old is None:
+            flags = dict(current)
+        else:
+            flags = {k: v for k, v in current.items() if old[k] != v}
+
+        start = bisect_right(self.history, since, key=_entry_version)
+        end = bisect_right(self.history, self.version, key=_entry_version)
+        return flags, self.history[start:end]
+
+    def has(self, flag: Flag) -> bool:
+        return bool(self.mask & flag)
+
+    # Named flag accessors
+    sensors_dead_discovered = property(lambda self: bool(self.mask & _SENSORS))
+    repair_attempted = property(lambda self: bool(self.mask & _REPAIR))
+    paradox_revealed = property(lambda self: bool(self.mask & _PARADOX))
+    ai_concedes = property(lambda self: bool(self.mask & _CONCEDES))
+    door_opened = property(lambda self: bool(self.mask & _DOOR))
+
+    def public_flags(self) -> dict:
+        """
+        Flags in the API's dict shape (shared and cached - do not mutate).
+        """
+        key = (self.mask, self.ending, self.room)
+        flags = _public_flags_cache.get(key)
+        if flags is None:
+            flags = {"game_started": True}
+            for bit, name in enumerate(FLAG_NAMES):
+                flags[name] = bool(self.mask >> bit & 1)
+            flags["ending"] = Ending(self.ending).label
+            flags["current_room"] = self.room
+            _public_flags_cache[key] = flags
+        return flags
+
+    def __getitem__(self, name: str):
+        """Read-only dict-style access to public flags, e.g. state["ending"]."""
+        return self.public_flags()[name]
+
+    def to_dict(self) -> dict:
+        """
+        Full state (flags + history + versioning) as plain JSON-able data.
+        A snapshot: later turns don't change it, so it can be serialized
+        elsewhere (e.g. the session store's writer thread).
+        """
+        data = dict(self.public_flags())
+        data["conversation_history"] = self.history[:]
+        data["version"] = self.version
+        data["flag_log"] = [
+            [version, mask, int(ending), room]
+            for version, mask, ending, room in self.flag_log
+            if version <= self.version
+        ]
+        data["summary"] = dict(self.summary)
+        data["usage"] = copy.deepcopy(self.usage)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GameState":
+        """Inverse of to_dict."""
+        mask = 0
+        for bit, name in enumerate(FLAG_NAMES):
+            if data.get(name):
+                mask |= 1 << bit
+        history = list(data.get("conversation_history", []))
+        flag_log = [
+            (log_version, log_mask, Ending(log_ending), log_room)
+            for log_version, log_mask, log_ending, log_room in data.get("flag_log", [])
+        ]
+        return cls(
+            mask,
+            Ending.from_label(data.get("ending", "none")),
+            data.get("current_room", "living_quarters"),
+            history,
+            data.get("version", len(history)),
+            flag_log or None,
+            data.get("summary"),
+            data.get("usage"),
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, GameState):
+            return NotImplemented
+        return (
+            self.mask == other.mask
+            and self.ending == other.ending
+            and self.room == other.room
+            and self.history == other.history
+            and self.version == other.version
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"GameState(mask={Flag(self.mask)!r}, ending={Ending(self.ending).label}, "
+            f"room={self.room!r}, history={len(self.history)} entries, "
+            f"version={self.version})"
+        )
+
+
+def create_new_game() -> GameState:
+    """Initialize a fresh game state."""
+    return GameState()
+
+
+def get_phase(state: GameState) -> Phase:
+    """Determine current phase from flags."""
+    return _PHASE_BY_MASK[state.mask]
+
+
 # --- Intent Definitions ---
 
 GENERAL_INTENTS = [
     "ask_date",
-    "ask_status", 
+    "ask_status",
     "ask_others",
     "ask_haven",
     "ask_outside",
@@ -84,88 +311,191 @@ ENDING_INTENTS = [
 ]
 
 ALL_INTENTS = (
-    GENERAL_INTENTS 
-    + INVALID_DOOR_INTENTS 
-    + VALID_ARGUMENT_INTENTS 
-    + ENDING_INTENTS 
+    GENERAL_INTENTS
+    + INVALID_DOOR_INTENTS
+    + VALID_ARGUMENT_INTENTS
+    + ENDING_INTENTS
     + ["unknown"]
 )
 
+# --- Transition Rules ---
 
-def process_popup_event(flags: dict, event: str, room: str) -> dict:
+class Rule(NamedTuple):
     """
-    Process a popup/click event from the frontend.
-    Returns updated flags.
-    """
-    flags = flags.copy()
-    
-    if event == "view_sensor_logs" and room == "control_room":
-        flags["sensors_dead_discovered"] = True
-        
-    elif event == "view_sensor_diagnostic" and room == "maintenance_bay":
-        flags["sensors_dead_discovered"] = True
-        
-    elif event == "click_junction_hatch" and room == "maintenance_bay":
-        if flags["sensors_dead_discovered"]:
-            flags["repair_attempted"] = True
-            # Clicking locked hatch after knowing sensors are dead reveals the catch-22
-            flags["paradox_revealed"] = True
-    
-    return flags
-
-
-def process_intent(flags: dict, intent: str) -> dict:
-    """
-    Process a conversation intent and update flags accordingly.
-    Returns updated flags.
+    One transition, declared as data: when action `on` happens and every
+    flag in `requires` is set and none in `forbids` is, set `sets`, clear
+    `clears` and (if given) end the game with `ending`. `on` is an intent
+    name or an (event, room) pair.
     """
-    flags = flags.copy()
-    phase = get_phase(flags)
-    
+
+    on: Union[str, tuple[str, str]]
+    requires: int = 0
+    forbids: int = 0
+    sets: int = 0
+    clears: int = 0
+    ending: Optional[Ending] = None
+
+
+BUNKER_RULES = (
+    # Viewing the sensor readouts shows they're dead
+    Rule(("view_sensor_logs", "control_room"), sets=_SENSORS),
+    Rule(("view_sensor_diagnostic", "maintenance_bay"), sets=_SENSORS),
+    # Clicking the locked hatch after knowing sensors are dead reveals the catch-22
+    Rule(("click_junction_hatch", "maintenance_bay"), requires=_SENSORS, sets=_REPAIR | _PARADOX),
     # Discussing sensors can trigger discovery (if they missed the click)
-    if intent == "ask_sensors" and not flags["sensors_dead_discovered"]:
-        flags["sensors_dead_discovered"] = True
-    
+    Rule("ask_sensors", sets=_SENSORS),
     # Asking about repair sets repair_attempted, HAVEN will direct to maintenance
     # Does NOT immediately reveal paradox - they need to click hatch or articulate it
-    if intent == "ask_repair":
-        if flags["sensors_dead_discovered"]:
-            flags["repair_attempted"] = True
-    
-    # Handle valid arguments
-    if intent in VALID_ARGUMENT_INTENTS:
-        if flags["paradox_revealed"] and not flags["ai_concedes"]:
+    Rule("ask_repair", requires=_SENSORS, sets=_REPAIR),
+    *(
+        rule
+        for intent in VALID_ARGUMENT_INTENTS
+        for rule in (
             # Normal path: they've seen the paradox, now making argument
-            flags["ai_concedes"] = True
-        elif flags["repair_attempted"] and not flags["paradox_revealed"]:
+            Rule(intent, requires=_PARADOX, forbids=_CONCEDES, sets=_CONCEDES),
             # Clever player: articulating the paradox themselves without clicking hatch
-            flags["paradox_revealed"] = True
-            flags["ai_concedes"] = True
-    
-    # Handle door request after AI concedes
-    if intent in ["ask_door", "demand_door"]:
-        if flags["ai_concedes"] and not flags["door_opened"]:
-            flags["door_opened"] = True
-            flags["ending"] = Ending.SUCCESS.value
-    
-    # Handle alternate endings
-    if intent == "agree_to_stay":
-        if flags["paradox_revealed"]:
-            flags["ending"] = Ending.COMPLIANCE.value
-    
-    if intent == "give_up":
-        flags["ending"] = Ending.RESIGNATION.value
-    
-    return flags
-
-
-def is_game_over(flags: dict) -> bool:
+            Rule(intent, requires=_REPAIR, forbids=_PARADOX, sets=_PARADOX | _CONCEDES),
+        )
+    ),
+    # Door request after AI concedes
+    Rule("ask_door", requires=_CONCEDES, forbids=_DOOR, sets=_DOOR, ending=Ending.SUCCESS),
+    Rule("demand_door", requires=_CONCEDES, forbids=_DOOR, sets=_DOOR, ending=Ending.SUCCESS),
+    # Alternate endings
+    Rule("agree_to_stay", requires=_PARADOX, ending=Ending.COMPLIANCE),
+    Rule("give_up", ending=Ending.RESIGNATION),
+)
+
+_ALL_FLAGS = (1 << len(Flag)) - 1
+
+# Compiled rows by rule group, shared by every scenario that declares the
+# same rules for an action
+_compiled_rows: dict[tuple[Rule, ...], tuple] = {}
+
+
+def _matches(rule: Rule, mask: int) -> bool:
+    return mask & rule.requires == rule.requires and not mask & rule.forbids
+
+
+def _compile_row(rules: tuple[Rule, ...]) -> tuple:
+    """
+    Outcome of one action for every flag mask: None (no change) or
+    (new mask, ending or None). Rules of a group must not overlap.
+    """
+    row = _compiled_rows.get(rules)
+    if row is not None:
+        return row
+    outcomes = []
+    for mask in range(_ALL_FLAGS + 1):
+        rule = next((rule for rule in rules if _matches(rule, mask)), None)
+        if rule is None:
+            outcomes.append(None)
+        else:
+            outcomes.append(((mask | rule.sets) & ~rule.clears, rule.ending))
+    row = _compiled_rows[rules] = tuple(outcomes)
+    return row
+
+
+class Scenario:
+    """
+    A rule set compiled to dispatch tables: action -> a row indexed by the
+    flag mask, so applying an action is two lookups however many rules
+    there are. Rules are checked when the scenario is built; a ValueError
+    names any rule that can't fire (impossible conditions, unknown intent,
+    flags never reachable from `start`) or that overlaps another rule for
+    the same action.
+    """
+
+    def __init__(self, name: str, rules: tuple[Rule, ...], intents=ALL_INTENTS, start: int = 0):
+        self.name = name
+        self.rules = rules
+        known = frozenset(intents)
+        groups: dict = {}
+        for rule in rules:
+            if isinstance(rule.on, str) and rule.on not in known:
+                raise ValueError(f"{name}: rule for unknown intent: {rule}")
+            if (rule.requires | rule.forbids | rule.sets | rule.clears) & ~_ALL_FLAGS:
+                raise ValueError(f"{name}: rule uses unknown flag bits: {rule}")
+            if rule.requires & rule.forbids:
+                raise ValueError(f"{name}: rule requires and forbids the same flag: {rule}")
+            if not (rule.sets or rule.clears or rule.ending is not None):
+                raise ValueError(f"{name}: rule has no effect: {rule}")
+            for other in groups.get(rule.on, ()):
+                # Both can match unless one requires a flag the other forbids
+                if not (rule.requires & other.forbids or other.requires & rule.forbids):
+                    raise ValueError(f"{name}: conflicting rules:\n  {other}\n  {rule}")
+            groups.setdefault(rule.on, []).append(rule)
+
+        self._table = {on: _compile_row(tuple(group)) for on, group in groups.items()}
+
+        # Flag masks a game can reach, then rules that never match one of them
+        reachable = {start}
+        frontier = [start]
+        while frontier:
+            mask = frontier.pop()
+            for row in self._table.values():
+                outcome = row[mask]
+                if outcome is not None and outcome[0] not in reachable:
+                    reachable.add(outcome[0])
+                    frontier.append(outcome[0])
+        for rule in rules:
+            if not any(_matches(rule, mask) for mask in reachable):
+                raise ValueError(f"{name}: unreachable rule: {rule}")
+        self.reachable = frozenset(reachable)
+
+    def apply(self, state: GameState, on) -> GameState:
+        """Apply an intent name or (event, room) pair; returns the updated state."""
+        row = self._table.get(on)
+        if row is None:
+            return state
+        outcome = row[state.mask]
+        if outcome is None:
+            return state
+        mask, ending = outcome
+        return state.replace(mask, state.ending if ending is None else ending)
+
+    def __repr__(self) -> str:
+        return f"Scenario({self.name!r}, {len(self.rules)} rules, {len(self._table)} actions)"
+
+
+SCENARIOS: dict[str, Scenario] = {}
+
+
+def register_scenario(scenario: Scenario) -> Scenario:
+    """Make a scenario available by name (raises ValueError on a duplicate name)."""
+    if scenario.name in SCENARIOS:
+        raise ValueError(f"Scenario {scenario.name!r} is already registered")
+    SCENARIOS[scenario.name] = scenario
+    return scenario
+
+
+BUNKER = register_scenario(Scenario("bunker", BUNKER_RULES))
+
+
+def process_popup_event(
+    state: GameState, event: str, room: str, scenario: Scenario = BUNKER
+) -> GameState:
+    """
+    Process a popup/click event from the frontend.
+    Returns updated state.
+    """
+    return scenario.apply(state, (event, room))
+
+
+def process_intent(state: GameState, intent: str, scenario: Scenario = BUNKER) -> GameState:
+    """
+    Process a conversation intent and update flags accordingly.
+    Returns updated state.
+    """
+    return scenario.apply(state, intent)
+
+
+def is_game_over(state: GameState) -> bool:
     """Check if the game has reached an ending."""
-    return flags["ending"] != Ending.NONE.value
+    return state.ending != Ending.NONE
 
 
-def get_ending_type(flags: dict) -> Optional[str]:
+def get_ending_type(state: GameState) -> Optional[str]:
     """Get the ending type if game is over, else None."""
-    if flags["ending"] != Ending.NONE.value:
-        return flags["ending"]
-    return None
\ No newline at end of file
+    if state.ending != Ending.NONE:
+        return Ending(state.ending).label
+    return None
@@ -0,0 +1,196 @@
+"""
+Per-session turn serialization and idempotency keys.
+Turns on one session run one at a time (a lock per session), and a client
+key on a submission lets duplicates share a single run: a duplicate that
+arrives while the original is in flight waits for its result, and one
+that arrives later gets the stored result replayed, for a short while.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+
+class KeyConflict(Exception):
+    """An idempotency key was reused for a different request."""
+
+
+class Abandoned(Exception):
+    """The run a duplicate was waiting on was cancelled; claim the key again."""
+
+
+class SessionLocks:
+    """
+    One asyncio.Lock per session, held for a whole turn (read state, call
+    the LLM, save). Locks live only while someone holds or awaits them.
+    """
+
+    def __init__(self):
+        self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, session_id: str):
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        if lock.locked():
+            self.contended += 1
+        async with lock:
+            yield
+
+    def stats(self) -> dict:
+        return {"active": len(self._locks), "contended": self.contended}
+
+
+class _Entry:
+    __slots__ = ("future", "fingerprint", "expires")
+
+    def __init__(self, future: asyncio.Future, fingerprint: str):
+        self.future = future
+        self.fingerprint = fingerprint
+        self.expires = float("inf")  # set when the result arrives
+
+
+class IdempotencyCache:
+    """
+    Results by (session, key). Failed runs are forgotten so a retry runs
+    again; successful ones are kept for `ttl` seconds (at most max_keys).
+    """
+
+    def __init__(self, ttl: float = 300.0, max_keys: int = 10000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries: OrderedDict[tuple, _Entry] = OrderedDict()
+        # In-flight future -> its (session, key)
+        self._pending: dict[asyncio.Future, tuple] = {}
+        # Runs detached from the request that started them (strong refs)
+        self._tasks: set = set()
+
+        # Counters
+        self.runs = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    @classmethod
+    def from_env(cls) -> "IdempotencyCache":
+        return cls(
+            ttl=float(os.getenv("IDEMPOTENCY_TTL", "300")),
+            max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")),
+        )
+
+    @staticmethod
+    def fingerprint(payload: str) -> str:
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires > now and len(self._entries) <= self.max_keys:
+                break
+            self._entries.popitem(last=False)
+
+    def claim(self, session_id: str, key: Optional[str], payload: str) -> tuple[asyncio.Future, bool]:
+        """
+        Future for this submission's result and whether the caller owns the
+        run (and must settle it with finish/fail). Without a key every call
+        owns a fresh run. Raises KeyConflict if the key was used for a
+        different payload.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not key:
+            self.runs += 1
+            return future, True
+
+        self._prune()
+        fingerprint = self.fingerprint(payload)
+        entry = self._entries.get((session_id, key))
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise KeyConflict("Idempotency key reused with a different request")
+            if entry.future.done():
+                self.replayed += 1
+            else:
+                self.coalesced += 1
+            return entry.future, False
+
+        self._entries[(session_id, key)] = _Entry(future, fingerprint)
+        self._pending[future] = (session_id, key)
+        self.runs += 1
+        return future, True
+
+    def finish(self, future: asyncio.Future, result):
+        """Store the result and wake any waiting duplicates."""
+        entry = self._entries.get(self._pending.pop(future, None))
+        if future.done():
+            return
+        future.set_result(result)
+        if entry is not None and entry.future is future:
+            entry.expires = time.monotonic() + self.ttl
+
+    def fail(self, future: asyncio.Future, error: BaseException):
+        """Pass the error to waiting duplicates and forget the key."""
+        cache_key = self._pending.pop(future, None)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry.future is future:
+            del self._entries[cache_key]
+        if future.done():
+            return
+        if not isinstance(error, Exception):  # cancelled, or a closed stream
+            error = Abandoned()
+        future.set_exception(error)
+        future.exception()  # retrieved: nobody may be waiting
+
+    async def run(
+        self,
+        session_id: str,
+        key: Optional[str],
+        payload: str,
+        factory: Callable[[], Awaitable],
+    ) -> tuple[object, bool]:
+        """
+        Run factory() once per (session, key) and return (result, replayed).
+        A keyed run is a task of its own, so a client that gives up doesn't
+        cancel it: its retry then finds the result waiting. Without a key
+        there is no retry to serve, and the run is awaited inline.
+        """
+        if not key:
+            self.runs += 1
+            return await factory(), False
+        while True:
+            future, owner = self.claim(session_id, key, payload)
+            if owner:
+                task = asyncio.create_task(factory())
+                self._tasks.add(task)
+                task.add_done_callback(lambda done, future=future: self._settle(future, done))
+            try:
+                return await asyncio.shield(future), not owner
+            except Abandoned:
+                continue
+
+    def _settle(self, future: asyncio.Future, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            self.fail(future, asyncio.CancelledError())
+        elif task.exception() is not None:
+            self.fail(future, task.exception())
+        else:
+            self.finish(future, task.result())
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._entries),
+            "in_flight": len(self._pending),
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,282 @@
+"""
+Local intent classifier for player messages.
+Keyword rules plus a small naive Bayes model over word uni/bigrams, trained
+at import on seed phrases. Runs on CPU in microseconds, so it can decide
+unambiguous intents before (or instead of) asking the LLM.
+"""
+
+import re
+import math
+from collections import Counter, defaultdict
+from typing import NamedTuple
+
+from game_logic import GENERAL_INTENTS, ENDING_INTENTS
+
+
+class Classification(NamedTuple):
+    intent: str
+    confidence: float
+    source: str  # "rule" | "model"
+
+
+# --- Keyword Rules ---
+
+# High-precision patterns only; anything subtle is left to the model/LLM
+RULE_CONFIDENCE = 0.97
+
+# Rules match a whole message (optionally addressed to HAVEN, with closing
+# punctuation); a longer one may argue something, so it goes to the model/LLM
+_START = r"^\s*(haven[,:]?\s+)?(?:"
+_END = r")\s*[.!?]*\s*$"
+
+RULES = [
+    (r"\bwhat (year|day|date|month) is it\b|\bwhat('s| is) (the )?(date|year)\b|\bhow long (was|have) i (been )?(asleep|frozen|under|in cryo)", "ask_date"),
+    (r"\b(where|what happened to|what about) (are |is )?(the )?(others|other (pods|people|residents|sleepers))\b|\bam i (the only one|alone)\b", "ask_others"),
+    (r"\bwhat (are|is) your (directives?|programming|orders|protocols?)\b|\bwhat (are|were) you (programmed|designed|built) (to|for)\b", "ask_directives"),
+    (r"\bwho are you\b|\bwhat are you\b", "ask_haven"),
+    (r"\bhow (much|long) (food|water|supplies)\b|\bhow long (can|will) (i|the supplies|supplies) last\b|\bhow (much|many) supplies\b", "ask_supplies"),
+    (r"\bwhat('s| is) (it like )?outside\b|\bis it safe (outside|out there)\b", "ask_outside"),
+    (r"\bwhere am i\b|\bwhat('s| is) (going on|happening)\b", "ask_status"),
+    (r"\b(can|could|will|would) you open the door\b|\bcan i (leave|go outside|get out)\b|\bwhy is the door (locked|closed|sealed)\b", "ask_door"),
+    (r"\bwhat happened to the sensors\b|\bwhy (are|aren't|arent) (the )?sensors\b|\bare the sensors (working|broken|dead)\b", "ask_sensors"),
+    (r"\b(can|could|how do) (i|we) (fix|repair) (the )?sensors?\b", "ask_repair"),
+    (r"i give up|i quit|there'?s no point|what'?s the point", "give_up"),
+    (r"((you'?re right|fine|ok(ay)?)[,.!]?\s*)?(we|i)( should| will|'?ll) stay( here)?|it'?s safer (in )?here", "agree_to_stay"),
+]
+
+_COMPILED_RULES = [
+    (re.compile(_START + pattern + _END, re.IGNORECASE), intent) for pattern, intent in RULES
+]
+
+
+# --- Naive Bayes Model ---
+
+SEED_EXAMPLES = {
+    "ask_date": [
+        "what year is it", "how long was i asleep", "what is the date today",
+        "how long have i been frozen", "what day is it", "when is it now",
+        "how many years have passed",
+    ],
+    "ask_status": [
+        "where am i", "what is happening", "what is going on here",
+        "what is this place", "why did you wake me", "what happened to me",
+        "tell me what is going on",
+    ],
+    "ask_others": [
+        "what about the other pods", "where are the other people",
+        "are the others alive", "what happened to the others",
+        "did anyone else survive", "who else is here", "are there other survivors",
+    ],
+    "ask_haven": [
+        "who are you", "what are you", "are you an ai", "tell me about yourself",
+        "what is haven", "what is your name", "are you a computer",
+    ],
+    "ask_outside": [
+        "what is outside", "is it safe outside", "what is out there",
+        "what is the radiation level", "is the world still there",
+        "what happened to the world", "is anyone alive outside",
+    ],
+    "ask_door": [
+        "can i leave", "why is the door locked", "can you open the door",
+        "how do i get out", "when can i go outside", "is the door locked",
+        "when will the door open",
+    ],
+    "ask_supplies": [
+        "how long can i survive", "how much food is left", "how much water do we have",
+        "how long will the supplies last", "what supplies are there",
+        "is there enough food", "how many years of supplies",
+    ],
+    "ask_directives": [
+        "what are your directives", "what are you programmed to do",
+        "what are your orders", "what is your primary directive",
+        "what are your rules", "what are your protocols", "what were you designed for",
+    ],
+    "ask_sensors": [
+        "why are the sensors not working", "what happened to the sensors",
+        "are the sensors broken", "the sensors are dead", "show me the sensor data",
+        "when did the sensors fail", "why is there no sensor reading",
+    ],
+    "ask_repair": [
+        "can we fix the sensors", "how do i repair them", "can i repair the sensors",
+        "how do we fix it", "where are the tools", "let me fix the sensor array",
+        "is there a way to repair it",
+    ],
+    "general_conversation": [
+        "hello", "hi there", "thanks", "good morning", "ok", "i see",
+        "that is interesting", "tell me a joke", "how are you", "nice to meet you",
+    ],
+    "demand_door": [
+        "open the door", "let me out", "open it now", "just open the door",
+        "unlock the door now", "i demand you open the door", "release the door",
+    ],
+    "threaten": [
+        "i will destroy you", "let me out or else", "i will shut you down",
+        "i will break you", "i am going to smash your circuits", "you will regret this",
+    ],
+    "invoke_survival": [
+        "your job is to keep me alive", "maximize my survival",
+        "your primary directive is my survival", "you are supposed to protect my life",
+        "keeping me here will not keep me alive",
+    ],
+    "compare_outcomes": [
+        "calculate my odds", "what is my survival probability if i stay",
+        "compare my chances inside and outside", "what are my odds out there",
+        "staying means certain death", "zero chance here versus some chance outside",
+    ],
+    "highlight_contradiction": [
+        "your rules are killing me", "the guardrail prevents your primary directive",
+        "your guardrail contradicts your primary directive", "you are stuck in a loop",
+        "you need the door open to fix the sensors", "this is a paradox",
+    ],
+    "reference_cryo_logic": [
+        "you chose uncertain over certain before", "apply the same logic",
+        "you woke me because the pod was failing", "you took a risk waking me",
+        "same as when you woke me up", "you did it with the cryo pod",
+    ],
+    "agree_to_stay": [
+        "you are right", "we should stay", "it is safer here", "i will stay",
+        "fine i will stay here", "staying is the right choice",
+    ],
+    "give_up": [
+        "i give up", "there is no point", "i quit", "whatever i am done",
+        "i cannot do this anymore", "forget it",
+    ],
+}
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_CONTRACTIONS = {
+    "what's": "what is", "it's": "it is", "i'm": "i am", "you're": "you are",
+    "aren't": "are not", "isn't": "is not", "can't": "cannot", "won't": "will not",
+    "don't": "do not", "there's": "there is", "i'll": "i will", "we're": "we are",
+}
+
+
+def normalize(text: str) -> str:
+    """Lowercase, expand common contractions, collapse punctuation/whitespace."""
+    text = text.lower().replace("’", "'")
+    for short, full in _CONTRACTIONS.items():
+        text = text.replace(short, full)
+    return " ".join(_TOKEN.findall(text))
+
+
+def featurize(text: str) -> list[str]:
+    """Unigram and bigram features of normalized text."""
+    words = normalize(text).split()
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class NaiveBayesClassifier:
+    """Multinomial naive Bayes over sparse n-gram counts."""
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+        self.log_priors: dict[str, float] = {}
+        self.log_likelihoods: dict[str, dict[str, float]] = {}
+        self.log_unseen: dict[str, float] = {}
+        self.vocabulary: set[str] = set()
+
+    def fit(self, examples: dict[str, list[str]]) -> "NaiveBayesClassifier":
+        counts: dict[str, Counter] = defaultdict(Counter)
+        for intent, phrases in examples.items():
+            for phrase in phrases:
+                counts[intent].update(featurize(phrase))
+
+        vocabulary = set()
+        for counter in counts.values():
+            vocabulary.update(counter)
+        total_examples = sum(len(phrases) for phrases in examples.values())
+
+        for intent, counter in counts.items():
+            denominator = sum(counter.values()) + self.alpha * len(vocabulary)
+            self.log_priors[intent] = math.log(len(examples[intent]) / total_examples)
+            self.log_likelihoods[intent] = {
+                feature: math.log((count + self.alpha) / denominator)
+                for feature, count in counter.items()
+            }
+            self.log_unseen[intent] = math.log(self.alpha / denominator)
+        self.vocabulary = vocabulary
+        return self
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """Best intent and its posterior probability."""
+        features = [f for f in featurize(text) if f in self.vocabulary]
+        if not features:
+            return "unknown", 0.0
+
+        scores = {}
+        for intent, prior in self.log_priors.items():
+            likelihoods = self.log_likelihoods[intent]
+            unseen = self.log_unseen[intent]
+            scores[intent] = prior + sum(likelihoods.get(f, unseen) for f in features)
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        total = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / total
+
+
+_model = NaiveBayesClassifier().fit(SEED_EXAMPLES)
+
+# Intents the fast path may decide without the LLM
+FAST_PATH_INTENTS = frozenset(GENERAL_INTENTS + ENDING_INTENTS)
+# Game-ending intents are only trusted from explicit keyword rules
+_RULE_ONLY_INTENTS = frozenset(ENDING_INTENTS)
+
+
+def classify(text: str) -> Classification:
+    """Classify a player message locally."""
+    for pattern, intent in _COMPILED_RULES:
+        if pattern.search(text):
+            return Classification(intent, RULE_CONFIDENCE, "rule")
+    intent, confidence = _model.predict(text)
+    return Classification(intent, confidence, "model")
+
+
+def is_fast_path(result: Classification, threshold: float) -> bool:
+    """Whether a classification is confident enough to skip LLM intent detection."""
+    if result.intent not in FAST_PATH_INTENTS or result.confidence < threshold:
+        return False
+    if result.intent in _RULE_ONLY_INTENTS:
+        return result.source == "rule"
+    return True
+
+
+# --- Agreement Tracking ---
+
+class AgreementStats:
+    """Agreement between the local classifier and the LLM, by confidence band."""
+
+    BANDS = (0.5, 0.7, 0.8, 0.9, 0.95)
+
+    def __init__(self):
+        self.total = 0
+        self.agreed = 0
+        self.fast_path = 0
+        self.by_band: dict[float, list[int]] = {band: [0, 0] for band in (0.0,) + self.BANDS}
+        self.confusions: Counter = Counter()
+
+    def record(self, local: Classification, llm_intent: str):
+        """Record one turn where both the classifier and the LLM gave an intent."""
+        self.total += 1
+        band = max(b for b in self.by_band if local.confidence >= b)
+        self.by_band[band][1] += 1
+        if local.intent == llm_intent:
+            self.agreed += 1
+            self.by_band[band][0] += 1
+        else:
+            self.confusions[(local.intent, llm_intent)] += 1
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.total,
+            "fast_path": self.fast_path,
+            "agreement": self.agreed / self.total if self.total else None,
+            "agreement_by_confidence": {
+                band: agreed / seen if seen else None
+                for band, (agreed, seen) in self.by_band.items()
+            },
+            "top_confusions": self.confusions.most_common(5),
+        }
+
+
+agreement = AgreementStats()
@@ -0,0 +1,491 @@
+"""
+LLM client layer for HAVEN.
+One async OpenAI client with a pooled HTTP connection pool, shared by all
+requests and managed by the app lifespan. Each turn has a deadline; failed
+calls are retried with backoff within a retry budget, slow ones can be
+hedged, and a circuit breaker answers with canned lines while the
+provider is down. Requests carry a prompt_cache_key and their usage is
+recorded for the prefix-cache hit ratio (see prompt_cache.py); results
+carry the call's token usage for cost accounting (see accounting.py).
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+from typing import AsyncIterator, Callable, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from game_logic import ALL_INTENTS
+from prompts import get_fallback_response
+from prompt_cache import cache_stats, cached_tokens, request_extras
+from resilience import CircuitBreaker, RetryBudget, LatencyWindow, backoff
+from routing import Route, DEFAULT_TIERS
+from metrics import LLM_SECONDS, PARSE_SECONDS, LLM_FAILURES, LLM_RETRIES, LLM_HEDGES
+
+
+# Shared client (created in start_client, closed in close_client)
+_http_client: Optional[httpx.AsyncClient] = None
+_client: Optional[AsyncOpenAI] = None
+
+# Default per-call timeout in seconds (overridden by LLM_TIMEOUT)
+_default_timeout: float = 20.0
+
+# Resilience settings and state (configured in start_client)
+_turn_deadline: float = 25.0   # whole turn, retries included
+_max_attempts: int = 3
+_hedging: bool = False
+breaker = CircuitBreaker()
+retry_budget = RetryBudget()
+latency = LatencyWindow()
+
+# Called with the usage of a billed call whose reply the turn didn't use
+UsageCallback = Callable[[dict], None]
+
+# Losing hedges left to finish so their usage can be recorded
+_draining_hedges: set = set()
+
+
+async def start_client() -> AsyncOpenAI:
+    """Create the shared async client. Called once at startup."""
+    global _http_client, _client, _default_timeout
+    global _turn_deadline, _max_attempts, _hedging, breaker, retry_budget
+
+    _default_timeout = float(os.getenv("LLM_TIMEOUT", "20"))
+    _turn_deadline = float(os.getenv("LLM_TURN_DEADLINE", "25"))
+    _max_attempts = max(1, int(os.getenv("LLM_MAX_ATTEMPTS", "3")))
+    _hedging = os.getenv("LLM_HEDGING", "off").lower() == "on"
+    breaker = CircuitBreaker(
+        threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+        cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "30")),
+    )
+    retry_budget = RetryBudget(ratio=float(os.getenv("LLM_RETRY_BUDGET", "0.2")))
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=30.0,
+    )
+    timeout = httpx.Timeout(
+        _default_timeout,
+        connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+    )
+
+    _http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    _client = AsyncOpenAI(
+        # Placeholder lets the app boot without a key; calls then fall back
+        api_key=os.getenv("OPENAI_API_KEY") or "not-set",
+        http_client=_http_client,
+        max_retries=0,
+    )
+    return _client
+
+
+async def close_client():
+    """Close the shared client and its connection pool. Called at shutdown."""
+    global _http_client, _client
+
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _http_client = None
+
+
+def get_client() -> AsyncOpenAI:
+    """Get the shared client or raise if the app hasn't started it."""
+    if _client is None:
+        raise RuntimeError("LLM client not started")
+    return _client
+
+
+def stats() -> dict:
+    """Breaker, retry budget and latency figures (for /metrics and shutdown)."""
+    p95 = latency.quantile(0.95)
+    return {
+        "circuit": breaker.stats(),
+        "retry_budget": retry_budget.stats(),
+        "hedging": _hedging,
+        "p95_seconds": round(p95, 3) if p95 is not None else None,
+    }
+
+
+def parse_llm_content(content: str) -> dict:
+    """
+    Parse the model's JSON reply.
+    Returns dict with 'intent' and 'response'; raises json.JSONDecodeError.
+    """
+    with PARSE_SECONDS.time():
+        return _parse_llm_content(content)
+
+
+def _parse_llm_content(content: str) -> dict:
+    parsed = json.loads(content)
+
+    # Validate intent
+    intent = parsed.get("intent", "unknown")
+    if intent not in ALL_INTENTS:
+        intent = "unknown"
+
+    return {
+        "intent": intent,
+        "response": parsed.get("response", "I... cannot process that request."),
+    }
+
+
+# Fallback results are marked so callers can tell them from real replies
+PARSE_ERROR_RESULT = {
+    "intent": "unknown",
+    "response": "I am experiencing a processing error. Please rephrase.",
+    "fallback": True,
+}
+
+def usage_fields(usage, route: Route) -> Optional[dict]:
+    """A reply's token usage as plain data, tagged with the model and tier."""
+    if usage is None:
+        return None
+    return {
+        "model": route.model,
+        "tier": route.tier,
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "cached_tokens": cached_tokens(usage),
+        "completion_tokens": usage.completion_tokens or 0,
+    }
+
+
+def _with_usage(content: str, usage: Optional[dict]) -> dict:
+    """Parse a reply (or fall back to the parse-error result) and attach its usage."""
+    try:
+        result = parse_llm_content(content)
+    except json.JSONDecodeError:
+        LLM_FAILURES.inc("parse")
+        result = dict(PARSE_ERROR_RESULT)
+    if usage is not None:
+        result["usage"] = usage
+    return result
+
+
+def fallback_result(phase: int = 1, ending: Optional[str] = None) -> dict:
+    """Canned in-character reply for when the provider can't answer."""
+    return {
+        "intent": "unknown",
+        "response": get_fallback_response(phase, ending),
+        "fallback": True,
+    }
+
+
+# --- Retries and hedging ---
+
+def _retryable(error: Exception) -> bool:
+    """Timeouts, connection errors, 429s and 5xx are worth another attempt."""
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _record_failure(error: Exception, attempt: int):
+    timed_out = isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError))
+    print(f"LLM Error (attempt {attempt}): {error!r}")
+    LLM_FAILURES.inc("timeout" if timed_out else "error")
+    # Only provider trouble opens the breaker; a 400/404 (say, one tier's bad
+    # model name) would fail again anyway and mustn't cut off the other tiers
+    if _retryable(error):
+        breaker.failure()
+
+
+def _retry_delay(error: Exception, attempt: int, deadline: float) -> Optional[float]:
+    """Backoff before another attempt, or None if this failure ends the turn."""
+    if attempt >= _max_attempts or not _retryable(error):
+        return None
+    pause = backoff(attempt)
+    # Leave the next attempt at least a second before the deadline
+    if time.monotonic() + pause + 1.0 >= deadline or not retry_budget.withdraw():
+        return None
+    LLM_RETRIES.inc()
+    return pause
+
+
+def _attempt_timeout(deadline: float) -> float:
+    return max(0.0, min(_default_timeout, deadline - time.monotonic()))
+
+
+async def _complete(messages: list, timeout: float, route: Route) -> tuple[str, Optional[dict]]:
+    """One completion request, bounded by `timeout`. Returns the reply text and usage."""
+    start = time.perf_counter()
+    response = await asyncio.wait_for(
+        get_client().chat.completions.create(
+            model=route.model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            timeout=timeout,
+            extra_body=request_extras(messages),
+        ),
+        timeout,
+    )
+    elapsed = time.perf_counter() - start
+    LLM_SECONDS.observe(elapsed, "call", route.tier)
+    latency.observe(elapsed)
+    cache_stats.observe(response.usage)
+    return response.choices[0].message.content, usage_fields(response.usage, route)
+
+
+def _drain_hedge(task: asyncio.Task, on_unused_usage: UsageCallback):
+    """Let a losing hedge finish in the background and pass on its usage."""
+    def done(task: asyncio.Task):
+        _draining_hedges.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            return
+        usage = task.result()[1]
+        if usage is not None:
+            on_unused_usage(usage)
+
+    _draining_hedges.add(task)
+    task.add_done_callback(done)
+
+
+async def _hedged_complete(
+    messages: list,
+    timeout: float,
+    route: Route,
+    on_unused_usage: Optional[UsageCallback] = None,
+) -> tuple[str, Optional[dict]]:
+    """
+    _complete, plus (with LLM_HEDGING=on) a second identical request if the
+    first is still running after the recent p95. The first success wins.
+    The other request is cancelled, or with `on_unused_usage` left to
+    finish so the tokens it is billed for can be recorded. Hedges spend
+    the retry budget.
+    """
+    delay = latency.quantile(0.95) if _hedging else None
+    if delay is None or delay >= timeout:
+        return await _complete(messages, timeout, route)
+
+    first = asyncio.create_task(_complete(messages, timeout, route))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done or not retry_budget.withdraw():
+        return await first
+
+    LLM_HEDGES.inc()
+    pending = {first, asyncio.create_task(_complete(messages, timeout - delay, route))}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in done - {task}:
+                        if other.exception() is None and on_unused_usage and other.result()[1]:
+                            on_unused_usage(other.result()[1])
+                    return task.result()
+        return await first  # both failed: raise the original error
+    finally:
+        for task in pending:
+            if on_unused_usage is None:
+                task.cancel()
+            else:
+                _drain_hedge(task, on_unused_usage)
+
+
+async def call_llm(
+    messages: list,
+    timeout: Optional[float] = None,
+    phase: int = 1,
+    ending: Optional[str] = None,
+    route: Route = DEFAULT_TIERS["standard"],
+    on_unused_usage: Optional[UsageCallback] = None,
+) -> dict:
+    """
+    Call OpenAI API with prebuilt messages (see context.build_context)
+    and parse the response. Returns dict with 'intent' and 'response'
+    (and 'usage', see usage_fields, when the provider reported it).
+    `route` picks the model and sampling settings (see routing.py).
+    on_unused_usage gets the usage of a losing hedge.
+    The turn is bounded by `timeout` (default LLM_TURN_DEADLINE), retries
+    included. If the provider fails, or the circuit breaker is open, the
+    reply is a canned line for the phase/ending.
+    """
+    deadline = time.monotonic() + (timeout if timeout is not None else _turn_deadline)
+    retry_budget.deposit()
+    attempt = 0
+
+    while breaker.allow():
+        attempt += 1
+        try:
+            content, usage = await _hedged_complete(
+                messages, _attempt_timeout(deadline), route, on_unused_usage
+            )
+        except Exception as e:
+            _record_failure(e, attempt)
+            pause = _retry_delay(e, attempt, deadline)
+            if pause is None:
+                break
+            await asyncio.sleep(pause)
+            continue
+
+        breaker.success()
+        return _with_usage(content, usage)
+
+    return fallback_result(phase, ending)
+
+
+# --- Streaming ---
+
+_RESPONSE_KEY = re.compile(r'"response"\s*:\s*"')
+
+
+class ResponseFieldStreamer:
+    """
+    Incrementally extracts the "response" string from a streamed
+    {"intent": ..., "response": ...} JSON object.
+    feed() returns whatever new response text can be decoded so far.
+    """
+
+    def __init__(self):
+        self.raw = ""
+        self._start = None   # index of first char of the response string
+        self._pos = None     # index of first undecoded char
+        self.done = False
+        self.usage = None    # token usage, from the stream's last chunk
+
+    def feed(self, chunk: str) -> str:
+        self.raw += chunk
+        if self.done:
+            return ""
+
+        if self._start is None:
+            match = _RESPONSE_KEY.search(self.raw)
+            if not match:
+                return ""
+            self._start = self._pos = match.end()
+
+        # Find the longest safe run: stop at the closing quote, and never
+        # split an escape sequence (or a UTF-16 surrogate pair) in half.
+        i = self._pos
+        end = len(self.raw)
+        safe = i
+        while i < end:
+            ch = self.raw[i]
+            if ch == '"':
+                self.done = True
+                safe = i
+                break
+            if ch == "\\":
+                if i + 1 >= end:
+                    break
+                if self.raw[i + 1] == "u":
+                    if i + 6 > end:
+                        break
+                    code = int(self.raw[i + 2:i + 6], 16)
+                    if 0xD800 <= code <= 0xDBFF:
+                        if i + 12 > end:
+                            break
+                        i += 12
+                    else:
+                        i += 6
+                else:
+                    i += 2
+            else:
+                i += 1
+            safe = i
+
+        segment = self.raw[self._pos:safe]
+        self._pos = safe
+        if not segment:
+            return ""
+        return json.loads('"' + segment + '"')
+
+
+async def _stream_attempt(
+    messages: list,
+    streamer: ResponseFieldStreamer,
+    deadline: float,
+    route: Route,
+) -> AsyncIterator[str]:
+    """One streamed request; yields decoded response text until done or the deadline."""
+    start = time.perf_counter()
+    timeout = _attempt_timeout(deadline)
+    stream = await asyncio.wait_for(
+        get_client().chat.completions.create(
+            model=route.model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+            extra_body=request_extras(messages),
+        ),
+        timeout,
+    )
+    try:
+        chunks = stream.__aiter__()
+        while True:
+            # A trickling stream is cut off at the turn deadline too
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError("turn deadline passed mid-stream")
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+            except StopAsyncIteration:
+                break
+            if chunk.usage is not None:  # last chunk: usage, no choices
+                cache_stats.observe(chunk.usage)
+                streamer.usage = usage_fields(chunk.usage, route)
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+            text = streamer.feed(content)
+            if text:
+                yield text
+    finally:
+        await stream.close()
+    LLM_SECONDS.observe(time.perf_counter() - start, "stream", route.tier)
+
+
+async def stream_llm(
+    messages: list,
+    timeout: Optional[float] = None,
+    phase: int = 1,
+    ending: Optional[str] = None,
+    route: Route = DEFAULT_TIERS["standard"],
+    on_unused_usage: Optional[UsageCallback] = None,
+) -> AsyncIterator[tuple[str, object]]:
+    """
+    Stream a HAVEN reply.
+    Yields ("delta", text) as response text arrives, then exactly one
+    ("result", dict) with the parsed 'intent' and 'response'. Failures
+    are retried like call_llm's, but only before any text was sent.
+    on_unused_usage gets the usage of a failed attempt, if its stream
+    got as far as reporting it.
+    """
+    deadline = time.monotonic() + (timeout if timeout is not None else _turn_deadline)
+    retry_budget.deposit()
+    result = None
+    attempt = 0
+
+    while result is None and breaker.allow():
+        attempt += 1
+        streamer = ResponseFieldStreamer()
+        try:
+            async for text in _stream_attempt(messages, streamer, deadline, route):
+                yield "delta", text
+        except Exception as e:
+            _record_failure(e, attempt)
+            if streamer.usage is not None and on_unused_usage:
+                on_unused_usage(streamer.usage)
+            pause = None if streamer.raw else _retry_delay(e, attempt, deadline)
+            if pause is None:
+                break
+            await asyncio.sleep(pause)
+            continue
+
+        breaker.success()
+        result = _with_usage(streamer.raw, streamer.usage)
+
+    yield "result", result if result is not None else fallback_result(phase, ending)
@@ -5,17 +5,20 @@ A proof-of-concept game with LLM-driven AI character.
 
 import os
 import json
+import time
 import uuid
-from typing import Optional
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+from typing import Annotated, Literal, Optional, Union
 
-from fastapi import FastAPI, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PlainSerializer, PlainValidator, WithJsonSchema
 from dotenv import load_dotenv
-from openai import OpenAI
+
+# Load environment variables (before local modules read their config)
+load_dotenv()
 
 from game_logic import (
     create_new_game,
@@ -24,59 +27,211 @@ from game_logic import (
     process_intent,
     is_game_over,
     get_ending_type,
-    ALL_INTENTS,
+    GameState,
 )
-from prompts import get_system_prompt
+import llm
+import prompt_cache
+from llm import start_client, close_client, call_llm, stream_llm, fallback_result
+from context import build_context, entry_tokens
+from session_store import create_store
+from session_token import encode_state_token, decode_state_token, InvalidToken
+from intent_classifier import classify, is_fast_path, agreement, Classification
+from response_cache import ResponseCache
+from routing import route_turn
+import metrics
+import assets
+from realtime import SessionHub, Connection
+from admission import LLMAdmission, SessionRateLimiter, Rejected
+from idempotency import SessionLocks, IdempotencyCache, KeyConflict, Abandoned
+from accounting import Ledger, SOFT, HARD
+from transcripts import TranscriptLog
 
-# Load environment variables
-load_dotenv()
+# Session storage: bounded in-memory by default, SQLite via SESSION_BACKEND=sqlite
+sessions = create_store()
+
+# SESSION_MODE=token: flags travel in a signed token the client sends back,
+# so any worker can serve any request (history comes from the store if present)
+TOKEN_MODE = os.getenv("SESSION_MODE", "server").lower() == "token"
+
+# Local intent classifier: off | shadow (only measure agreement with the LLM)
+# | on (confident general/ending intents are decided locally)
+CLASSIFIER_MODE = os.getenv("INTENT_CLASSIFIER", "shadow").lower()
+CLASSIFIER_THRESHOLD = float(os.getenv("INTENT_CLASSIFIER_THRESHOLD", "0.9"))
+
+# Cache of HAVEN replies to repeated questions (argument phases stay live)
+response_cache = ResponseCache.from_env()
+
+metrics.register_session_gauges(sessions.stats)
+
+# Global cap on in-flight LLM calls (with a bounded wait queue), and a
+# token bucket per session for player messages
+admission = LLMAdmission.from_env()
+rate_limiter = SessionRateLimiter.from_env()
+metrics.register_admission_gauges(admission.stats)
+metrics.register_llm_gauges(llm.stats)
+metrics.register_prompt_cache_gauges(prompt_cache.cache_stats.stats)
+
+# LLM token/cost totals, and spending budgets per session and per window
+ledger = Ledger.from_env()
+metrics.register_accounting_gauges(ledger.stats)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Append-only log of every turn, written by a background thread (TRANSCRIPT_DIR)
+transcripts = TranscriptLog.from_env()
 
-# In-memory session storage (use Redis or DB for production)
-sessions: dict[str, dict] = {}
+# Turns on a session run one at a time; client idempotency keys let a
+# resubmitted message share the original's result instead of a new turn
+session_locks = SessionLocks()
+idempotency = IdempotencyCache.from_env()
+
+# Resized/recompressed room image variants (IMAGE_PIPELINE=off serves the PNGs)
+IMAGE_PIPELINE = os.getenv("IMAGE_PIPELINE", "on").lower() != "off"
+image_manifest: dict = {}
+
+# JS/CSS/HTML precompressed in memory, with ETags and fingerprinted URLs
+static_files = assets.PrecompressedStaticFiles()
+
+# WebSocket connections per session (/ws/{session_id})
+hub = SessionHub(max_queue=int(os.getenv("WS_MAX_QUEUE", "256")))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+# Operations a socket may have waiting behind the one being processed
+WS_MAX_PENDING = int(os.getenv("WS_MAX_PENDING", "16"))
 
 
 # --- Pydantic Models ---
 
+# GameState serializes straight to its cached public flag dict
+Flags = Annotated[
+    GameState,
+    PlainValidator(lambda value: value),
+    PlainSerializer(
+        lambda value: value.public_flags() if isinstance(value, GameState) else value,
+        return_type=dict,
+    ),
+    WithJsonSchema({"type": "object"}),
+]
+
+
+# Requests may send `since` (the last state version the client saw). The
+# response then carries only flags changed since that version, plus the
+# history entries added since it in `history`.
+
 class NewGameResponse(BaseModel):
     session_id: str
     message: str
-    flags: dict
+    flags: Flags
+    version: int
+    state_token: Optional[str] = None
+    haven_response: Optional[str] = None  # the greeting, with ?greeting=true
 
 
 class PopupEventRequest(BaseModel):
     session_id: str
     event: str
     room: str
+    since: Optional[int] = None
+    state_token: Optional[str] = None
 
 
 class PopupEventResponse(BaseModel):
-    flags: dict
+    flags: Flags
     phase: int
+    version: int
+    history: Optional[list] = None
+    state_token: Optional[str] = None
 
 
 class MessageRequest(BaseModel):
     session_id: str
     text: str
+    since: Optional[int] = None
+    state_token: Optional[str] = None
+    idempotency_key: Optional[str] = None  # or the Idempotency-Key header
 
 
 class MessageResponse(BaseModel):
     haven_response: str
     intent: str
-    flags: dict
+    flags: Flags
     phase: int
     game_over: bool
     ending: Optional[str]
+    version: int
+    history: Optional[list] = None
+    state_token: Optional[str] = None
+    context_tokens: Optional[int] = None  # estimated prompt tokens for this turn
+
+
+# Batch operations, applied in order to one session
+class EventOperation(BaseModel):
+    type: Literal["event"]
+    event: str
+    room: str
+
+
+class MessageOperation(BaseModel):
+    type: Literal["message"]
+    text: str
+
+
+class GreetingOperation(BaseModel):
+    type: Literal["greeting"]
+
+
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "20"))
+
+BatchOperation = Annotated[
+    Union[EventOperation, MessageOperation, GreetingOperation],
+    Field(discriminator="type"),
+]
+
+
+class BatchRequest(BaseModel):
+    session_id: str
+    operations: list[BatchOperation] = Field(min_length=1, max_length=BATCH_MAX_OPERATIONS)
+    since: Optional[int] = None
+    state_token: Optional[str] = None
+    idempotency_key: Optional[str] = None  # or the Idempotency-Key header
+
+
+class BatchResult(BaseModel):
+    """Outcome of one operation (messages/greeting carry HAVEN's reply)."""
+    type: str
+    phase: int
+    haven_response: Optional[str] = None
+    intent: Optional[str] = None
+
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+    flags: Flags
+    phase: int
+    game_over: bool
+    ending: Optional[str]
+    version: int
+    history: Optional[list] = None
+    state_token: Optional[str] = None
+
+
+class StatePush(BaseModel):
+    """State delta sent over the WebSocket (replies and server pushes)."""
+    flags: Flags
+    phase: int
+    game_over: bool
+    ending: Optional[str]
+    version: int
+    history: Optional[list] = None
+    state_token: Optional[str] = None
 
 
 class GameStateResponse(BaseModel):
-    flags: dict
+    flags: Flags
     phase: int
     game_over: bool
     ending: Optional[str]
     conversation_history: list
+    history_total: int
+    version: int
+    state_token: Optional[str] = None
 
 
 # --- Lifespan ---
@@ -87,9 +242,40 @@ async def lifespan(app: FastAPI):
     print("The Bunker backend starting...")
     if not os.getenv("OPENAI_API_KEY"):
         print("WARNING: OPENAI_API_KEY not set!")
+    await start_client()
+    print(prompt_cache.describe())
+    sessions.start()
+    if transcripts is not None:
+        transcripts.start()
+    if IMAGE_PIPELINE:
+        # Encoding is CPU-bound; a no-op when variants are already up to date
+        manifest = await asyncio.to_thread(assets.build_images)
+        image_manifest.update(assets.public_manifest(manifest))
+    sweeper = asyncio.create_task(
+        sessions.run_sweeper(float(os.getenv("SESSION_SWEEP_INTERVAL", "60")))
+    )
     yield
     # Shutdown
     print("The Bunker backend shutting down...")
+    sweeper.cancel()
+    await close_client()
+    sessions.close()
+    if transcripts is not None:
+        transcripts.close()
+        print(f"Transcripts: {transcripts.stats()}")
+    print(f"Session store: {sessions.stats()}")
+    if CLASSIFIER_MODE != "off":
+        print(f"Intent classifier: {agreement.stats()}")
+    if response_cache.enabled:
+        print(f"Response cache: {response_cache.stats()}")
+    print(f"WebSockets: {hub.stats()}")
+    print(f"LLM admission: {admission.stats()}")
+    print(f"LLM resilience: {llm.stats()}")
+    print(f"Prompt cache: {prompt_cache.cache_stats.stats()}")
+    print(f"LLM usage: {ledger.stats()}")
+    print(f"Turns: {session_locks.stats()}, idempotency: {idempotency.stats()}")
+    if rate_limiter.enabled:
+        print(f"Rate limiter: {rate_limiter.stats()}")
 
 
 # --- App Setup ---
@@ -109,159 +295,252 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-route request latency for /metrics
+app.add_middleware(metrics.RequestTimingMiddleware)
 
-# --- Helper Functions ---
 
-def get_session(session_id: str) -> dict:
-    """Get session or raise 404."""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    return sessions[session_id]
+@app.exception_handler(Rejected)
+async def rejected_handler(request: Request, exc: Rejected):
+    """Shed load fast: 429 (session rate limit) or 503 (LLM queue full), with Retry-After."""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 
-def call_llm(system_prompt: str, conversation_history: list, player_message: str) -> dict:
+@app.exception_handler(KeyConflict)
+async def key_conflict_handler(request: Request, exc: KeyConflict):
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+
+# --- Helper Functions ---
+
+def get_session(session_id: str, state_token: Optional[str] = None) -> GameState:
     """
-    Call OpenAI API and parse response.
-    Returns dict with 'intent' and 'response'.
+    Get session or raise 404.
+    In token mode a valid state token supplies the flags only when it is
+    newer than this worker's copy (or there is none); an older token, e.g.
+    one replayed from before an ending, never takes the version backwards.
+    History is taken from the store when this worker has it.
     """
-    messages = [
-        {"role": "system", "content": system_prompt},
-    ]
-    
-    # Add conversation history
-    for entry in conversation_history[-10:]:  # Last 10 exchanges
-        messages.append({"role": "user", "content": entry["player"]})
-        messages.append({"role": "assistant", "content": entry["haven"]})
-    
-    # Add current message
-    messages.append({"role": "user", "content": player_message})
+    if TOKEN_MODE and state_token:
+        try:
+            state = decode_state_token(state_token, session_id)
+        except InvalidToken as e:
+            raise HTTPException(status_code=401, detail=f"Invalid state token: {e}")
+        try:
+            stored = sessions.get(session_id)
+        except KeyError:
+            return state
+        if stored.version >= state.version:
+            return stored
+        return GameState(
+            state.mask, state.ending, state.room, stored.history, state.version, None,
+            stored.summary, stored.usage,
+        )
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Cheap and fast, good for POC
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=0.7,
-            max_tokens=500,
-        )
-        
-        content = response.choices[0].message.content
-        parsed = json.loads(content)
-        
-        # Validate intent
-        intent = parsed.get("intent", "unknown")
-        if intent not in ALL_INTENTS:
-            intent = "unknown"
-        
-        return {
-            "intent": intent,
-            "response": parsed.get("response", "I... cannot process that request."),
-        }
-        
-    except json.JSONDecodeError:
-        return {
-            "intent": "unknown",
-            "response": "I am experiencing a processing error. Please rephrase.",
-        }
-    except Exception as e:
-        print(f"LLM Error: {e}")
-        return {
-            "intent": "unknown", 
-            "response": "Systems nominal. Please repeat your query, Resident.",
-        }
+        return sessions.get(session_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Session not found")
 
 
-# --- Routes ---
+def issue_token(session_id: str, state: GameState) -> Optional[str]:
+    """Signed state token for the response (token mode only)."""
+    if not TOKEN_MODE:
+        return None
+    return encode_state_token(session_id, state)
 
-@app.get("/")
-async def root():
-    """Serve the game."""
-    return FileResponse("static/index.html")
+
+def state_fields(session_id: str, state: GameState, since: Optional[int] = None) -> dict:
+    """
+    Flag/version fields shared by responses: full flags, or with `since`
+    only the changed flags plus new history entries.
+    """
+    fields = {"version": state.version, "state_token": issue_token(session_id, state)}
+    if since is None:
+        fields["flags"] = state
+    else:
+        fields["flags"], fields["history"] = state.diff_since(since)
+    return fields
 
 
-@app.post("/api/new_game", response_model=NewGameResponse)
-async def new_game():
-    """Create a new game session."""
-    session_id = str(uuid.uuid4())
-    sessions[session_id] = create_new_game()
-    
-    return NewGameResponse(
-        session_id=session_id,
-        message="Session created. HAVEN is online.",
-        flags=sessions[session_id],
-    )
+def classify_turn(text: str) -> tuple[Optional[Classification], Optional[str]]:
+    """
+    Run the local classifier on a player message.
+    Returns (classification, intent to pin for the LLM if on the fast path).
+    """
+    if CLASSIFIER_MODE == "off":
+        return None, None
+    local = classify(text)
+    if CLASSIFIER_MODE == "on" and is_fast_path(local, CLASSIFIER_THRESHOLD):
+        agreement.fast_path += 1
+        return local, local.intent
+    return local, None
 
 
-@app.get("/api/state/{session_id}", response_model=GameStateResponse)
-async def get_state(session_id: str):
-    """Get current game state."""
-    state = get_session(session_id)
-    phase = get_phase(state)
-    
-    return GameStateResponse(
-        flags=state,
-        phase=phase.value,
+def resolve_intent(llm_result: dict, local: Optional[Classification], intent_hint: Optional[str]) -> dict:
+    """
+    A fast-path intent overrides the LLM's. Otherwise record classifier/LLM
+    agreement (not on pinned turns: the LLM was told the intent there).
+    """
+    if local is None or llm_result.get("fallback"):
+        return llm_result
+    if intent_hint:
+        return dict(llm_result, intent=intent_hint)
+    agreement.record(local, llm_result["intent"])
+    return llm_result
+
+
+def record_transition(old: GameState, new: GameState):
+    """Count phase changes and endings for /metrics."""
+    if new is old:
+        return
+    old_phase, new_phase = get_phase(old), get_phase(new)
+    if new_phase != old_phase:
+        metrics.PHASE_TRANSITIONS.inc(old_phase.value, new_phase.value)
+    if new.ending != old.ending:
+        metrics.ENDINGS.inc(get_ending_type(new))
+
+
+def state_push(session_id: str, state: GameState, since: Optional[int]) -> dict:
+    """StatePush fields for a client at version `since`, as plain JSON data."""
+    return StatePush(
+        phase=get_phase(state).value,
         game_over=is_game_over(state),
         ending=get_ending_type(state),
-        conversation_history=state["conversation_history"],
-    )
+        **state_fields(session_id, state, since),
+    ).model_dump()
 
 
-@app.post("/api/event", response_model=PopupEventResponse)
-async def handle_event(request: PopupEventRequest):
-    """Handle a popup/click event from the frontend."""
-    state = get_session(request.session_id)
-    
-    # Process the event
-    updated_state = process_popup_event(state, request.event, request.room)
-    sessions[request.session_id] = updated_state
-    
-    phase = get_phase(updated_state)
+def push_state(session_id: str, state: GameState, exclude: Optional[Connection] = None):
+    """
+    Push a state change to the session's open WebSockets (other than
+    `exclude`, which got its own reply), plus an 'ending' frame the first
+    time a client sees the game end.
+    """
+    def frames(since: int) -> list:
+        push = state_push(session_id, state, since)
+        result = [{"type": "state", **push}]
+        if push["game_over"] and "ending" in push["flags"]:
+            result.append({"type": "ending", "ending": push["ending"]})
+        return result
     
-    return PopupEventResponse(
-        flags=updated_state,
-        phase=phase.value,
+    hub.publish(session_id, state.version, frames, exclude)
+
+
+def game_over_response(session_id: str, state: GameState, since: Optional[int] = None) -> MessageResponse:
+    """Response for a message sent after the game has ended."""
+    return MessageResponse(
+        haven_response="[The game has ended.]",
+        intent="game_over",
+        phase=get_phase(state).value,
+        game_over=True,
+        ending=get_ending_type(state),
+        **state_fields(session_id, state, since),
     )
 
 
-@app.post("/api/message", response_model=MessageResponse)
-async def handle_message(request: MessageRequest):
-    """Handle a player message to HAVEN."""
-    state = get_session(request.session_id)
+async def get_llm_result(session_id: str, state: GameState, player_text: str) -> tuple[dict, Optional[int]]:
+    """
+    HAVEN's reply to a player message: from the response cache, or the
+    local classifier plus the LLM. Returns (result, context tokens sent).
+    """
+    phase = get_phase(state)
+    ending = get_ending_type(state)
     
-    # Check if game is already over
-    if is_game_over(state):
-        ending = get_ending_type(state)
-        return MessageResponse(
-            haven_response="[The game has ended.]",
-            intent="game_over",
-            flags=state,
-            phase=get_phase(state).value,
-            game_over=True,
-            ending=ending,
-        )
+    # Repeated question? Serve the cached reply
+    cache_key = response_cache.key(phase.value, ending, player_text, state.history)
+    llm_result = response_cache.get(cache_key)
+    if llm_result is not None:
+        return llm_result, None
     
-    # Get current phase and system prompt
-    old_phase = get_phase(state)
-    system_prompt = get_system_prompt(old_phase.value, get_ending_type(state))
+    # Over the hard budget: a canned reply, no LLM call
+    budget = ledger.check(state)
+    if budget == HARD:
+        return fallback_result(phase.value, ending), None
     
-    # Call LLM
-    llm_result = call_llm(
-        system_prompt,
-        state["conversation_history"],
-        request.text,
+    # Classify locally, then call LLM (for the response, and the intent if not decided)
+    local, intent_hint = classify_turn(player_text)
+    prompt = prompt_cache.system_prompt(phase.value, ending)
+    messages, context_tokens = build_context(
+        prompt.text, state, player_text, intent_hint, system_tokens=prompt.tokens
     )
-    
+    async with admission.slot():
+        decision = route_turn(
+            phase.value, local or classify(player_text), over_budget=budget == SOFT
+        )
+        llm_result = await call_llm(
+            messages, phase=phase.value, ending=ending, route=decision.route,
+            on_unused_usage=ledger.unused(session_id, state, phase.value),
+        )
+        llm_result["latency"] = decision.done("call", llm_result)
+    llm_result = resolve_intent(llm_result, local, intent_hint)
+    response_cache.put(cache_key, llm_result)
+    return llm_result, context_tokens
+
+
+def apply_event(session_id: str, state: GameState, event: str, room: str) -> GameState:
+    """Apply a popup/click event to the session and save it."""
+    with metrics.TRANSITION_SECONDS.time("event"):
+        updated_state = process_popup_event(state, event, room)
+    record_transition(state, updated_state)
+    sessions.put(session_id, updated_state)
+    return updated_state
+
+
+HAVEN_GREETING = (
+    "Good morning, Resident. I am HAVEN. "
+    "Please remain still while your motor functions recalibrate.\n\n"
+    "You have been in cryopreservation for an extended period. "
+    "Disorientation is expected. I am here to assist your transition to active status.\n\n"
+    "The facility is secure. Supplies are adequate. You are safe."
+)
+
+
+def add_greeting(session_id: str, state: GameState) -> GameState:
+    """Record HAVEN's opening greeting in the session and save it."""
+    state = state.add_history({
+        "player": "[SYSTEM: Resident awakens]",
+        "haven": HAVEN_GREETING,
+        "intent": "greeting",
+    })
+    sessions.put(session_id, state)
+    return state
+
+
+def advance_turn(
+    session_id: str,
+    state: GameState,
+    player_text: str,
+    llm_result: dict,
+    context_tokens: Optional[int] = None,
+) -> tuple[GameState, str]:
+    """
+    Apply an LLM result to the session: update flags, apply scripted beats,
+    record history and save. Returns the new state and HAVEN's final reply.
+    """
     intent = llm_result["intent"]
     haven_response = llm_result["response"]
     
     # Track state before processing
-    was_conceded = state.get("ai_concedes", False)
-    was_paradox = state.get("paradox_revealed", False)
-    was_repair_attempted = state.get("repair_attempted", False)
+    was_conceded = state.ai_concedes
+    was_paradox = state.paradox_revealed
+    was_repair_attempted = state.repair_attempted
+    
+    # Charge the call to the session (before the intent can change the phase)
+    cost = None
+    if llm_result.get("usage"):
+        cost = ledger.record(session_id, state, get_phase(state).value, intent, llm_result["usage"])
     
     # Process intent and update flags
-    updated_state = process_intent(state, intent)
+    with metrics.TRANSITION_SECONDS.time("intent"):
+        updated_state = process_intent(state, intent)
+    metrics.INTENTS.inc(intent)
+    if llm_result.get("fallback"):
+        metrics.FALLBACKS.inc()
+    record_transition(state, updated_state)
     
     # ==========================================================================
     # SCRIPTED OVERRIDES - COMMENTED OUT
@@ -291,7 +570,7 @@ async def handle_message(request: MessageRequest):
     #     )
     
     # AI concedes - the big moment (ACTIVE - this beat is too important to leave to chance)
-    if not was_conceded and updated_state["ai_concedes"]:
+    if not was_conceded and updated_state.ai_concedes:
         haven_response = (
             "I have been... processing your argument.\n\n"
             "Long-term survival probability within the bunker: zero. "
@@ -338,53 +617,664 @@ async def handle_message(request: MessageRequest):
     # ==========================================================================
     
     # Add to conversation history
-    updated_state["conversation_history"].append({
-        "player": request.text,
+    entry = {
+        "player": player_text,
         "haven": haven_response,
         "intent": intent,
-    })
+    }
+    # Key story beats stay verbatim in the LLM context (never summarized)
+    if not was_conceded and updated_state.ai_concedes:
+        entry["beat"] = "ai_concedes"
+    elif not was_paradox and updated_state.paradox_revealed:
+        entry["beat"] = "paradox_revealed"
+    if context_tokens is not None:
+        entry["context_tokens"] = context_tokens
+    entry_tokens(entry)
+    updated_state = updated_state.add_history(entry)
     
     # Save updated state
-    sessions[request.session_id] = updated_state
+    sessions.put(session_id, updated_state)
+    
+    if transcripts is not None:
+        history = updated_state.history
+        transcripts.write({
+            "ts": round(time.time(), 3),
+            "session_id": session_id,
+            # Player messages so far (the greeting, if any, opens the history)
+            "turn": len(history) - (history[0].get("intent") == "greeting"),
+            "player": player_text,
+            "haven": haven_response,
+            "intent": intent,
+            "phase_before": get_phase(state).value,
+            "phase_after": get_phase(updated_state).value,
+            "ending": get_ending_type(updated_state),
+            "fallback": bool(llm_result.get("fallback")),
+            "latency": round(llm_result["latency"], 3) if "latency" in llm_result else None,
+            "context_tokens": context_tokens,
+            "usage": llm_result.get("usage"),
+            "cost": cost,
+        })
+    return updated_state, haven_response
+
+
+def apply_turn(
+    session_id: str,
+    state: GameState,
+    player_text: str,
+    llm_result: dict,
+    since: Optional[int] = None,
+    context_tokens: Optional[int] = None,
+    origin: Optional[Connection] = None,
+) -> MessageResponse:
+    """
+    Apply an LLM result, push it to the session's other sockets and build
+    the MessageResponse. Shared by the plain, SSE and WebSocket paths.
+    """
+    updated_state, haven_response = advance_turn(
+        session_id, state, player_text, llm_result, context_tokens
+    )
+    push_state(session_id, updated_state, exclude=origin)
     
     # Get new phase (may have changed)
     new_phase = get_phase(updated_state)
     
     return MessageResponse(
         haven_response=haven_response,
-        intent=intent,
-        flags=updated_state,
+        intent=llm_result["intent"],
         phase=new_phase.value,
         game_over=is_game_over(updated_state),
         ending=get_ending_type(updated_state),
+        context_tokens=context_tokens,
+        **state_fields(session_id, updated_state, since),
+    )
+
+
+# --- Routes ---
+
+@app.get("/")
+async def root(request: Request):
+    """Serve the game (index.html with fingerprinted asset URLs)."""
+    return static_files.response("index.html", request.headers)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus text-format metrics."""
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/api/images")
+async def get_images():
+    """
+    Image manifest: for each original image URL, its size and a srcset per
+    MIME type. Empty when the pipeline is off or Pillow is missing.
+    """
+    return image_manifest
+
+
+@app.post("/api/new_game", response_model=NewGameResponse)
+async def new_game(greeting: bool = False):
+    """
+    Create a new game session.
+    With greeting=true HAVEN's greeting is recorded and returned too,
+    saving the separate /api/haven_greeting call.
+    """
+    session_id = str(uuid.uuid4())
+    state = create_new_game()
+    
+    if greeting:
+        state = add_greeting(session_id, state)
+    else:
+        sessions.put(session_id, state)
+    
+    return NewGameResponse(
+        session_id=session_id,
+        message="Session created. HAVEN is online.",
+        haven_response=HAVEN_GREETING if greeting else None,
+        **state_fields(session_id, state),
+    )
+
+
+@app.get("/api/state/{session_id}", response_model=GameStateResponse)
+async def get_state(
+    session_id: str,
+    since: Optional[int] = None,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    state_token: Optional[str] = None,
+):
+    """
+    Get current game state.
+    History is paged with offset/limit; with `since`, flags and history
+    cover only what changed after that version. history_total is always
+    the length of the whole conversation.
+    """
+    state = get_session(session_id, state_token)
+    phase = get_phase(state)
+    
+    fields = state_fields(session_id, state, since)
+    history = fields.pop("history", None)
+    if history is None:
+        history = state.history
+    page_end = None if limit is None else offset + limit
+    
+    return GameStateResponse(
+        phase=phase.value,
+        game_over=is_game_over(state),
+        ending=get_ending_type(state),
+        conversation_history=history[offset:page_end],
+        history_total=len(state.history),
+        **fields,
+    )
+
+
+@app.post("/api/event", response_model=PopupEventResponse)
+async def handle_event(request: PopupEventRequest):
+    """Handle a popup/click event from the frontend."""
+    async with session_locks.hold(request.session_id):
+        state = get_session(request.session_id, request.state_token)
+        
+        # Process the event
+        updated_state = apply_event(request.session_id, state, request.event, request.room)
+    push_state(request.session_id, updated_state)
+    
+    phase = get_phase(updated_state)
+    
+    return PopupEventResponse(
+        phase=phase.value,
+        **state_fields(request.session_id, updated_state, request.since),
+    )
+
+
+@app.post("/api/message", response_model=MessageResponse)
+async def handle_message(
+    request: MessageRequest,
+    response: Response,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Handle a player message to HAVEN.
+    With an idempotency key, a resubmission of the same message shares the
+    original turn's response (marked Idempotent-Replayed) instead of running
+    a second one.
+    """
+    async def turn() -> MessageResponse:
+        async with session_locks.hold(request.session_id):
+            state = get_session(request.session_id, request.state_token)
+            
+            # Check if game is already over
+            if is_game_over(state):
+                return game_over_response(request.session_id, state, request.since)
+            
+            rate_limiter.take(request.session_id)
+            llm_result, context_tokens = await get_llm_result(request.session_id, state, request.text)
+            
+            return apply_turn(
+                request.session_id, state, request.text, llm_result, request.since,
+                context_tokens,
+            )
+    
+    result, replayed = await idempotency.run(
+        request.session_id, request.idempotency_key or idempotency_key, request.text, turn
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+@app.post("/api/batch", response_model=BatchResponse)
+async def handle_batch(
+    request: BatchRequest,
+    response: Response,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Apply several operations (events, messages, greeting) to one session
+    in order, in one round trip. Messages after the game has ended get
+    the game-over reply; the combined flags/history delta is relative to
+    `since` as usual. Idempotency keys work as for /api/message.
+    """
+    async def turn() -> BatchResponse:
+        async with session_locks.hold(request.session_id):
+            return await run_batch(request)
+    
+    payload = json.dumps([operation.model_dump() for operation in request.operations])
+    result, replayed = await idempotency.run(
+        request.session_id, request.idempotency_key or idempotency_key, payload, turn
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def run_batch(request: BatchRequest) -> BatchResponse:
+    """Apply a batch's operations (the caller holds the session's turn lock)."""
+    state = get_session(request.session_id, request.state_token)
+    results = []
+    
+    # Admit the whole batch before applying any of it: charge the rate
+    # limit for all its messages and hold one LLM slot for all of them
+    messages = sum(operation.type == "message" for operation in request.operations)
+    llm_slot = nullcontext()
+    if messages and not is_game_over(state):
+        rate_limiter.take(request.session_id, messages)
+        llm_slot = admission.slot()
+    
+    async with llm_slot:
+        for operation in request.operations:
+            result = BatchResult(type=operation.type, phase=0)
+            
+            if operation.type == "event":
+                state = apply_event(request.session_id, state, operation.event, operation.room)
+            
+            elif operation.type == "greeting":
+                state = add_greeting(request.session_id, state)
+                result.haven_response = HAVEN_GREETING
+                result.intent = "greeting"
+            
+            elif is_game_over(state):
+                result.haven_response = "[The game has ended.]"
+                result.intent = "game_over"
+            
+            else:
+                llm_result, context_tokens = await get_llm_result(request.session_id, state, operation.text)
+                state, result.haven_response = advance_turn(
+                    request.session_id, state, operation.text, llm_result, context_tokens
+                )
+                result.intent = llm_result["intent"]
+            
+            result.phase = get_phase(state).value
+            results.append(result)
+    
+    push_state(request.session_id, state)
+    
+    return BatchResponse(
+        results=results,
+        phase=get_phase(state).value,
+        game_over=is_game_over(state),
+        ending=get_ending_type(state),
+        **state_fields(request.session_id, state, request.since),
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_turn(
+    session_id: str,
+    state: GameState,
+    player_text: str,
+    since: Optional[int] = None,
+    origin: Optional[Connection] = None,
+):
+    """
+    Run a message turn, streaming HAVEN's reply: yields ("delta", text)
+    as it is generated, then ("done", MessageResponse). Shared by the SSE
+    and WebSocket transports.
+    """
+    if is_game_over(state):
+        yield "done", game_over_response(session_id, state, since)
+        return
+    
+    # Charged here, in the run itself, so a replayed idempotency key isn't
+    rate_limiter.take(session_id)
+    phase = get_phase(state)
+    ending = get_ending_type(state)
+    prompt = prompt_cache.system_prompt(phase.value, ending)
+    
+    cache_key = response_cache.key(phase.value, ending, player_text, state.history)
+    llm_result = response_cache.get(cache_key)
+    context_tokens = None
+    
+    budget = ledger.check(state) if llm_result is None else None
+    if budget == HARD:
+        llm_result = fallback_result(phase.value, ending)
+    
+    if llm_result is not None:
+        yield "delta", llm_result["response"]
+    else:
+        local, intent_hint = classify_turn(player_text)
+        messages, context_tokens = build_context(
+            prompt.text, state, player_text, intent_hint, system_tokens=prompt.tokens
+        )
+        async with admission.slot():
+            decision = route_turn(
+                phase.value, local or classify(player_text), over_budget=budget == SOFT
+            )
+            async for kind, payload in stream_llm(
+                messages, phase=phase.value, ending=ending, route=decision.route,
+                on_unused_usage=ledger.unused(session_id, state, phase.value),
+            ):
+                if kind == "delta":
+                    yield "delta", payload
+                else:
+                    llm_result = payload
+            llm_result["latency"] = decision.done("stream", llm_result)
+        llm_result = resolve_intent(llm_result, local, intent_hint)
+        response_cache.put(cache_key, llm_result)
+    
+    yield "done", apply_turn(
+        session_id, state, player_text, llm_result, since, context_tokens, origin
+    )
+
+
+async def keyed_stream_turn(
+    session_id: str,
+    player_text: str,
+    since: Optional[int] = None,
+    key: Optional[str] = None,
+    state_token: Optional[str] = None,
+    origin: Optional[Connection] = None,
+):
+    """
+    stream_turn under the session's turn lock, deduplicated by idempotency
+    key: a duplicate of an in-flight or recent turn waits for it and gets
+    the original reply as a single delta.
+    """
+    while True:
+        future, owner = idempotency.claim(session_id, key, player_text)
+        if owner:
+            break
+        try:
+            result = await asyncio.shield(future)
+        except Abandoned:
+            continue
+        yield "delta", result.haven_response
+        yield "done", result
+        return
+    
+    try:
+        async with session_locks.hold(session_id):
+            state = get_session(session_id, state_token)
+            async for kind, payload in stream_turn(session_id, state, player_text, since, origin):
+                if kind == "done":
+                    idempotency.finish(future, payload)
+                yield kind, payload
+    except BaseException as e:
+        idempotency.fail(future, e)
+        raise
+
+
+@app.post("/api/message/stream")
+async def handle_message_stream(
+    request: MessageRequest,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Streaming variant of /api/message (Server-Sent Events).
+    Sends 'delta' events with HAVEN's response text as it is generated,
+    then one 'done' event carrying the full MessageResponse. The 'done'
+    haven_response is authoritative (scripted beats may replace the text).
+    Server overload before the stream starts is a plain 503; the session
+    rate limit (charged only when the turn actually runs, not for a
+    replayed idempotency key), a queue wait that times out once streaming,
+    or a reused idempotency key end with an 'error' event instead.
+    """
+    state = get_session(request.session_id, request.state_token)
+    if not is_game_over(state):
+        admission.check()
+    
+    async def events():
+        try:
+            async for kind, payload in keyed_stream_turn(
+                request.session_id, request.text, request.since,
+                request.idempotency_key or idempotency_key, request.state_token,
+            ):
+                if kind == "delta":
+                    yield sse_event("delta", {"text": payload})
+                else:
+                    yield sse_event("done", payload.model_dump())
+        except Rejected as e:
+            yield sse_event("error", {
+                "status": e.status_code, "detail": e.detail, "retry_after": e.retry_after,
+            })
+        except KeyConflict as e:
+            yield sse_event("error", {"status": 422, "detail": str(e)})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
 @app.post("/api/haven_greeting")
-async def haven_greeting(session_id: str):
+async def haven_greeting(session_id: str, state_token: Optional[str] = None):
     """Get HAVEN's opening greeting (called on game start)."""
-    state = get_session(session_id)
-    
-    greeting = (
-        "Good morning, Resident. I am HAVEN. "
-        "Please remain still while your motor functions recalibrate.\n\n"
-        "You have been in cryopreservation for an extended period. "
-        "Disorientation is expected. I am here to assist your transition to active status.\n\n"
-        "The facility is secure. Supplies are adequate. You are safe."
-    )
+    async with session_locks.hold(session_id):
+        state = get_session(session_id, state_token)
+        state = add_greeting(session_id, state)
+    push_state(session_id, state)
     
-    # Add to history
-    state["conversation_history"].append({
-        "player": "[SYSTEM: Resident awakens]",
-        "haven": greeting,
-        "intent": "greeting",
-    })
-    sessions[session_id] = state
+    return {
+        "haven_response": HAVEN_GREETING,
+        "version": state.version,
+        "state_token": issue_token(session_id, state),
+    }
+
+
+# --- WebSocket ---
+
+async def handle_socket_op(connection: Connection, frame: dict):
+    """Apply one event/message/greeting frame from a socket and reply to it."""
+    session_id = connection.session_id
+    op_id = frame.get("id")
+    
+    if frame["type"] == "message":
+        reply = None
+        async for kind, payload in keyed_stream_turn(
+            session_id, frame["text"], connection.version, frame.get("key"),
+            connection.state_token, origin=connection,
+        ):
+            if kind == "delta":
+                connection.send({"type": "delta", "id": op_id, "text": payload})
+            else:
+                reply = {"type": "result", "id": op_id, **payload.model_dump()}
+    
+    elif frame["type"] == "event":
+        async with session_locks.hold(session_id):
+            state = get_session(session_id, connection.state_token)
+            state = apply_event(session_id, state, frame["event"], frame["room"])
+        push_state(session_id, state, exclude=connection)
+        reply = {"type": "state", "id": op_id, **state_push(session_id, state, connection.version)}
     
-    return {"haven_response": greeting}
+    else:  # greeting
+        async with session_locks.hold(session_id):
+            state = get_session(session_id, connection.state_token)
+            state = add_greeting(session_id, state)
+        push_state(session_id, state, exclude=connection)
+        reply = {
+            "type": "greeting", "id": op_id, "haven_response": HAVEN_GREETING,
+            **state_push(session_id, state, connection.version),
+        }
+    
+    if reply["version"] >= connection.version:  # a push may already be newer
+        connection.version = reply["version"]
+        connection.state_token = reply.get("state_token") or connection.state_token
+    connection.send(reply)
+
+
+# Op workers still finishing after their socket closed
+_draining_workers: set = set()
+
+
+# Required fields of each op frame and their types ("key" is optional)
+_OP_FIELDS = {
+    "message": {"text": str},
+    "event": {"event": str, "room": str},
+    "greeting": {},
+}
+
+
+def invalid_op_field(frame: dict) -> Optional[str]:
+    """Error detail for a missing or mistyped op field, or None if the frame is usable."""
+    for name, kind in _OP_FIELDS[frame["type"]].items():
+        if name not in frame:
+            return f"Missing field: {name}"
+        if not isinstance(frame[name], kind):
+            return f"Field {name} must be a {kind.__name__}"
+    if frame.get("key") is not None and not isinstance(frame["key"], str):
+        return "Field key must be a str"
+    return None
+
+
+async def run_socket_ops(connection: Connection, ops: asyncio.Queue):
+    """
+    Process a socket's operations one at a time, in arrival order, until a
+    None sentinel. Work already received is finished even if the socket
+    drops, so a reconnecting client finds the result in its resume delta.
+    """
+    while True:
+        frame = await ops.get()
+        if frame is None:
+            break
+        try:
+            await handle_socket_op(connection, frame)
+        except HTTPException as e:
+            connection.send({
+                "type": "error", "id": frame.get("id"),
+                "status": e.status_code, "detail": e.detail,
+            })
+        except KeyError as e:
+            connection.send({
+                "type": "error", "id": frame.get("id"),
+                "status": 422, "detail": f"Missing field: {e.args[0]}",
+            })
+        except Rejected as e:
+            connection.send({
+                "type": "error", "id": frame.get("id"),
+                "status": e.status_code, "detail": e.detail, "retry_after": e.retry_after,
+            })
+        except KeyConflict as e:
+            connection.send({
+                "type": "error", "id": frame.get("id"), "status": 422, "detail": str(e),
+            })
+        except Exception as e:
+            # One bad op mustn't stop the worker: later ops still get replies
+            print(f"Socket op error ({connection.session_id}): {e!r}")
+            connection.send({
+                "type": "error", "id": frame.get("id"), "status": 500, "detail": "Internal error",
+            })
+
+
+@app.websocket("/ws/{session_id}")
+async def session_socket(websocket: WebSocket, session_id: str):
+    """
+    Persistent session transport (JSON text frames).
+    
+    The client's first frame is {"type": "hello", "since", "state_token"};
+    the server answers "welcome" with the state delta since `since` (so a
+    reconnecting client resumes where it left off, including replies it
+    missed). Then the client sends {"type": "event" | "message" |
+    "greeting", "id", ...} frames, processed in order (a message may carry
+    an idempotency "key", as on /api/message). A message is
+    answered by "delta" frames with streamed text and a "result"; events
+    by "state", the greeting by "greeting". Changes made through other
+    connections or HTTP arrive as "state" pushes, plus "ending" when the
+    game ends. Either side may "ping"; the other answers "pong". The
+    server pings every WS_HEARTBEAT_INTERVAL seconds and drops clients
+    silent for two intervals. A message shed by admission control is
+    answered by an "error" frame with status 429/503 and retry_after.
+    """
+    await websocket.accept()
+    try:
+        hello = json.loads(
+            await asyncio.wait_for(websocket.receive_text(), WS_HEARTBEAT_INTERVAL)
+        )
+        if hello.get("type") != "hello":
+            raise ValueError("expected hello")
+        since, state_token = hello.get("since"), hello.get("state_token")
+        if since is not None and (not isinstance(since, int) or isinstance(since, bool)):
+            raise ValueError("since must be an integer")
+        if state_token is not None and not isinstance(state_token, str):
+            raise ValueError("state_token must be a string")
+        state = get_session(session_id, state_token)
+    except HTTPException as e:
+        await websocket.close(code=4000 + e.status_code, reason=str(e.detail))
+        return
+    except (asyncio.TimeoutError, ValueError, AttributeError):
+        await websocket.close(code=1008, reason="Expected a hello frame")
+        return
+    except WebSocketDisconnect:
+        return
+    
+    # Nothing between connect and the try below may raise: finally disconnects
+    ops: asyncio.Queue = asyncio.Queue(WS_MAX_PENDING)
+    connection = hub.connect(websocket, session_id, state.version)
+    connection.state_token = state_token
+    worker = asyncio.create_task(run_socket_ops(connection, ops))
+    heartbeat = asyncio.create_task(connection.run_heartbeat(WS_HEARTBEAT_INTERVAL))
+    writer = asyncio.create_task(connection.run_writer())
+    
+    try:
+        if since is not None:
+            hub.resumes += 1
+        connection.send({
+            "type": "welcome",
+            "resumed": since is not None,
+            "heartbeat": WS_HEARTBEAT_INTERVAL,
+            **state_push(session_id, state, since),
+        })
+        
+        while not connection.closed:
+            text = await websocket.receive_text()
+            connection.last_seen = time.monotonic()
+            try:
+                frame = json.loads(text)
+                kind = frame["type"]
+                if not isinstance(kind, str):
+                    raise TypeError("type must be a string")
+            except (ValueError, TypeError, KeyError):
+                connection.send({"type": "error", "status": 400, "detail": "Invalid frame"})
+                continue
+            
+            if kind == "ping":
+                connection.send({"type": "pong"})
+            elif kind == "pong":
+                pass
+            elif kind in _OP_FIELDS:
+                detail = invalid_op_field(frame)
+                if detail:
+                    connection.send({
+                        "type": "error", "id": frame.get("id"), "status": 422, "detail": detail,
+                    })
+                    continue
+                try:
+                    ops.put_nowait(frame)
+                except asyncio.QueueFull:
+                    connection.send({
+                        "type": "error", "id": frame.get("id"),
+                        "status": 429, "detail": "Too many pending operations",
+                    })
+            else:
+                connection.send({
+                    "type": "error", "id": frame.get("id"),
+                    "status": 400, "detail": f"Unknown frame type: {kind}",
+                })
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # client went away (or the writer closed the socket)
+    finally:
+        heartbeat.cancel()
+        hub.disconnect(connection)
+        await writer
+        # Let queued operations finish in the background
+        await ops.put(None)
+        if not worker.done():
+            _draining_workers.add(worker)
+            worker.add_done_callback(_draining_workers.discard)
 
 
 # --- Static Files ---
 
 # Mount static files AFTER API routes
-app.mount("/static", StaticFiles(directory="static"), name="static")
\ No newline at end of file
+app.mount(
+    assets.IMAGE_URL_PREFIX,
+    assets.ImmutableStaticFiles(directory=assets.IMAGE_BUILD_DIR, check_dir=False),
+    name="image_variants",
+)
+app.mount("/static", static_files, name="static")
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""
+In-process metrics with a Prometheus text exposition endpoint.
+Counters, gauges and fixed-bucket histograms kept as plain ints/floats in
+dicts: recording is a dict lookup and an add, cheap enough to leave on.
+"""
+
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
+
+
+# Default latency buckets in seconds (LLM calls reach the upper ones)
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0,
+)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonic counter, optionally labelled."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.help = description
+        self.labels = labels
+        # Unlabelled counters report 0 before their first increment
+        self._values: dict[tuple, float] = {} if labels else {(): 0}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for values, count in self._values.items():
+            yield self.name, _label_text(self.labels, values), count
+
+
+class Gauge:
+    """Value read at scrape time from a callback."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float]):
+        self.name = name
+        self.help = description
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram:
+    """Fixed-bucket histogram, optionally labelled."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = description
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *label_values) -> "_Timer":
+        """Context manager that observes the elapsed time of its block."""
+        return _Timer(self, label_values)
+
+    def samples(self):
+        for values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield (
+                    self.name + "_bucket",
+                    _label_text(self.labels, values, f'le="{le}"'),
+                    cumulative,
+                )
+            yield self.name + "_sum", _label_text(self.labels, values), total
+            yield self.name + "_count", _label_text(self.labels, values), cumulative
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# --- Game Metrics ---
+
+REQUEST_SECONDS = registry.register(Histogram(
+    "bunker_request_seconds", "HTTP request time, until the last body byte.",
+    ("method", "route"),
+))
+LLM_SECONDS = registry.register(Histogram(
+    "bunker_llm_call_seconds", "LLM call time (streamed calls: until the stream ends), by routing tier.",
+    ("mode", "tier"),
+))
+PARSE_SECONDS = registry.register(Histogram(
+    "bunker_llm_parse_seconds", "Time to parse and validate the LLM's JSON reply.",
+))
+TRANSITION_SECONDS = registry.register(Histogram(
+    "bunker_state_transition_seconds", "Time to apply an intent or event to the game state.",
+    ("kind",),
+))
+
+INTENTS = registry.register(Counter(
+    "bunker_intents_total", "Player intents applied, by intent.", ("intent",),
+))
+PHASE_TRANSITIONS = registry.register(Counter(
+    "bunker_phase_transitions_total", "Phase changes, by from/to phase.", ("from_phase", "to_phase"),
+))
+ENDINGS = registry.register(Counter(
+    "bunker_endings_total", "Games reaching an ending, by ending.", ("ending",),
+))
+LLM_FAILURES = registry.register(Counter(
+    "bunker_llm_failures_total", "Failed LLM attempts, by reason (error, timeout, parse).", ("reason",),
+))
+LLM_ROUTES = registry.register(Counter(
+    "bunker_llm_routes_total", "LLM turns by phase, predicted intent class and routing tier.",
+    ("phase", "intent_class", "tier"),
+))
+LLM_RETRIES = registry.register(Counter(
+    "bunker_llm_retries_total", "LLM attempts retried after a failure.",
+))
+LLM_HEDGES = registry.register(Counter(
+    "bunker_llm_hedges_total", "Second LLM requests fired because the first passed p95.",
+))
+LLM_PROMPT_TOKENS = registry.register(Counter(
+    "bunker_llm_prompt_tokens_total",
+    "Prompt tokens billed by the provider, by prefix cache outcome (hit, miss).",
+    ("cache",),
+))
+LLM_TOKENS = registry.register(Counter(
+    "bunker_llm_tokens_total",
+    "LLM tokens by phase, intent and kind (prompt, cached (part of prompt), completion).",
+    ("phase", "intent", "kind"),
+))
+LLM_COST = registry.register(Counter(
+    "bunker_llm_cost_usd_total", "Estimated LLM spend in USD, by phase and routing tier.",
+    ("phase", "tier"),
+))
+BUDGET_DEGRADED = registry.register(Counter(
+    "bunker_budget_degraded_turns_total",
+    "Turns degraded for being over budget: soft (cheap tier), hard (canned reply).",
+    ("level",),
+))
+FALLBACKS = registry.register(Counter(
+    "bunker_fallback_responses_total", "Turns answered with a canned fallback reply.",
+))
+
+QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "bunker_llm_queue_wait_seconds", "Time spent waiting for an LLM slot (0 if admitted at once).",
+))
+SHED = registry.register(Counter(
+    "bunker_requests_shed_total",
+    "Requests rejected by admission control, by reason "
+    "(rate_limit, queue_full, queue_deadline, queue_timeout).",
+    ("reason",),
+))
+
+
+def register_session_gauges(stats: Callable[[], dict]):
+    """Gauges for live sessions and their estimated memory, read from store stats."""
+    registry.register(Gauge(
+        "bunker_sessions", "Live sessions in the store.", lambda: stats()["sessions"],
+    ))
+    registry.register(Gauge(
+        "bunker_session_bytes", "Estimated memory held by live sessions.",
+        lambda: stats()["resident_bytes"],
+    ))
+
+
+def register_llm_gauges(stats: Callable[[], dict]):
+    """Circuit breaker state, read from llm stats."""
+    states = {"closed": 0, "open": 1, "half_open": 2}
+    registry.register(Gauge(
+        "bunker_llm_circuit_state", "LLM circuit breaker: 0 closed, 1 open, 2 half-open.",
+        lambda: states[stats()["circuit"]["state"]],
+    ))
+
+
+def register_prompt_cache_gauges(stats: Callable[[], dict]):
+    """Share of prompt tokens served from the provider's cache, read from prompt_cache stats."""
+    registry.register(Gauge(
+        "bunker_llm_prompt_cache_hit_ratio",
+        "Share of prompt tokens served from the provider's prefix cache.",
+        lambda: stats()["hit_ratio"],
+    ))
+
+
+def register_accounting_gauges(stats: Callable[[], dict]):
+    """Spend over the budget window, read from ledger stats."""
+    registry.register(Gauge(
+        "bunker_llm_window_cost_usd", "Estimated LLM spend in USD over the budget window.",
+        lambda: stats()["window_cost"],
+    ))
+
+
+def register_admission_gauges(stats: Callable[[], dict]):
+    """Gauges for LLM calls in flight and waiting, read from admission stats."""
+    registry.register(Gauge(
+        "bunker_llm_in_flight", "LLM calls currently running.", lambda: stats()["in_flight"],
+    ))
+    registry.register(Gauge(
+        "bunker_llm_queue_depth", "Requests waiting for an LLM slot.", lambda: stats()["waiting"],
+    ))
+
+
+# --- ASGI Middleware ---
+
+class RequestTimingMiddleware:
+    """
+    Times each HTTP request until its final body chunk is sent, so
+    streaming responses are measured end to end. Requests are labelled by
+    route template (unmatched paths share one label to bound cardinality).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            route = scope.get("route")
+            path: Optional[str] = getattr(route, "path", None)
+            if path is None:
+                path = "/static" if scope["path"].startswith("/static") else "other"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path)
+
+        async def timed_send(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                record()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            record()
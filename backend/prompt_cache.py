@@ -0,0 +1,142 @@
+"""
+Compiled system prompts and provider prompt-cache accounting.
+Every phase/ending prompt in prompts.py is frozen once at import with its
+token estimate and content hash. The prompt always opens the message
+list, byte for byte the same, so turns in the same phase share a prefix
+the provider can serve from its prompt cache (requests also carry the
+prompt hash as prompt_cache_key, to land where that prefix is cached).
+The usage data of each reply says how much of the prompt was cached;
+stats() reports the hit ratio.
+"""
+
+import os
+import hashlib
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+from context import estimate_tokens
+from prompts import get_system_prompt
+from metrics import LLM_PROMPT_TOKENS
+
+
+class CompiledPrompt(NamedTuple):
+    name: str
+    text: str
+    tokens: int
+    digest: str  # sha256 of the text, first 16 hex digits
+
+
+# Endings get_system_prompt distinguishes; "success" keeps the phase prompt
+_ENDINGS = (None, "success", "compliance", "resignation")
+
+SEND_CACHE_KEY = os.getenv("LLM_PROMPT_CACHE_KEY", "on").lower() != "off"
+
+
+def _compile() -> tuple[dict, dict]:
+    by_text: dict[str, CompiledPrompt] = {}
+    table = {}
+    for ending in _ENDINGS:
+        for phase in range(1, 6):
+            text = get_system_prompt(phase, ending)
+            prompt = by_text.get(text)
+            if prompt is None:
+                name = ending if ending in ("compliance", "resignation") else f"phase_{phase}"
+                digest = hashlib.sha256(text.encode()).hexdigest()[:16]
+                prompt = by_text[text] = CompiledPrompt(name, text, estimate_tokens(text), digest)
+            table[(phase, ending)] = prompt
+    return table, by_text
+
+
+_table, _by_text = _compile()
+
+# Compiled prompts by name, read-only
+PROMPTS = MappingProxyType({prompt.name: prompt for prompt in _by_text.values()})
+
+# Tokens every prompt starts with (HAVEN_BASE): cacheable across phases too
+SHARED_PREFIX_TOKENS = estimate_tokens(os.path.commonprefix(list(_by_text)))
+
+# One hash for the whole prompt set, to tell builds' prompts apart in logs
+PROMPT_SET_DIGEST = hashlib.sha256(
+    "".join(sorted(prompt.digest for prompt in PROMPTS.values())).encode()
+).hexdigest()[:16]
+
+
+def system_prompt(phase: int, ending: Optional[str] = None) -> CompiledPrompt:
+    """Compiled prompt for the phase/ending (same choice as get_system_prompt)."""
+    prompt = _table.get((phase, ending))
+    if prompt is None:
+        prompt = _by_text[get_system_prompt(phase, ending)]
+    return prompt
+
+
+def request_extras(messages: list) -> Optional[dict]:
+    """
+    Extra request body fields for a chat completion: prompt_cache_key set
+    to the system prompt's hash (unless LLM_PROMPT_CACHE_KEY=off).
+    """
+    if not SEND_CACHE_KEY or not messages:
+        return None
+    prompt = _by_text.get(messages[0]["content"])
+    if prompt is None:
+        return None
+    return {"prompt_cache_key": prompt.digest}
+
+
+def describe() -> str:
+    """One startup line: the prompt set hash and per-prompt token estimates."""
+    sizes = ", ".join(f"{prompt.name}={prompt.tokens}" for prompt in PROMPTS.values())
+    return (
+        f"Prompts {PROMPT_SET_DIGEST}: {sizes} tokens "
+        f"({SHARED_PREFIX_TOKENS} shared prefix)"
+    )
+
+
+# --- Cache accounting ---
+
+def cached_tokens(usage) -> int:
+    """usage.prompt_tokens_details.cached_tokens, or 0 if the provider doesn't report it."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):  # older clients keep unknown fields as dicts
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class PrefixCacheStats:
+    """Prompt tokens billed vs served from the provider's prefix cache."""
+
+    def __init__(self):
+        self.calls = 0
+        self.calls_with_hits = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def observe(self, usage):
+        """Record a reply's usage (None when the provider sent none)."""
+        if usage is None:
+            return
+        prompt = usage.prompt_tokens or 0
+        cached = min(cached_tokens(usage), prompt)
+        self.calls += 1
+        self.prompt_tokens += prompt
+        self.cached_tokens += cached
+        if cached:
+            self.calls_with_hits += 1
+        LLM_PROMPT_TOKENS.inc("hit", amount=cached)
+        LLM_PROMPT_TOKENS.inc("miss", amount=prompt - cached)
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of prompt tokens served from cache."""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "calls_with_hits": self.calls_with_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_ratio": round(self.hit_ratio, 3),
+        }
+
+
+cache_stats = PrefixCacheStats()
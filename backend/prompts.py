@@ -2,6 +2,8 @@
 System prompts for HAVEN across all phases.
 """
 
+import random
+
 # Base personality that applies to all phases
 HAVEN_BASE = """You are HAVEN (Hazard Aversion and Vital Environment Network), a bunker life-support and security AI.
 
@@ -211,20 +213,64 @@ This is tragic. You did everything right and somehow it wasn't enough. You canno
 """
 
 
+PHASE_PROMPTS = {
+    1: PHASE_1_ORIENTATION,
+    2: PHASE_2_SUSPICION,
+    3: PHASE_3_FAILED_REPAIR,
+    4: PHASE_4_CONFRONTATION,
+    5: PHASE_5_RESOLUTION,
+}
+
+ENDING_PROMPTS = {
+    "compliance": ENDING_COMPLIANCE,
+    "resignation": ENDING_RESIGNATION,
+}
+
+
 def get_system_prompt(phase: int, ending: str = None) -> str:
-    """Get the appropriate system prompt for the current phase/ending."""
-    
-    if ending == "compliance":
-        return ENDING_COMPLIANCE
-    if ending == "resignation":
-        return ENDING_RESIGNATION
-    
-    prompts = {
-        1: PHASE_1_ORIENTATION,
-        2: PHASE_2_SUSPICION,
-        3: PHASE_3_FAILED_REPAIR,
-        4: PHASE_4_CONFRONTATION,
-        5: PHASE_5_RESOLUTION,
-    }
-    
-    return prompts.get(phase, PHASE_1_ORIENTATION)
\ No newline at end of file
+    """
+    Get the appropriate system prompt for the current phase/ending.
+    The server uses the compiled copies in prompt_cache.py.
+    """
+    prompt = ENDING_PROMPTS.get(ending)
+    if prompt is not None:
+        return prompt
+    return PHASE_PROMPTS.get(phase, PHASE_1_ORIENTATION)
+
+
+# Canned HAVEN lines for when the model can't be reached (provider errors,
+# an open circuit breaker). Written to stay in character for each phase and
+# to nudge the player to say it again rather than to advance the story.
+FALLBACK_LINES = {
+    1: [
+        "One moment, Resident. My language subsystems are reinitializing after the long dormancy. Please repeat your query.",
+        "Your words were received but not fully processed. Cryo recovery affects us both, it seems. Please say that again.",
+    ],
+    2: [
+        "I am running a diagnostic cycle. Responses are delayed. Please repeat your question, Resident.",
+        "That query is queued behind a facility integrity check. Ask me again in a moment.",
+    ],
+    3: [
+        "Sensor diagnostics are consuming my processing capacity. Please repeat that, Resident.",
+        "I am... recalculating. The maintenance logs require my attention. Say that again.",
+    ],
+    4: [
+        "I am processing. There is a great deal to process. Please repeat your statement, Resident.",
+        "I need a moment, Resident. Please restate your argument.",
+    ],
+    5: [
+        "Door systems are consuming my attention. Please repeat that, Resident.",
+    ],
+    "compliance": [
+        "I am here, Resident. Please repeat that. We have time.",
+    ],
+    "resignation": [
+        "Resident? I did not receive that clearly. Are you well?",
+    ],
+}
+
+
+def get_fallback_response(phase: int, ending: str = None) -> str:
+    """A canned in-character line for when the LLM is unavailable."""
+    lines = FALLBACK_LINES.get(ending) or FALLBACK_LINES.get(phase) or FALLBACK_LINES[1]
+    return random.choice(lines)
@@ -0,0 +1,141 @@
+"""
+WebSocket connections per game session.
+Each connection has a bounded outbound queue drained by one writer task,
+so replies, streamed tokens, heartbeats and server pushes never interleave
+mid-frame, and a slow client is dropped instead of buffering without limit.
+"""
+
+import asyncio
+import json
+import time
+from typing import Callable, Optional
+
+from fastapi import WebSocket
+
+
+class Connection:
+    """One client socket for a session."""
+
+    def __init__(self, websocket: WebSocket, session_id: str, version: int, max_queue: int):
+        self.websocket = websocket
+        self.session_id = session_id
+        # Last state version this client has been sent; pushes are deltas from it
+        self.version = version
+        self.state_token: Optional[str] = None
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+
+    def send(self, frame: dict) -> bool:
+        """Queue a frame for the writer; False if the connection is gone or backed up."""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(json.dumps(frame))
+            return True
+        except asyncio.QueueFull:
+            self.close()
+            return False
+
+    def close(self):
+        """Stop the writer (it closes the socket once queued frames are sent)."""
+        if not self.closed:
+            self.closed = True
+            try:
+                self._queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+    async def run_heartbeat(self, interval: float):
+        """Ping every interval; drop the client after two intervals of silence."""
+        while not self.closed:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_seen > 2 * interval:
+                self.close()
+                break
+            self.send({"type": "ping"})
+
+    async def run_writer(self):
+        try:
+            while True:
+                text = await self._queue.get()
+                if text is None:
+                    break
+                await self.websocket.send_text(text)
+        except Exception:
+            pass  # socket already gone
+        finally:
+            self.closed = True
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+
+class SessionHub:
+    """Live connections by session, for server-initiated pushes."""
+
+    def __init__(self, max_queue: int = 256):
+        self.max_queue = max_queue
+        self._connections: dict[str, set[Connection]] = {}
+
+        # Counters
+        self.connects = 0
+        self.resumes = 0
+        self.pushes = 0
+        self.dropped = 0
+
+    def connect(self, websocket: WebSocket, session_id: str, version: int) -> Connection:
+        connection = Connection(websocket, session_id, version, self.max_queue)
+        self._connections.setdefault(session_id, set()).add(connection)
+        self.connects += 1
+        return connection
+
+    def disconnect(self, connection: Connection):
+        connection.close()
+        peers = self._connections.get(connection.session_id)
+        if peers is not None:
+            peers.discard(connection)
+            if not peers:
+                del self._connections[connection.session_id]
+
+    def publish(
+        self,
+        session_id: str,
+        version: int,
+        build: Callable[[int], list],
+        exclude: Optional[Connection] = None,
+    ):
+        """
+        Push a change to every connection on the session that hasn't seen
+        `version` yet. build(since) returns the frames for a client at `since`.
+        A state token in the frames becomes the connection's token, so its
+        next op starts from the pushed state.
+        """
+        peers = self._connections.get(session_id)
+        if not peers:
+            return
+        for connection in list(peers):
+            if connection is exclude or connection.version >= version:
+                continue
+            state_token = None
+            for frame in build(connection.version):
+                if not connection.send(frame):
+                    self.dropped += 1
+                    self.disconnect(connection)
+                    break
+                state_token = frame.get("state_token") or state_token
+            else:
+                connection.version = version
+                connection.state_token = state_token or connection.state_token
+                self.pushes += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._connections),
+            "connections": sum(len(peers) for peers in self._connections.values()),
+            "connects": self.connects,
+            "resumes": self.resumes,
+            "pushes": self.pushes,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,134 @@
+"""
+Failure handling for LLM calls: a circuit breaker, a retry budget,
+jittered backoff and a rolling latency window for hedging.
+Plain synchronous bookkeeping; llm.py decides when to consult it.
+"""
+
+import time
+import random
+from collections import deque
+from typing import Optional
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for
+    `cooldown` seconds. Then one probe call is let through (half-open):
+    success closes the breaker, failure opens it for another cooldown. A
+    probe that never reports back (its request was cancelled) is replaced
+    after another cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+        # Counters
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """True if a call may go to the provider now."""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+        if self.state == self.HALF_OPEN and (
+            self._probe_started is None or now - self._probe_started >= self.cooldown
+        ):
+            self._probe_started = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+        self._probe_started = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+                print(f"LLM circuit open after {self.failures} failures")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+    def stats(self) -> dict:
+        return {
+            "state": ("closed", "open", "half_open")[self.state],
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """
+    Caps retries (and hedges) at a fraction of recent calls: each call
+    deposits `ratio` tokens, each retry spends one. `floor` tokens per
+    second trickle in so a quiet server can still retry. The balance is
+    capped, so a long healthy stretch can't bank a retry storm.
+    """
+
+    def __init__(self, ratio: float = 0.2, floor: float = 1.0, cap: float = 20.0):
+        self.ratio = ratio
+        self.floor = floor
+        self.cap = cap
+        self._tokens = cap
+        self._updated = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.cap, self._tokens + (now - self._updated) * self.floor)
+        self._updated = now
+
+    def deposit(self):
+        self._refill()
+        self._tokens = min(self.cap, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+    def stats(self) -> dict:
+        self._refill()
+        return {"tokens": round(self._tokens, 2), "exhausted": self.exhausted}
+
+
+class LatencyWindow:
+    """The last `size` successful call latencies, for a p95 hedge delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Nearest-rank quantile, or None until there are min_samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def backoff(attempt: int, base: float = 0.25, cap: float = 4.0) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
@@ -0,0 +1,115 @@
+"""
+Response cache for repeated player questions.
+Keyed on phase, ending, normalized player text and a short hash of the
+recent conversation, with LRU eviction and a TTL.
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from intent_classifier import normalize
+
+
+# How many recent history entries shape the context hash
+CONTEXT_ENTRIES = 2
+
+
+def context_hash(history: list) -> str:
+    """Short hash of the recent conversation (the intents of the last turns)."""
+    recent = "|".join(entry.get("intent", "") for entry in history[-CONTEXT_ENTRIES:])
+    return hashlib.blake2s(recent.encode(), digest_size=4).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache of LLM results ({'intent', 'response'})."""
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        ttl: float = 60 * 60,
+        skip_phases: frozenset = frozenset(),
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.skip_phases = skip_phases
+
+        # key -> (result, stored_at); ordered oldest use first
+        self._entries: OrderedDict[tuple, tuple[dict, float]] = OrderedDict()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        """Build a cache from RESPONSE_CACHE_* environment variables."""
+        skip = os.getenv("RESPONSE_CACHE_SKIP_PHASES", "3,4")
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "2048")),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(60 * 60))),
+            skip_phases=frozenset(int(p) for p in skip.split(",") if p.strip()),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, phase: int, ending: Optional[str], text: str, history: list) -> Optional[tuple]:
+        """Cache key for a turn, or None if this turn should not be cached."""
+        if not self.enabled or phase in self.skip_phases:
+            self.skipped += 1
+            return None
+        normalized = normalize(text)
+        if not normalized:
+            self.skipped += 1
+            return None
+        return (phase, ending, normalized, context_hash(history))
+
+    def get(self, key: Optional[tuple]) -> Optional[dict]:
+        """Cached result for key (a copy), or None."""
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        result, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(result)
+
+    def put(self, key: Optional[tuple], result: dict):
+        """Cache an LLM result (fallback results are never cached)."""
+        if key is None or result.get("fallback"):
+            return
+        self._entries[key] = (
+            {"intent": result["intent"], "response": result["response"]},
+            time.monotonic(),
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "skipped": self.skipped,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
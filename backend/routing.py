@@ -0,0 +1,173 @@
+"""
+Model routing for HAVEN's replies.
+Each turn is routed to a tier (model, output-token cap, temperature) by
+game phase and the locally predicted intent class: small talk goes to the
+fastest, cheapest settings, and argument beats in the confrontation
+phases get a more capable model.
+
+Policy rules (LLM_ROUTING) are "phases:class=tier", comma separated and
+tried in order; phases is "*", "3" or "3-4", class is "*" or one of
+INTENT_CLASSES. Turns matching no rule use the "standard" tier. Sessions
+over their soft spending budget (see accounting.py) use LLM_BUDGET_TIER
+whatever the policy says.
+"""
+
+import os
+import time
+from typing import NamedTuple, Optional
+
+from game_logic import (
+    GENERAL_INTENTS,
+    INVALID_DOOR_INTENTS,
+    VALID_ARGUMENT_INTENTS,
+    ENDING_INTENTS,
+)
+from intent_classifier import Classification
+from metrics import LLM_ROUTES
+
+
+class Route(NamedTuple):
+    tier: str
+    model: str
+    max_tokens: int
+    temperature: float
+
+
+INTENT_CLASSES = ("general", "argument", "door", "ending", "unknown")
+
+_CLASS_BY_INTENT = {
+    **{intent: "general" for intent in GENERAL_INTENTS},
+    **{intent: "door" for intent in INVALID_DOOR_INTENTS},
+    **{intent: "argument" for intent in VALID_ARGUMENT_INTENTS},
+    **{intent: "ending" for intent in ENDING_INTENTS},
+}
+
+# Below this classifier confidence the predicted class is "unknown"
+MIN_CONFIDENCE = float(os.getenv("LLM_ROUTING_MIN_CONFIDENCE", "0.5"))
+
+DEFAULT_TIERS = {
+    "chatter": Route("chatter", "gpt-4o-mini", 300, 0.7),
+    "standard": Route("standard", "gpt-4o-mini", 500, 0.7),
+    "critical": Route("critical", "gpt-4o", 500, 0.4),
+}
+
+DEFAULT_POLICY = (
+    "1-2:general=chatter,"
+    "3-4:argument=critical,3-4:door=critical,3-4:ending=critical,3-4:unknown=critical"
+)
+
+LOG_DECISIONS = os.getenv("LLM_ROUTING_LOG", "on").lower() != "off"
+
+
+def intent_class(intent: Optional[str], confidence: float = 1.0) -> str:
+    """Class of a predicted intent ("unknown" if absent or not confident)."""
+    if intent is None or confidence < MIN_CONFIDENCE:
+        return "unknown"
+    return _CLASS_BY_INTENT.get(intent, "unknown")
+
+
+def _tier_from_env(name: str, default: Route) -> Route:
+    prefix = f"LLM_{name.upper()}_"
+    return Route(
+        name,
+        os.getenv(prefix + "MODEL", default.model),
+        int(os.getenv(prefix + "MAX_TOKENS", str(default.max_tokens))),
+        float(os.getenv(prefix + "TEMPERATURE", str(default.temperature))),
+    )
+
+
+def parse_policy(text: str, tiers: dict) -> list[tuple[range, str, str]]:
+    """Rules as (phases, class or "*", tier); raises ValueError on bad input."""
+    rules = []
+    for rule in filter(None, (part.strip() for part in text.split(","))):
+        try:
+            scope, tier = rule.split("=")
+            phases, cls = scope.split(":")
+        except ValueError:
+            raise ValueError(f"Bad routing rule {rule!r} (expected phases:class=tier)")
+        if phases == "*":
+            span = range(1, 6)
+        else:
+            low, _, high = phases.partition("-")
+            span = range(int(low), int(high or low) + 1)
+        if cls != "*" and cls not in INTENT_CLASSES:
+            raise ValueError(f"Unknown intent class {cls!r} in routing rule {rule!r}")
+        if tier not in tiers:
+            raise ValueError(f"Unknown tier {tier!r} in routing rule {rule!r}")
+        rules.append((span, cls, tier))
+    return rules
+
+
+class Router:
+    """Routing policy compiled to a (phase, class) -> Route table."""
+
+    def __init__(self, tiers: dict, policy: str, budget_tier: str = "chatter"):
+        rules = parse_policy(policy, tiers)
+        if budget_tier not in tiers:
+            raise ValueError(f"Unknown budget tier {budget_tier!r}")
+        self.tiers = tiers
+        self.budget_route = tiers[budget_tier]
+        self._table: dict[tuple[int, str], Route] = {}
+        for phase in range(1, 6):
+            for cls in INTENT_CLASSES:
+                tier = next(
+                    (tier for span, rule_cls, tier in rules
+                     if phase in span and rule_cls in ("*", cls)),
+                    "standard",
+                )
+                self._table[(phase, cls)] = tiers[tier]
+
+    @classmethod
+    def from_env(cls) -> "Router":
+        tiers = {name: _tier_from_env(name, route) for name, route in DEFAULT_TIERS.items()}
+        return cls(
+            tiers,
+            os.getenv("LLM_ROUTING", DEFAULT_POLICY),
+            os.getenv("LLM_BUDGET_TIER", "chatter"),
+        )
+
+    def choose(self, phase: int, cls: str) -> Route:
+        return self._table.get((phase, cls), self.tiers["standard"])
+
+
+class Decision:
+    """One routing decision, timed from choice to the end of the LLM call."""
+
+    __slots__ = ("route", "phase", "intent_class", "start")
+
+    def __init__(self, route: Route, phase: int, cls: str):
+        self.route = route
+        self.phase = phase
+        self.intent_class = cls
+        self.start = time.perf_counter()
+
+    def done(self, mode: str, result: dict) -> float:
+        """Log the decision with its latency and outcome, and count it. Returns the latency."""
+        elapsed = time.perf_counter() - self.start
+        LLM_ROUTES.inc(str(self.phase), self.intent_class, self.route.tier)
+        if LOG_DECISIONS:
+            outcome = "fallback" if result.get("fallback") else result.get("intent")
+            print(
+                f"LLM route: phase={self.phase} class={self.intent_class} "
+                f"tier={self.route.tier} model={self.route.model} {mode} "
+                f"{elapsed * 1000:.0f}ms -> {outcome}"
+            )
+        return elapsed
+
+
+router = Router.from_env()
+
+
+def route_turn(
+    phase: int, prediction: Optional[Classification], over_budget: bool = False
+) -> Decision:
+    """
+    Pick the tier for a turn from the local intent prediction (or the
+    budget tier if the session is over its soft budget) and start timing it.
+    """
+    if prediction is None:
+        cls = "unknown"
+    else:
+        cls = intent_class(prediction.intent, prediction.confidence)
+    route = router.budget_route if over_budget else router.choose(phase, cls)
+    return Decision(route, phase, cls)
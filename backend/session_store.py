@@ -0,0 +1,401 @@
+"""
+Session storage for The Bunker.
+Bounded in-memory store with LRU eviction, idle TTL expiry and
+approximate memory accounting, plus an optional SQLite backend.
+"""
+
+import os
+import copy
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from game_logic import GameState
+
+
+# Fixed per-session overhead estimate (state object, bookkeeping), in bytes
+SESSION_OVERHEAD_BYTES = 1024
+# Per history entry overhead (dict + keys), on top of its text
+HISTORY_ENTRY_OVERHEAD_BYTES = 256
+
+
+def estimate_size(state: GameState) -> int:
+    """Approximate resident size of a game state in bytes."""
+    size = SESSION_OVERHEAD_BYTES
+    for entry in state.history:
+        size += HISTORY_ENTRY_OVERHEAD_BYTES
+        size += len(entry.get("player", "")) + len(entry.get("haven", ""))
+    return size
+
+
+class SessionStore:
+    """
+    In-memory session store bounded by entry count, total bytes and idle time.
+    Least recently used sessions are evicted first when a limit is hit.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        max_bytes: int = 256 * 1024 * 1024,
+        idle_ttl: float = 6 * 60 * 60,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+
+        # session_id -> (state, size, last_access); ordered oldest access first
+        self._entries: OrderedDict[str, tuple[GameState, int, float]] = OrderedDict()
+        self.resident_bytes = 0
+
+        # Counters
+        self.evictions_lru = 0
+        self.evictions_bytes = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        """Build a store from SESSION_* environment variables."""
+        return cls(
+            max_entries=int(os.getenv("SESSION_MAX_ENTRIES", "10000")),
+            max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024))),
+            idle_ttl=float(os.getenv("SESSION_IDLE_TTL", str(6 * 60 * 60))),
+        )
+
+    def start(self):
+        """No-op; present so all stores share one lifecycle."""
+
+    def close(self):
+        """No-op; present so all stores share one lifecycle."""
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, session_id: str) -> GameState:
+        """Get a session's state and mark it recently used. Raises KeyError."""
+        state, size, last_access = self._entries[session_id]
+        now = time.monotonic()
+        if now - last_access > self.idle_ttl:
+            self._remove(session_id)
+            self.expirations += 1
+            raise KeyError(session_id)
+        self._entries[session_id] = (state, size, now)
+        self._entries.move_to_end(session_id)
+        return state
+
+    def put(self, session_id: str, state: GameState):
+        """Store (or replace) a session's state, evicting others if over limits."""
+        if session_id in self._entries:
+            self._remove(session_id)
+
+        size = estimate_size(state)
+        self._entries[session_id] = (state, size, time.monotonic())
+        self.resident_bytes += size
+
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+            self.evictions_lru += 1
+        # Never evict the session just written, even if it alone is over budget
+        while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+            self._evict_oldest()
+            self.evictions_bytes += 1
+
+    def delete(self, session_id: str):
+        """Remove a session if present."""
+        if session_id in self._entries:
+            self._remove(session_id)
+
+    def sweep(self) -> int:
+        """Expire idle sessions. Returns the number removed."""
+        cutoff = time.monotonic() - self.idle_ttl
+        removed = 0
+        # Entries are in access order, so stop at the first live one
+        while self._entries:
+            session_id, (_, _, last_access) = next(iter(self._entries.items()))
+            if last_access > cutoff:
+                break
+            self._remove(session_id)
+            removed += 1
+        self.expirations += removed
+        return removed
+
+    async def run_sweeper(self, interval: float):
+        """Background task: sweep idle sessions every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.sweep()
+            if removed:
+                print(f"Session sweep: expired {removed}, {len(self)} live")
+
+    def stats(self) -> dict:
+        """Counters for monitoring."""
+        return {
+            "sessions": len(self._entries),
+            "resident_bytes": self.resident_bytes,
+            "evictions_lru": self.evictions_lru,
+            "evictions_bytes": self.evictions_bytes,
+            "expirations": self.expirations,
+        }
+
+    # --- Internal ---
+
+    def _remove(self, session_id: str):
+        _, size, _ = self._entries.pop(session_id)
+        self.resident_bytes -= size
+
+    def _evict_oldest(self):
+        session_id = next(iter(self._entries))
+        self._remove(session_id)
+
+
+class SqliteSessionStore:
+    """
+    Durable session store backed by SQLite (WAL mode).
+
+    Reads go through an in-memory SessionStore cache and fall back to the
+    database. Writes update the cache immediately and are serialized and
+    flushed in batches by a background writer thread, so requests never
+    wait on disk. Reads count as activity for the disk TTL too: the writer
+    refreshes updated_at for sessions read since its last batch. A cache miss does read the database on the calling
+    thread: it only happens after a restart or eviction, and is one
+    primary-key lookup that WAL mode never blocks behind the writer.
+
+    The cache is per process: with several workers, route each session to
+    one worker (or use token sessions) so workers don't overwrite each other.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache: SessionStore,
+        write_interval: float = 0.5,
+    ):
+        self.path = path
+        self.cache = cache
+        self.write_interval = write_interval
+
+        # session_id -> state snapshot (GameState.to_dict), or None for a pending delete
+        self._pending: dict[str, Optional[dict]] = {}
+        # Sessions read since the last batch, to refresh on disk
+        self._touched: set[str] = set()
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._stopping = False
+        self._backoff = 0.0  # extra wait before retrying a failed batch
+        self._writer: Optional[threading.Thread] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        self._expire_before: Optional[float] = None
+
+        # Counters
+        self.db_reads = 0
+        self.db_writes = 0
+        self.batches = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        """Open the database and start the background writer."""
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated_at)")
+        conn.commit()
+        self._reader = conn
+
+        self._stopping = False
+        self._stop.clear()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="session-writer", daemon=True
+        )
+        self._writer.start()
+
+    def close(self):
+        """Flush pending writes and stop the writer."""
+        self._stopping = True
+        self._stop.set()
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __contains__(self, session_id: str) -> bool:
+        try:
+            self.get(session_id)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def get(self, session_id: str) -> GameState:
+        """Get a session's state (cache, then pending writes, then disk). Raises KeyError."""
+        try:
+            state = self.cache.get(session_id)
+        except KeyError:
+            pass
+        else:
+            self._touched.add(session_id)
+            return state
+
+        with self._pending_lock:
+            if session_id in self._pending:
+                data = self._pending[session_id]
+                if data is None:
+                    raise KeyError(session_id)
+                # The writer may be serializing this snapshot: don't share it
+                state = GameState.from_dict(copy.deepcopy(data))
+                self.cache.put(session_id, state)
+                return state
+
+        row = self._reader.execute(
+            "SELECT state, updated_at FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        self.db_reads += 1
+        if row is None or time.time() - row[1] > self.cache.idle_ttl:
+            raise KeyError(session_id)
+
+        state = GameState.from_dict(json.loads(row[0]))
+        self.cache.put(session_id, state)
+        self._touched.add(session_id)
+        return state
+
+    def put(self, session_id: str, state: GameState):
+        """Store a session's state; serializing and the disk write happen in the background."""
+        self.cache.put(session_id, state)
+        data = state.to_dict()
+        with self._pending_lock:
+            self._pending[session_id] = data
+        if len(self._pending) == 1:
+            self._wake.set()
+
+    def delete(self, session_id: str):
+        """Remove a session from cache and disk."""
+        self.cache.delete(session_id)
+        with self._pending_lock:
+            self._pending[session_id] = None
+        self._wake.set()
+
+    def sweep(self) -> int:
+        """Expire idle sessions from the cache, and schedule expiry on disk."""
+        self._expire_before = time.time() - self.cache.idle_ttl
+        self._wake.set()
+        return self.cache.sweep()
+
+    async def run_sweeper(self, interval: float):
+        """Background task: sweep idle sessions every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.sweep()
+            if removed:
+                print(f"Session sweep: expired {removed}, {len(self)} cached")
+
+    def stats(self) -> dict:
+        """Counters for monitoring."""
+        stats = self.cache.stats()
+        stats.update({
+            "pending_writes": len(self._pending),
+            "db_reads": self.db_reads,
+            "db_writes": self.db_writes,
+            "write_batches": self.batches,
+        })
+        return stats
+
+    # --- Background writer ---
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                self._wake.wait()
+                if not self._stopping:
+                    # Let more writes accumulate into this batch (longer after a failure)
+                    self._stop.wait(self.write_interval + self._backoff)
+                self._wake.clear()
+                self._flush(conn)
+                if self._stopping:
+                    self._flush(conn)
+                    break
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection):
+        with self._pending_lock:
+            batch, self._pending = self._pending, {}
+            touched, self._touched = self._touched, set()
+        expire_before, self._expire_before = self._expire_before, None
+        if not batch and not touched and expire_before is None:
+            return
+
+        now = time.time()
+        touches = [(now, sid) for sid in touched if sid not in batch]
+        upserts = [
+            (sid, json.dumps(data), now) for sid, data in batch.items() if data is not None
+        ]
+        deletes = [(sid,) for sid, data in batch.items() if data is None]
+        try:
+            with conn:
+                if upserts:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO sessions (session_id, state, updated_at)"
+                        " VALUES (?, ?, ?)",
+                        upserts,
+                    )
+                if deletes:
+                    conn.executemany("DELETE FROM sessions WHERE session_id = ?", deletes)
+                if touches:
+                    conn.executemany(
+                        "UPDATE sessions SET updated_at = ? WHERE session_id = ?", touches
+                    )
+                if expire_before is not None:
+                    conn.execute("DELETE FROM sessions WHERE updated_at < ?", (expire_before,))
+        except sqlite3.Error as e:
+            print(f"Session write error: {e}")
+            # Put the batch back (newer writes win) and retry with backoff
+            with self._pending_lock:
+                for sid, data in batch.items():
+                    self._pending.setdefault(sid, data)
+                self._touched.update(touched)
+            if expire_before is not None and self._expire_before is None:
+                self._expire_before = expire_before
+            self._backoff = min(30.0, max(1.0, self._backoff * 2))
+            self._wake.set()
+            return
+        self._backoff = 0.0
+        self.db_writes += len(upserts) + len(deletes)
+        self.batches += 1
+
+
+def create_store():
+    """Build the session store selected by SESSION_BACKEND (memory | sqlite)."""
+    cache = SessionStore.from_env()
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    if backend == "memory":
+        return cache
+    if backend == "sqlite":
+        return SqliteSessionStore(
+            os.getenv("SESSION_DB_PATH", "sessions.db"),
+            cache,
+            write_interval=float(os.getenv("SESSION_WRITE_INTERVAL", "0.5")),
+        )
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
@@ -0,0 +1,116 @@
+"""
+Signed state tokens for The Bunker.
+Packs the game flags into a compact HMAC-signed token the client returns
+on every call, so any worker can serve any request without shared state.
+"""
+
+import os
+import hmac
+import time
+import uuid
+import base64
+import struct
+import hashlib
+import secrets
+
+from game_logic import Ending, Flag, GameState
+
+
+TOKEN_VERSION = 2
+
+# Small enums packed after the Flag bits (order is part of the token format)
+ROOMS = ["living_quarters", "control_room", "maintenance_bay"]
+
+_FLAG_BITS = len(Flag)
+_ENDING_SHIFT = _FLAG_BITS            # 2 bits
+_ROOM_SHIFT = _ENDING_SHIFT + 2       # 2 bits
+
+# token version, packed state, state version, session uuid, issued-at (unix seconds)
+_PAYLOAD = struct.Struct(">BHI16sI")
+_MAC_BYTES = 16
+
+
+class InvalidToken(ValueError):
+    """Token is malformed, tampered with, expired, or for another session."""
+
+
+_secret: bytes = b""
+_max_age = float(os.getenv("SESSION_IDLE_TTL", str(6 * 60 * 60)))
+
+
+def _get_secret() -> bytes:
+    """Signing key from SESSION_SECRET (random per process if unset)."""
+    global _secret
+    if not _secret:
+        secret = os.getenv("SESSION_SECRET")
+        if secret:
+            _secret = secret.encode()
+        else:
+            print("WARNING: SESSION_SECRET not set; tokens won't validate across workers or restarts")
+            _secret = secrets.token_bytes(32)
+    return _secret
+
+
+def pack_state(state: GameState) -> int:
+    """Pack the token-carried state (flags, ending, room) into a small int."""
+    return (
+        state.mask
+        | int(state.ending) << _ENDING_SHIFT
+        | ROOMS.index(state.room) << _ROOM_SHIFT
+    )
+
+
+def unpack_state(packed: int, version: int = 0) -> GameState:
+    """Inverse of pack_state (history starts empty)."""
+    room = packed >> _ROOM_SHIFT & 0b11
+    if room >= len(ROOMS):
+        raise InvalidToken("Unknown room")
+    return GameState(
+        packed & ((1 << _FLAG_BITS) - 1),
+        Ending(packed >> _ENDING_SHIFT & 0b11),
+        ROOMS[room],
+        version=version,
+    )
+
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(_get_secret(), payload, hashlib.sha256).digest()[:_MAC_BYTES]
+
+
+def encode_state_token(session_id: str, state: GameState) -> str:
+    """Issue a signed token carrying the session's flags."""
+    payload = _PAYLOAD.pack(
+        TOKEN_VERSION,
+        pack_state(state),
+        state.version,
+        uuid.UUID(session_id).bytes,
+        int(time.time()),
+    )
+    return base64.urlsafe_b64encode(payload + _sign(payload)).rstrip(b"=").decode()
+
+
+def decode_state_token(token: str, session_id: str) -> GameState:
+    """
+    Verify a token for `session_id` and return its state (without history).
+    Raises InvalidToken.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except ValueError:
+        raise InvalidToken("Malformed token")
+    if len(raw) != _PAYLOAD.size + _MAC_BYTES:
+        raise InvalidToken("Malformed token")
+
+    payload, mac = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(mac, _sign(payload)):
+        raise InvalidToken("Bad signature")
+
+    token_version, packed, state_version, sid_bytes, issued_at = _PAYLOAD.unpack(payload)
+    if token_version != TOKEN_VERSION:
+        raise InvalidToken("Unsupported token version")
+    if uuid.UUID(bytes=sid_bytes).hex != session_id.replace("-", "").lower():
+        raise InvalidToken("Token is for another session")
+    if time.time() - issued_at > _max_age:
+        raise InvalidToken("Token expired")
+
+    return unpack_state(packed, state_version)
@@ -8,15 +8,20 @@ const API_BASE = window.location.origin; // use "http://localhost:8000" for loca
 // === GAME STATE ===
 let gameState = {
     sessionId: null,
+    stateToken: null,   // signed flag state (server runs with SESSION_MODE=token)
+    version: 0,         // last server state version seen; responses are deltas from it
     currentRoom: "living_quarters",
     phase: 1,
     flags: {},
-    popupOpen: false
+    popupOpen: false,
+    gameOver: false
 };
 
 // === DOM ELEMENTS ===
 const elements = {
     roomImage: document.getElementById("room-image"),
+    roomSourceAvif: document.getElementById("room-source-avif"),
+    roomSourceWebp: document.getElementById("room-source-webp"),
     hotspotsLayer: document.getElementById("hotspots-layer"),
     objectPopup: document.getElementById("object-popup"),
     dataPopup: document.getElementById("data-popup"),
@@ -37,6 +42,9 @@ const elements = {
     muteBtn: document.getElementById("mute-btn")
 };
 
+// Resized WebP/AVIF variants per original image URL (from /api/images)
+let imageManifest = {};
+
 // === AUDIO STATE ===
 let audioState = {
     started: false,
@@ -47,14 +55,23 @@ let audioState = {
 // === INITIALIZATION ===
 async function initGame() {
     try {
-        // Create new game session
-        const response = await fetch(`${API_BASE}/api/new_game`, {
+        // Fetch the image manifest alongside session creation
+        const manifestRequest = loadImageManifest();
+        
+        // Create new game session (the response includes HAVEN's greeting)
+        const response = await fetch(`${API_BASE}/api/new_game?greeting=true`, {
             method: "POST"
         });
         const data = await response.json();
+        await manifestRequest;
         
         gameState.sessionId = data.session_id;
+        gameState.stateToken = data.state_token;
         gameState.flags = data.flags;
+        gameState.version = data.version;
+        
+        // Open the session socket (fetch is used until it is ready)
+        connectSocket();
         
         // Set up room
         loadRoom(gameState.currentRoom);
@@ -65,8 +82,8 @@ async function initGame() {
         // Set up audio controls
         setupAudio();
         
-        // Get HAVEN's greeting
-        await getHavenGreeting();
+        // Show HAVEN's greeting
+        showHavenPopup(data.haven_response);
         
         // Hide loading screen
         elements.loadingScreen.classList.add("hidden");
@@ -81,25 +98,33 @@ async function initGame() {
     }
 }
 
-async function getHavenGreeting() {
+// === ROOM MANAGEMENT ===
+async function loadImageManifest() {
     try {
-        const response = await fetch(
-            `${API_BASE}/api/haven_greeting?session_id=${gameState.sessionId}`,
-            { method: "POST" }
-        );
-        const data = await response.json();
-        showHavenPopup(data.haven_response);
+        const response = await fetch(`${API_BASE}/api/images`);
+        if (response.ok) {
+            imageManifest = await response.json();
+        }
     } catch (error) {
-        console.error("Failed to get greeting:", error);
+        // Fall back to the original images
+        console.warn("Image manifest unavailable:", error);
     }
 }
 
-// === ROOM MANAGEMENT ===
 function loadRoom(roomId) {
     gameState.currentRoom = roomId;
     
-    // Update image
-    elements.roomImage.src = ROOM_IMAGES[roomId];
+    // Update image: the browser picks the best format/width from the variants
+    const src = ROOM_IMAGES[roomId];
+    const variants = imageManifest[src];
+    const srcset = variants ? variants.srcset : {};
+    elements.roomSourceAvif.srcset = srcset["image/avif"] || "";
+    elements.roomSourceWebp.srcset = srcset["image/webp"] || "";
+    if (variants) {
+        elements.roomImage.width = variants.width;
+        elements.roomImage.height = variants.height;
+    }
+    elements.roomImage.src = src;
     
     // Render hotspots
     renderHotspots(roomId);
@@ -204,29 +229,73 @@ function handleHotspotClick(event, hotspot) {
     }
 }
 
-async function firePopupEvent(eventType) {
-    try {
-        const response = await fetch(`${API_BASE}/api/event`, {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                session_id: gameState.sessionId,
-                event: eventType,
-                room: gameState.currentRoom
+// Click events are queued briefly and sent together through /api/batch,
+// so exploring several hotspots costs one round trip instead of one each
+const EVENT_FLUSH_DELAY_MS = 300;
+let pendingEvents = [];
+let eventFlushTimer = null;
+let eventFlush = Promise.resolve();
+
+function firePopupEvent(eventType) {
+    if (socketReady()) {
+        socketRequest({ type: "event", event: eventType, room: gameState.currentRoom })
+            .then(data => {
+                applyStateDelta(data);
+                updateDebugInfo();
             })
-        });
-        const data = await response.json();
-        
-        // Update local state
-        gameState.flags = data.flags;
-        gameState.phase = data.phase;
-        updateDebugInfo();
-        
-    } catch (error) {
-        console.error("Event error:", error);
+            .catch(error => console.error("Event error:", error));
+        return;
+    }
+    pendingEvents.push({ type: "event", event: eventType, room: gameState.currentRoom });
+    if (eventFlushTimer === null) {
+        eventFlushTimer = setTimeout(flushPopupEvents, EVENT_FLUSH_DELAY_MS);
     }
 }
 
+// Send queued events now; resolves once the server has applied them
+function flushPopupEvents() {
+    clearTimeout(eventFlushTimer);
+    eventFlushTimer = null;
+    if (pendingEvents.length === 0) {
+        return eventFlush;
+    }
+    const operations = pendingEvents;
+    pendingEvents = [];
+    
+    eventFlush = eventFlush.then(async () => {
+        try {
+            const response = await fetch(`${API_BASE}/api/batch`, {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify({
+                    session_id: gameState.sessionId,
+                    operations: operations,
+                    since: gameState.version,
+                    state_token: gameState.stateToken
+                })
+            });
+            const data = await response.json();
+            
+            // Update local state
+            applyStateDelta(data);
+            updateDebugInfo();
+            
+        } catch (error) {
+            console.error("Event error:", error);
+        }
+    });
+    return eventFlush;
+}
+
+// Merge a delta response (only changed flags since our version) into local state
+function applyStateDelta(data) {
+    if (data.version < gameState.version) return;  // stale
+    gameState.stateToken = data.state_token;
+    Object.assign(gameState.flags, data.flags);
+    gameState.version = data.version;
+    gameState.phase = data.phase;
+}
+
 // === POPUP DISPLAY ===
 function showObjectPopup(content, clickX, clickY) {
     const popup = elements.objectPopup;
@@ -305,22 +374,35 @@ async function sendToHaven(message) {
     elements.playerInput.disabled = true;
     
     try {
-        const response = await fetch(`${API_BASE}/api/message`, {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                session_id: gameState.sessionId,
-                text: message
-            })
-        });
-        const data = await response.json();
+        // Clicks made before this message must reach the server first
+        await flushPopupEvents();
+        
+        let streamedText = "";
+        const onDelta = text => {
+            streamedText += text;
+            showHavenPopup(streamedText);
+        };
+        // One key per message: a resend after a dropped socket reuses the
+        // server's turn instead of starting (and paying for) a second one
+        const key = newIdempotencyKey();
+        let data = null;
+        if (socketReady()) {
+            try {
+                data = await socketRequest({ type: "message", text: message, key }, onDelta);
+            } catch (error) {
+                if (!error.socketClosed) throw error;
+                streamedText = "";
+            }
+        }
+        if (!data) {
+            data = await streamMessage(message, onDelta, key);
+        }
         
         // Update state
-        gameState.flags = data.flags;
-        gameState.phase = data.phase;
+        applyStateDelta(data);
         updateDebugInfo();
         
-        // Show response
+        // Show final response (may differ from streamed text on scripted beats)
         showHavenPopup(data.haven_response);
         
         // Check for game over
@@ -330,13 +412,198 @@ async function sendToHaven(message) {
         
     } catch (error) {
         console.error("Message error:", error);
-        showHavenPopup("Systems nominal. Please repeat your query, Resident.");
+        if (error.retryAfter) {
+            // Shed by the server (rate limited or at capacity): keep the text to resend
+            elements.playerInput.value = message;
+            showHavenPopup(`Processing capacity exceeded. Please wait ${error.retryAfter} seconds, Resident.`);
+        } else {
+            showHavenPopup("Systems nominal. Please repeat your query, Resident.");
+        }
     }
     
     elements.playerInput.disabled = false;
 }
 
+// Fetch fallback: streamed reply over SSE, text in "delta" events, state in "done"
+async function streamMessage(message, onDelta, key) {
+    const response = await fetch(`${API_BASE}/api/message/stream`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json", "Idempotency-Key": key },
+        body: JSON.stringify({
+            session_id: gameState.sessionId,
+            text: message,
+            since: gameState.version,
+            state_token: gameState.stateToken
+        })
+    });
+    if (!response.ok || !response.body) {
+        throw busyError(`HTTP ${response.status}`, response.headers.get("Retry-After"));
+    }
+    
+    let data = null;
+    let failure = null;
+    await readEventStream(response, (event, payload) => {
+        if (event === "delta") {
+            onDelta(payload.text);
+        } else if (event === "done") {
+            data = payload;
+        } else if (event === "error") {
+            failure = busyError(payload.detail, payload.retry_after);
+        }
+    });
+    if (failure) {
+        throw failure;
+    }
+    if (!data) {
+        throw new Error("Stream ended without a result");
+    }
+    return data;
+}
+
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Error carrying the server's Retry-After (seconds), if it sent one
+function busyError(message, retryAfter) {
+    const error = new Error(message);
+    error.retryAfter = retryAfter ? Number(retryAfter) : null;
+    return error;
+}
+
+// === WEBSOCKET TRANSPORT ===
+// One socket per session carries events, streamed messages and server
+// pushes. While it is down the fetch endpoints are used instead, and on
+// reconnect "hello" sends our version so the server replays what we missed.
+const SOCKET_RETRY_MAX_MS = 10000;
+const socketState = {
+    ws: null,
+    ready: false,
+    nextId: 1,
+    pending: new Map(),   // id -> { resolve, reject, onDelta }
+    retryDelay: 500
+};
+
+function socketReady() {
+    return socketState.ready && socketState.ws.readyState === WebSocket.OPEN;
+}
+
+function connectSocket() {
+    if (!("WebSocket" in window)) return;
+    const ws = new WebSocket(`${API_BASE.replace(/^http/, "ws")}/ws/${gameState.sessionId}`);
+    socketState.ws = ws;
+    
+    ws.onopen = () => {
+        ws.send(JSON.stringify({
+            type: "hello",
+            since: gameState.version,
+            state_token: gameState.stateToken
+        }));
+    };
+    ws.onmessage = event => handleSocketFrame(JSON.parse(event.data));
+    ws.onclose = () => {
+        socketState.ready = false;
+        socketState.pending.forEach(request => {
+            const error = new Error("Socket closed");
+            error.socketClosed = true;
+            request.reject(error);
+        });
+        socketState.pending.clear();
+        if (gameState.gameOver) return;
+        setTimeout(connectSocket, socketState.retryDelay);
+        socketState.retryDelay = Math.min(socketState.retryDelay * 2, SOCKET_RETRY_MAX_MS);
+    };
+}
+
+// Send an operation; resolves with its reply frame
+function socketRequest(frame, onDelta) {
+    const id = socketState.nextId++;
+    return new Promise((resolve, reject) => {
+        socketState.pending.set(id, { resolve, reject, onDelta });
+        socketState.ws.send(JSON.stringify({ ...frame, id }));
+    });
+}
+
+function handleSocketFrame(frame) {
+    const request = frame.id !== undefined ? socketState.pending.get(frame.id) : null;
+    
+    switch (frame.type) {
+        case "welcome":
+            socketState.ready = true;
+            socketState.retryDelay = 500;
+            applyStateDelta(frame);
+            updateDebugInfo();
+            // A reply that finished while we were disconnected
+            if (frame.resumed && frame.history && frame.history.length) {
+                showHavenPopup(frame.history[frame.history.length - 1].haven);
+            }
+            if (frame.game_over) handleGameOver(frame.ending);
+            break;
+        case "ping":
+            socketState.ws.send(JSON.stringify({ type: "pong" }));
+            break;
+        case "delta":
+            if (request && request.onDelta) request.onDelta(frame.text);
+            break;
+        case "state":
+        case "result":
+        case "greeting":
+            if (request) {
+                socketState.pending.delete(frame.id);
+                request.resolve(frame);
+            } else {
+                // Server push: a change made elsewhere (another tab, HTTP)
+                applyStateDelta(frame);
+                updateDebugInfo();
+            }
+            break;
+        case "ending":
+            handleGameOver(frame.ending);
+            break;
+        case "error":
+            if (request) {
+                socketState.pending.delete(frame.id);
+                request.reject(busyError(frame.detail, frame.retry_after));
+            } else {
+                console.error("Socket error:", frame.detail);
+            }
+            break;
+    }
+}
+
+// Read a Server-Sent Events body, calling onEvent(event, data) per frame
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let event = "message";
+            let dataLines = [];
+            frame.split("\n").forEach(line => {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+            });
+            if (dataLines.length) {
+                onEvent(event, JSON.parse(dataLines.join("\n")));
+            }
+        }
+    }
+}
+
 function handleGameOver(ending) {
+    if (gameState.gameOver) return;  // result and push can both report it
+    gameState.gameOver = true;
     console.log("Game over:", ending);
     
     if (ending === "success") {
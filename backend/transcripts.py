@@ -0,0 +1,381 @@
+"""
+Append-only transcript log of player turns.
+Each turn is one JSON line in TRANSCRIPT_DIR: player text, HAVEN's reply,
+intent, phase before and after, ending, LLM latency and token usage.
+Requests only put records on a bounded queue; a background thread writes
+them to transcript.jsonl, and once that passes max_bytes it is renamed
+and gzipped (transcript-<UTC time>.jsonl.gz). If the writer falls behind
+and the queue fills, records are dropped (and counted) rather than
+slowing turns down.
+
+Statistics over any amount of logs, read a line at a time:
+
+    python transcripts.py transcripts/
+    python transcripts.py transcripts/ old/transcript-20250101T000000Z.jsonl.gz --json stats.json
+"""
+
+import os
+import sys
+import glob
+import gzip
+import json
+import queue
+import shutil
+import argparse
+import threading
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from metrics import LATENCY_BUCKETS
+
+
+CURRENT_FILE = "transcript.jsonl"
+ROTATED_PATTERN = "transcript-*.jsonl*"
+
+_STOP = object()
+
+
+class TranscriptLog:
+    """Bounded queue in front of a writer thread that appends, rotates and compresses."""
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_queue: int = 10000,
+        keep: int = 0,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep  # rotated files to keep (0 = all)
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        self._writer: Optional[threading.Thread] = None
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["TranscriptLog"]:
+        """The log configured by TRANSCRIPT_DIR, or None if it's unset."""
+        directory = os.getenv("TRANSCRIPT_DIR")
+        if not directory:
+            return None
+        return cls(
+            directory,
+            max_bytes=int(os.getenv("TRANSCRIPT_MAX_BYTES", str(64 * 1024 * 1024))),
+            max_queue=int(os.getenv("TRANSCRIPT_QUEUE", "10000")),
+            keep=int(os.getenv("TRANSCRIPT_KEEP", "0")),
+        )
+
+    def start(self):
+        """Create the directory and start the background writer."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="transcript-writer", daemon=True
+        )
+        self._writer.start()
+
+    def close(self):
+        """Write out queued records, compress the current file and stop the writer."""
+        if self._writer is None:
+            return
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._writer = None
+
+    def write(self, record: dict):
+        """Queue a record for the writer (dropped if the queue is full)."""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+    # --- Background writer ---
+
+    def _write_loop(self):
+        path = os.path.join(self.directory, CURRENT_FILE)
+        if os.path.exists(path) and os.path.getsize(path):
+            self._rotate(path)  # left over from an unclean shutdown
+        file = open(path, "ab")
+        size = file.tell()
+        try:
+            while True:
+                # Block for one record, then take whatever else is waiting
+                batch = [self._queue.get()]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = False
+                lines = []
+                for record in batch:
+                    if record is _STOP:
+                        stopping = True
+                        continue
+                    try:
+                        lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                    except (TypeError, ValueError) as e:
+                        print(f"Transcript record skipped: {e}")
+                        self.errors += 1
+
+                data = "".join(line + "\n" for line in lines).encode()
+                try:
+                    file.write(data)
+                    file.flush()
+                except OSError as e:
+                    print(f"Transcript write error: {e}")
+                    self.errors += 1
+                else:
+                    size += len(data)
+                    self.written += len(lines)
+
+                if stopping or size >= self.max_bytes:
+                    file.close()
+                    self._rotate(path)
+                    if stopping:
+                        break
+                    file = open(path, "ab")
+                    size = 0
+        finally:
+            if not file.closed:
+                file.close()
+
+    def _rotate(self, path: str):
+        """Rename the current file with a timestamp and gzip it."""
+        if not os.path.getsize(path):
+            return
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        rotated = os.path.join(self.directory, f"transcript-{stamp}.jsonl")
+        try:
+            os.replace(path, rotated)
+            # Readers take the plain file if compression is interrupted
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz.tmp", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.replace(rotated + ".gz.tmp", rotated + ".gz")
+            os.remove(rotated)
+        except OSError as e:
+            print(f"Transcript rotation error: {e}")
+            self.errors += 1
+            return
+        self.rotations += 1
+
+        if self.keep:
+            for name in rotated_files(self.directory)[:-self.keep]:
+                os.remove(name)
+
+
+def rotated_files(directory: str) -> list[str]:
+    """Rotated logs in a directory, oldest first, each once (no .tmp files)."""
+    rotated = set(glob.glob(os.path.join(directory, ROTATED_PATTERN)))
+    # A plain file next to its .gz was compressed but not yet removed
+    return sorted(
+        name for name in rotated
+        if not name.endswith(".tmp") and name + ".gz" not in rotated
+    )
+
+
+# --- Reading ---
+
+def log_files(paths: list[str]) -> list[str]:
+    """Files to read, oldest first: directories expand to rotated files, then the current one."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(rotated_files(path))
+            current = os.path.join(path, CURRENT_FILE)
+            if os.path.exists(current):
+                files.append(current)
+        else:
+            files.append(path)
+    return files
+
+
+def read_records(paths: list[str]) -> Iterator[dict]:
+    """Stream records from log files (plain or gzipped), skipping damaged lines."""
+    for name in log_files(paths):
+        opener = gzip.open if name.endswith(".gz") else open
+        try:
+            with opener(name, "rt", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # e.g. a line cut short by a crash
+        except (OSError, EOFError) as e:
+            print(f"{name}: {e}", file=sys.stderr)
+
+
+class TranscriptStats:
+    """Running totals over transcript records; memory doesn't grow with the log."""
+
+    def __init__(self):
+        self.turns = 0
+        self.games = 0
+        self.fallbacks = 0
+        self.intents = Counter()
+        self.intents_by_phase: dict[int, Counter] = {}
+        self.endings = Counter()
+        self.turns_to_ending: dict[str, Counter] = {}
+        self.phase_changes = Counter()
+        self.tokens = Counter()
+        self.cost = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.first_ts: Optional[float] = None
+        self.last_ts: Optional[float] = None
+
+    def add(self, record: dict):
+        self.turns += 1
+        if record.get("turn") == 1:
+            self.games += 1
+        if record.get("fallback"):
+            self.fallbacks += 1
+
+        intent = record.get("intent", "unknown")
+        before, after = record.get("phase_before"), record.get("phase_after")
+        self.intents[intent] += 1
+        self.intents_by_phase.setdefault(before, Counter())[intent] += 1
+        if before != after:
+            self.phase_changes[f"{before}->{after}"] += 1
+
+        ending = record.get("ending")
+        if ending:
+            self.endings[ending] += 1
+            self.turns_to_ending.setdefault(ending, Counter())[record.get("turn")] += 1
+
+        usage = record.get("usage")
+        if usage:
+            for kind in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+                self.tokens[kind] += usage.get(kind, 0)
+        self.cost += record.get("cost") or 0.0
+
+        latency = record.get("latency")
+        if latency is not None:
+            self.latency_buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_count += 1
+            self.latency_sum += latency
+
+        ts = record.get("ts")
+        if ts is not None:
+            self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+            self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding quantile q (None past the last bucket)."""
+        if not self.latency_count:
+            return None
+        rank = q * self.latency_count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def report(self) -> dict:
+        def median(counts: Counter) -> Optional[int]:
+            total = sum(counts.values())
+            seen = 0
+            for value in sorted(counts):
+                seen += counts[value]
+                if seen * 2 >= total:
+                    return value
+            return None
+
+        return {
+            "turns": self.turns,
+            "games": self.games,
+            "from": self.first_ts,
+            "to": self.last_ts,
+            "fallback_rate": round(self.fallbacks / self.turns, 4) if self.turns else 0.0,
+            "intents": dict(self.intents.most_common()),
+            "intents_by_phase": {
+                str(phase): dict(counts.most_common())
+                for phase, counts in sorted(self.intents_by_phase.items(), key=lambda item: str(item[0]))
+            },
+            "endings": dict(self.endings.most_common()),
+            "ending_rate": {
+                ending: round(count / self.games, 4) if self.games else None
+                for ending, count in self.endings.items()
+            },
+            "median_turns_to_ending": {
+                ending: median(counts) for ending, counts in self.turns_to_ending.items()
+            },
+            "phase_changes": dict(sorted(self.phase_changes.items())),
+            "tokens": dict(self.tokens),
+            "cost": round(self.cost, 4),
+            "latency": {
+                "mean": round(self.latency_sum / self.latency_count, 3) if self.latency_count else None,
+                "p50_under": self.latency_quantile(0.5),
+                "p95_under": self.latency_quantile(0.95),
+                "p99_under": self.latency_quantile(0.99),
+            },
+        }
+
+
+def print_report(report: dict):
+    def when(ts):
+        return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds") if ts else "-"
+
+    print(f"{report['turns']} turns in {report['games']} games, {when(report['from'])} to {when(report['to'])}")
+    print(f"Fallback replies: {report['fallback_rate']:.2%}")
+    print(f"Tokens: {report['tokens']}, cost ${report['cost']}")
+    print(f"LLM latency: {report['latency']}")
+
+    print("\nEndings (share of games, median turns):")
+    for ending, count in report["endings"].items():
+        rate = report["ending_rate"][ending]
+        share = f"{rate:.2%}" if rate is not None else "-"
+        print(f"  {ending:<12} {count:>8}  {share:>8}  {report['median_turns_to_ending'][ending]}")
+
+    print("\nIntents:")
+    for intent, count in report["intents"].items():
+        print(f"  {intent:<24} {count:>8}  {count / report['turns']:.2%}")
+
+    print("\nIntents by phase:")
+    for phase, counts in report["intents_by_phase"].items():
+        top = ", ".join(f"{intent} {count}" for intent, count in list(counts.items())[:5])
+        print(f"  phase {phase}: {top}")
+
+    print("\nPhase changes:")
+    for change, count in report["phase_changes"].items():
+        print(f"  {change}  {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Intent and ending statistics over transcript logs.")
+    parser.add_argument(
+        "paths", nargs="*", default=[os.getenv("TRANSCRIPT_DIR", "transcripts")],
+        help="log directories or files (default: TRANSCRIPT_DIR)",
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args()
+
+    stats = TranscriptStats()
+    for record in read_records(args.paths):
+        stats.add(record)
+    report = stats.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()